@@ -7,19 +7,32 @@ Using FLUX 2 Dev model from Hugging Face
 from io import BytesIO
 from pathlib import Path
 import base64
+import copy
 import hashlib
 import json
+import math
 import modal
 import os
+import queue
+import random
+import re
+import socket
+import sqlite3
 import threading
 import time
 import asyncio
+import contextlib
+import functools
 import traceback
-from fastapi import FastAPI, HTTPException
+import unicodedata
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
-import requests
 
 def decode_base64_image(base64_string: str) -> bytes:
     """Convert base64 string to bytes, handling data URI prefix"""
@@ -90,13 +103,36 @@ image = (
     })
 )
 
-# Import statements for Modal
+# Slim image for the web tier (fastapi_app) - no torch/diffusers/transformers/audio stack,
+# so web containers start in hundreds of milliseconds instead of importing the GPU stack
+web_image = (
+    modal.Image.debian_slim(python_version="3.12")
+    .pip_install(
+        "fastapi>=0.110.0",
+        "pydantic>=2.7.0",
+        "uvicorn[standard]>=0.29.0",
+        "Pillow>=11.2.1",
+        "httpx>=0.27.0",
+        # Room pre-classifier (quantized CLIP on CPU) - no torch in the web tier
+        "numpy",
+        "onnxruntime>=1.18.0",
+        "tokenizers>=0.19.0",
+        "huggingface_hub>=0.23.0",
+    )
+)
+
+# Import statements for Modal - heavy GPU-only imports are skipped in web_image containers
 with image.imports():
     import torch
+    import numpy as np
     from diffusers import Flux2Pipeline  # For FLUX.2-dev
     from diffusers.utils import load_image
-    from transformers import AutoProcessor, AutoModelForCausalLM, AutoTokenizer
-    from PIL import Image
+    from transformers import AutoProcessor, AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList, StoppingCriteriaList
+
+# Pillow is installed in both images (web-tier pre-resize and GPU-side image loading)
+with web_image.imports():
+    from PIL import Image, ImageOps
+    import numpy as np
 
 # Pydantic models for API
 class GenerationRequest(BaseModel):
@@ -110,6 +146,8 @@ class GenerationRequest(BaseModel):
     width: int = 512
     height: int = 512
     seed: Optional[int] = None
+    session_id: Optional[str] = None  # enables the per-session generation quota
+    deadline_ms: Optional[int] = None  # previews: latency budget used to pick a quality rung (see PREVIEW_QUALITY_LADDER)
 
 class GenerationResponse(BaseModel):
     images: List[str]  # base64 encoded images
@@ -122,6 +160,7 @@ class UpscaleRequest(BaseModel):
     seed: int
     target_size: int = 512
     inspiration_images: Optional[List[str]] = None  # Additional reference images for multi-reference (base64)
+    session_id: Optional[str] = None  # enables the per-session generation quota
 
 class UpscaleResponse(BaseModel):
     image: str  # base64 encoded upscaled image
@@ -140,6 +179,7 @@ class RoomAnalysisMetadata(BaseModel):
 class RoomAnalysisRequest(BaseModel):
     image: str  # base64 encoded image
     metadata: Optional[RoomAnalysisMetadata] = None
+    include_comment: bool = True  # False: only the room type is needed, a confident pre-classifier answer skips Gemma
 
 class RoomAnalysisResponse(BaseModel):
     detected_room_type: str
@@ -167,76 +207,753 @@ class InspirationAnalysisResponse(BaseModel):
     materials: List[str]
     biophilia: int  # 0-3 scale
     description: str
+    color_names: Optional[List[str]] = None  # nearest named colour for each entry of `colors`
+
+class AnalyzeBatchRequest(BaseModel):
+    room_image: Optional[str] = None  # base64 encoded room photo
+    inspiration_images: List[str] = []  # base64 encoded inspiration images
+    metadata: Optional[RoomAnalysisMetadata] = None
 
 
 ROOM_ANALYSIS_SESSION_LIMIT = int(os.environ.get("ROOM_ANALYSIS_SESSION_LIMIT", "1"))
 ROOM_ANALYSIS_SESSION_WINDOW_SECONDS = int(os.environ.get("ROOM_ANALYSIS_SESSION_WINDOW_SECONDS", "3600"))
-_room_analysis_usage: dict[str, dict[str, float]] = {}
-_room_analysis_usage_lock = threading.Lock()
 GROQ_API_URL = os.environ.get("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
 GROQ_LLM_MODEL = os.environ.get("GROQ_LLM_MODEL", "llama-3.1-8b-instant")
 
+# Web-tier preprocessing: downscale images to the size the GPU will use before calling .remote(),
+# so the A100 container receives small JPEGs instead of full-resolution originals
+WEB_PRERESIZE_ENABLED = os.environ.get("WEB_PRERESIZE_ENABLED", "0").lower() in ("1", "true", "yes")
+WEB_PRERESIZE_JPEG_QUALITY = int(os.environ.get("WEB_PRERESIZE_JPEG_QUALITY", "92"))
 
-def _check_room_analysis_quota(session_id: Optional[str]) -> None:
-    """Ensure a session does not exceed the configured number of analyses per time window."""
-    if not session_id:
-        return
 
-    now = time.time()
-    with _room_analysis_usage_lock:
-        entry = _room_analysis_usage.get(session_id)
-        if not entry or now - entry["start"] > ROOM_ANALYSIS_SESSION_WINDOW_SECONDS:
-            _room_analysis_usage[session_id] = {"count": 1, "start": now}
+# =========================================
+# QUOTAS / RATE LIMITING
+# =========================================
+# Token buckets keyed by session id. State lives in a pluggable backend:
+# - memory: per-container dict with TTL + LRU eviction (default)
+# - sqlite: shared by every worker on the host (QUOTA_SQLITE_PATH)
+# - redis:  any Redis-protocol server (redis-server/valkey locally, or a managed instance) - shared across containers
+QUOTA_BACKEND = os.environ.get("QUOTA_BACKEND", "memory").lower()
+QUOTA_SQLITE_PATH = os.environ.get("QUOTA_SQLITE_PATH", "/tmp/aura-quota.sqlite3")
+QUOTA_REDIS_URL = os.environ.get("QUOTA_REDIS_URL", "redis://127.0.0.1:6379/0")
+QUOTA_MEMORY_MAX_KEYS = int(os.environ.get("QUOTA_MEMORY_MAX_KEYS", "100000"))
+
+# Generation routes: cost units per session, 1 unit = one 512x512 image at 28 steps
+GENERATION_QUOTA_CAPACITY = float(os.environ.get("GENERATION_QUOTA_CAPACITY", "60"))
+GENERATION_QUOTA_WINDOW_SECONDS = int(os.environ.get("GENERATION_QUOTA_WINDOW_SECONDS", "3600"))
+GENERATION_COST_UNIT = 28 * 512 * 512
+
+
+def _token_bucket_take(tokens: Optional[float], updated_at: Optional[float], cost: float,
+                       capacity: float, refill_per_second: float, now: float) -> tuple:
+    """Refill a bucket up to `now` and try to take `cost` tokens.
+
+    Returns (allowed, tokens_left, retry_after_seconds, ttl_seconds). A missing bucket starts full;
+    ttl is how long until the bucket is full again - after that its state is redundant and can be evicted.
+    """
+    if tokens is None or updated_at is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, tokens + max(0.0, now - updated_at) * refill_per_second)
+
+    if tokens >= cost:
+        tokens -= cost
+        allowed, retry_after = True, 0.0
+    else:
+        allowed, retry_after = False, (cost - tokens) / refill_per_second
+
+    ttl = (capacity - tokens) / refill_per_second
+    return allowed, tokens, retry_after, ttl
+
+
+class MemoryQuotaBackend:
+    """In-process buckets with TTL eviction and a hard cap on the number of tracked keys"""
+
+    def __init__(self, max_keys: int = QUOTA_MEMORY_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (tokens, updated_at, expires_at)
+        self._lock = threading.Lock()
+
+    def take(self, key: str, cost: float, capacity: float, refill_per_second: float) -> tuple:
+        now = time.time()
+        with self._lock:
+            # Buckets are kept in last-access order - drop expired ones from the cold end
+            while self._buckets:
+                _, (_, _, expires_at) = next(iter(self._buckets.items()))
+                if expires_at > now:
+                    break
+                self._buckets.popitem(last=False)
+
+            tokens, updated_at, _ = self._buckets.pop(key, (None, None, None))
+            allowed, tokens, retry_after, ttl = _token_bucket_take(tokens, updated_at, cost, capacity, refill_per_second, now)
+            self._buckets[key] = (tokens, now, now + ttl)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+
+class SQLiteQuotaBackend:
+    """Buckets in a SQLite file, shared by all processes on the host"""
+
+    def __init__(self, path: str = QUOTA_SQLITE_PATH, sweep_every: int = 500):
+        self.path = path
+        self.sweep_every = sweep_every
+        self._calls = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS quota_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS quota_buckets_expires ON quota_buckets (expires_at)")
+
+    def take(self, key: str, cost: float, capacity: float, refill_per_second: float) -> tuple:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT tokens, updated_at FROM quota_buckets WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+                tokens, updated_at = row if row else (None, None)
+                allowed, tokens, retry_after, ttl = _token_bucket_take(tokens, updated_at, cost, capacity, refill_per_second, now)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO quota_buckets (key, tokens, updated_at, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, tokens, now, now + ttl),
+                )
+                self._calls += 1
+                if self._calls % self.sweep_every == 0:
+                    self._conn.execute("DELETE FROM quota_buckets WHERE expires_at <= ?", (now,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return allowed, retry_after
+
+
+class RedisQuotaBackend:
+    """Buckets in a Redis-protocol server, updated atomically by a Lua script and expired with PEXPIRE.
+
+    Speaks RESP over a plain socket, so no client library is needed in the web image. Uses the server clock,
+    which keeps buckets consistent across web containers.
+    """
+
+    _SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local cost = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tokens = tonumber(state[1])
+if tokens == nil then
+  tokens = capacity
+else
+  tokens = math.min(capacity, tokens + math.max(0, now - tonumber(state[2])) * rate)
+end
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+else
+  retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return {allowed, tostring(retry_after)}
+"""
+
+    def __init__(self, url: str = QUOTA_REDIS_URL, key_prefix: str = "aura:quota:", timeout: float = 2.0):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> None:
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile("rb")
+        if self.password:
+            self._command("AUTH", self.password)
+        if self.db:
+            self._command("SELECT", self.db)
+
+    def _close(self) -> None:
+        try:
+            if self._sock:
+                self._sock.close()
+        finally:
+            self._sock = None
+            self._reader = None
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RuntimeError(f"Redis error: {payload.decode()}")
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2].decode()
+        if kind == b"*":
+            count = int(payload)
+            return None if count == -1 else [self._read_reply() for _ in range(count)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    def _command(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = str(arg).encode()
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        self._sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def take(self, key: str, cost: float, capacity: float, refill_per_second: float) -> tuple:
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    allowed, retry_after = self._command(
+                        "EVAL", self._SCRIPT, 1, self.key_prefix + key, cost, capacity, refill_per_second
+                    )
+                    return bool(allowed), float(retry_after)
+                except (OSError, ConnectionError):
+                    # Stale connection (server restart, idle timeout) - reconnect once
+                    self._close()
+                    if attempt:
+                        raise
+
+
+class QuotaLimiter:
+    """Token-bucket limiter: `capacity` cost units per session, refilled evenly over `window_seconds`"""
+
+    def __init__(self, name: str, capacity: float, window_seconds: float, detail: str):
+        self.name = name
+        self.capacity = capacity
+        self.refill_per_second = capacity / window_seconds
+        self.detail = detail
+
+    async def check(self, key: Optional[str], cost: float = 1.0) -> None:
+        """Take `cost` units from the key's bucket or raise 429 with Retry-After. The backend call (SQLite
+        transaction, Redis round trip) runs in the web worker pool, off the event loop"""
+        if not key:
             return
 
-        entry["count"] += 1
-        if entry["count"] > ROOM_ANALYSIS_SESSION_LIMIT:
-            raise HTTPException(
-                status_code=429,
-                detail="Room analysis quota exceeded for this session. Please wait before retrying.",
+        # A request costlier than the whole bucket could never pass - charge it as a full bucket instead
+        cost = min(cost, self.capacity)
+        try:
+            allowed, retry_after = await _run_in_pool(
+                lambda: _get_quota_backend().take(f"{self.name}:{key}", cost, self.capacity, self.refill_per_second)
             )
+        except Exception as exc:
+            # Fail open - a broken quota store must not take the API down with it
+            print(f"[QUOTA] {self.name} backend error, allowing request: {exc}")
+            return
+
+        if not allowed:
+            retry_after_s = max(1, int(retry_after + 0.999))
+            print(f"[QUOTA] {self.name} limit hit for key={key} cost={cost:.2f} retry_after={retry_after_s}s")
+            raise HTTPException(status_code=429, detail=self.detail, headers={"Retry-After": str(retry_after_s)})
+
+
+_quota_backend = None
+_quota_backend_lock = threading.Lock()
+
+
+def _get_quota_backend():
+    """Create the configured quota backend on first use"""
+    global _quota_backend
+    if _quota_backend is None:
+        with _quota_backend_lock:
+            if _quota_backend is None:
+                backends = {"memory": MemoryQuotaBackend, "sqlite": SQLiteQuotaBackend, "redis": RedisQuotaBackend}
+                if QUOTA_BACKEND not in backends:
+                    raise ValueError(f"Unknown QUOTA_BACKEND: {QUOTA_BACKEND}")
+                _quota_backend = backends[QUOTA_BACKEND]()
+                print(f"[QUOTA] Using {QUOTA_BACKEND} backend")
+    return _quota_backend
+
+
+room_analysis_quota = QuotaLimiter(
+    "room_analysis",
+    capacity=ROOM_ANALYSIS_SESSION_LIMIT,
+    window_seconds=ROOM_ANALYSIS_SESSION_WINDOW_SECONDS,
+    detail="Room analysis quota exceeded for this session. Please wait before retrying.",
+)
+generation_quota = QuotaLimiter(
+    "generation",
+    capacity=GENERATION_QUOTA_CAPACITY,
+    window_seconds=GENERATION_QUOTA_WINDOW_SECONDS,
+    detail="Generation quota exceeded for this session. Please wait before retrying.",
+)
+
+
+def _generation_cost(steps: int, width: int, height: int, num_images: int = 1) -> float:
+    """Quota cost of a FLUX call, weighted by steps x pixels (1.0 = one 512x512 image at 28 steps)"""
+    return max(1, num_images) * max(1, steps) * width * height / GENERATION_COST_UNIT
+
+
+async def _check_room_analysis_quota(session_id: Optional[str]) -> None:
+    """Ensure a session does not exceed the configured number of analyses per time window."""
+    await room_analysis_quota.check(session_id)
+
+
+# Groq client: one pooled async HTTP client per web container, short connect timeout, bounded retries
+# with jittered backoff, and a circuit breaker that skips Groq entirely while it keeps failing
+GROQ_CONNECT_TIMEOUT_SECONDS = float(os.environ.get("GROQ_CONNECT_TIMEOUT_SECONDS", "2"))
+GROQ_READ_TIMEOUT_SECONDS = float(os.environ.get("GROQ_READ_TIMEOUT_SECONDS", "12"))
+GROQ_MAX_RETRIES = int(os.environ.get("GROQ_MAX_RETRIES", "2"))
+GROQ_RETRY_BASE_SECONDS = float(os.environ.get("GROQ_RETRY_BASE_SECONDS", "0.3"))
+GROQ_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("GROQ_BREAKER_FAILURE_THRESHOLD", "5"))
+GROQ_BREAKER_RESET_SECONDS = float(os.environ.get("GROQ_BREAKER_RESET_SECONDS", "30"))
+
+# Comments served when Groq is unavailable (no API key, breaker open, or the call failed)
+LLM_FALLBACK_COMMENTS = {
+    "kitchen": "Świetnie! Ta wygenerowana kuchnia wygląda naprawdę fantastycznie! Widzę idealne miejsce do gotowania i spotkań rodzinnych.",
+    "living_room": "Świetnie! Ten pokój dzienny ma naprawdę przytulną atmosferę. Idealne miejsce na relaks i spędzanie czasu z bliskimi.",
+    "bedroom": "Uwielbiam tę sypialnię! Wygląda na bardzo komfortowe i spokojne miejsce do wypoczynku.",
+    "bathroom": "Ta łazienka ma naprawdę elegancki styl! Idealne miejsce na relaks i regenerację.",
+    "office": "Fantastyczne biuro! Widzę tu idealne warunki do pracy i kreatywności.",
+    "empty_room": "Świetnie! To puste pomieszczenie ma naprawdę duży potencjał - możemy stworzyć tu coś wyjątkowego!"
+}
+LLM_FALLBACK_DEFAULT_COMMENT = "Świetnie! To wygenerowane wnętrze wygląda naprawdę fantastycznie!"
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker: closed -> open after `failure_threshold` failures,
+    half-open (one probe allowed) once `reset_seconds` have passed, closed again on success."""
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            print(f"[{self.name}] Circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def cancel_probe(self) -> None:
+        """The half-open probe ended without an outcome (task cancelled) - let the next call probe instead"""
+        self._probe_in_flight = False
 
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            # A failed half-open probe re-opens the breaker for another reset period
+            self.opened_at = time.monotonic()
+            print(f"[{self.name}] Circuit open for {self.reset_seconds:.0f}s after {self.failures} failure(s)")
 
-def _call_groq_for_comment(room_type: str, room_description: str, context: str = "room_analysis") -> Optional[str]:
+
+class _RetryableGroqError(Exception):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+groq_breaker = CircuitBreaker("GROQ", GROQ_BREAKER_FAILURE_THRESHOLD, GROQ_BREAKER_RESET_SECONDS)
+_groq_client = None
+
+
+def _get_groq_client():
+    """Shared keep-alive client for Groq calls (created lazily inside the web container)"""
+    global _groq_client
+    if _groq_client is None:
+        import httpx
+        _groq_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(GROQ_READ_TIMEOUT_SECONDS, connect=GROQ_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=8, keepalive_expiry=60.0),
+        )
+    return _groq_client
+
+
+async def _close_groq_client() -> None:
+    global _groq_client
+    if _groq_client is not None:
+        await _groq_client.aclose()
+        _groq_client = None
+
+
+async def _call_groq_for_comment(room_type: str, room_description: str, context: str = "room_analysis") -> Optional[str]:
     api_key = os.environ.get("GROQ_API_KEY")
     if not api_key:
         return None
 
-    try:
-        if context == "room_analysis":
-            prompt = (
-                f"Zdjęcie przedstawia {room_description or 'wnętrze'}. "
-                f"Użytkownik prosi o krótki, ciepły komentarz dotyczący pomieszczenia typu {room_type}. "
-                "Napisz 2-3 zdania po polsku, przyjaznym tonem, zachęcając do wspólnego projektowania."
-            )
-        else:
-            prompt = (
-                f"Wygenerowane wnętrze ({room_type}) opisane jako: {room_description or 'brak opisu'}. "
-                "Przygotuj krótki komentarz (2-3 zdania) po polsku, zachęcający użytkownika do dalszych iteracji."
-            )
+    probe = groq_breaker.state == "half_open"
+    if not groq_breaker.allow():
+        print("[GROQ] Circuit open, serving fallback comment")
+        return None
 
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "model": GROQ_LLM_MODEL,
-            "messages": [
-                {"role": "system", "content": "Jesteś IDA - empatyczną architektką wnętrz mówiącą po polsku."},
-                {"role": "user", "content": prompt},
-            ],
-            "temperature": 0.7,
-            "max_tokens": 320,
-        }
+    if context == "room_analysis":
+        prompt = (
+            f"Zdjęcie przedstawia {room_description or 'wnętrze'}. "
+            f"Użytkownik prosi o krótki, ciepły komentarz dotyczący pomieszczenia typu {room_type}. "
+            "Napisz 2-3 zdania po polsku, przyjaznym tonem, zachęcając do wspólnego projektowania."
+        )
+    else:
+        prompt = (
+            f"Wygenerowane wnętrze ({room_type}) opisane jako: {room_description or 'brak opisu'}. "
+            "Przygotuj krótki komentarz (2-3 zdania) po polsku, zachęcający użytkownika do dalszych iteracji."
+        )
+
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+    payload = {
+        "model": GROQ_LLM_MODEL,
+        "messages": [
+            {"role": "system", "content": "Jesteś IDA - empatyczną architektką wnętrz mówiącą po polsku."},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0.7,
+        "max_tokens": 320,
+    }
+
+    try:
+        import httpx
+        client = _get_groq_client()
+        for attempt in range(GROQ_MAX_RETRIES + 1):
+            try:
+                response = await client.post(GROQ_API_URL, headers=headers, json=payload)
+                if response.status_code == 429 or response.status_code >= 500:
+                    retry_after = response.headers.get("Retry-After")
+                    raise _RetryableGroqError(
+                        f"HTTP {response.status_code}",
+                        float(retry_after) if retry_after and retry_after.replace(".", "", 1).isdigit() else None,
+                    )
+                response.raise_for_status()
+                content = response.json()["choices"][0]["message"]["content"]
+                groq_breaker.record_success()
+                return content.strip()
+            except (_RetryableGroqError, httpx.TransportError) as exc:
+                if attempt == GROQ_MAX_RETRIES:
+                    print(f"[GROQ] Comment generation failed after {attempt + 1} attempt(s): {exc}")
+                    break
+                # Exponential backoff with full jitter, honouring a short Retry-After from Groq
+                delay = random.uniform(0, GROQ_RETRY_BASE_SECONDS * (2 ** attempt))
+                if isinstance(exc, _RetryableGroqError) and exc.retry_after is not None:
+                    delay = max(delay, min(exc.retry_after, GROQ_READ_TIMEOUT_SECONDS))
+                print(f"[GROQ] Attempt {attempt + 1} failed ({exc}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+            except Exception as exc:
+                # Non-retryable (4xx, malformed body)
+                print(f"[GROQ] Comment generation failed: {exc}")
+                break
 
-        response = requests.post(GROQ_API_URL, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        content = data["choices"][0]["message"]["content"]
-        return content.strip()
-    except Exception as exc:
-        print(f"[GROQ] Comment generation failed: {exc}")
+        groq_breaker.record_failure()
         return None
+    except BaseException:
+        # Cancelled mid-call (client disconnect, wait_for): CancelledError skips the handlers above, so release
+        # the half-open probe here or the breaker would wait for its outcome forever
+        if probe:
+            groq_breaker.cancel_probe()
+        raise
+
+
+# LLM comment caching: /llm-comment is called after every generated image with mostly the same room type and context
+LLM_COMMENT_CACHE_TTL_SECONDS = float(os.environ.get("LLM_COMMENT_CACHE_TTL_SECONDS", "900"))
+LLM_COMMENT_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_COMMENT_CACHE_MAX_ENTRIES", "1024"))
+LLM_COMMENT_POOL_SIZE = int(os.environ.get("LLM_COMMENT_POOL_SIZE", "0"))  # >0 serves pre-generated comments per (room_type, context)
+LLM_COMMENT_POOL_TTL_SECONDS = float(os.environ.get("LLM_COMMENT_POOL_TTL_SECONDS", "3600"))
+
+
+class AsyncTTLCache:
+    """LRU cache with per-entry TTL and request coalescing - concurrent misses on one key share a single computation.
+    None results are not cached, so failures (e.g. Groq down) are retried on the next request."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[object, tuple]" = OrderedDict()  # key -> (expires_at, value)
+        self._in_flight: dict = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def has(self, key) -> bool:
+        """True if get_or_compute(key) would be served without computing: a live entry or one in flight"""
+        return key in self._in_flight or self.get(key) is not None
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(in_flight)
+
+        self.misses += 1
+        # The computation runs as its own task and every caller (the first one too) waits through a shield, so a
+        # cancelled caller (client disconnect, timeout) never cancels the shared work for the others
+        task = asyncio.ensure_future(self._compute(key, compute))
+        # Every caller may have gone by the time it fails - don't let asyncio log "exception never retrieved"
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._in_flight[key] = task
+        return await asyncio.shield(task)
+
+    async def _compute(self, key, compute):
+        try:
+            value = await compute()
+            if value is not None:
+                self.put(key, value)
+            return value
+        finally:
+            del self._in_flight[key]
+
+
+class CommentPool:
+    """Per-(room_type, context) pool of varied comments generated in the background.
+    Requests are served from the pool immediately; the pool refills itself up to `size` entries."""
+
+    def __init__(self, size: int, ttl_seconds: float):
+        self.size = size
+        self.ttl_seconds = ttl_seconds
+        self._pools: dict = {}  # key -> list of (expires_at, comment)
+        self._refilling: set = set()
+
+    def take(self, room_type: str, context: str) -> Optional[str]:
+        key = (room_type, context)
+        now = time.monotonic()
+        pool = [entry for entry in self._pools.get(key, []) if entry[0] > now]
+        self._pools[key] = pool
+        if len(pool) < self.size and key not in self._refilling:
+            self._refilling.add(key)
+            asyncio.get_running_loop().create_task(self._refill(key))
+        return random.choice(pool)[1] if pool else None
+
+    async def _refill(self, key: tuple) -> None:
+        room_type, context = key
+        try:
+            while len(self._pools.get(key, [])) < self.size:
+                comment = await _call_groq_for_comment(room_type, "", context)
+                if not comment:
+                    break
+                self._pools.setdefault(key, []).append((time.monotonic() + self.ttl_seconds, comment))
+        finally:
+            self._refilling.discard(key)
+
+
+llm_comment_cache = AsyncTTLCache(LLM_COMMENT_CACHE_MAX_ENTRIES, LLM_COMMENT_CACHE_TTL_SECONDS)
+llm_comment_pool = CommentPool(LLM_COMMENT_POOL_SIZE, LLM_COMMENT_POOL_TTL_SECONDS)
+
+
+def _llm_comment_cache_key(room_type: str, room_description: str, context: str) -> tuple:
+    """Cache key that treats descriptions differing only in case, punctuation or whitespace as the same"""
+    description = "".join(ch if ch.isalnum() else " " for ch in (room_description or "").lower())
+    return (room_type, context, " ".join(description.split()))
+
+
+async def _get_llm_comment(room_type: str, room_description: str, context: str) -> Optional[str]:
+    """Groq comment via the pre-generated pool (if enabled) or the coalescing TTL cache"""
+    if LLM_COMMENT_POOL_SIZE > 0:
+        pooled = llm_comment_pool.take(room_type, context)
+        if pooled:
+            return pooled
+
+    key = _llm_comment_cache_key(room_type, room_description, context)
+    return await llm_comment_cache.get_or_compute(
+        key, lambda: _call_groq_for_comment(room_type, room_description, context)
+    )
+
+def _preview_size(request: GenerationRequest) -> int:
+    """Square edge used for preview generation (0.26MP max, valid per BFL docs)"""
+    return max(256, min(request.width or 512, request.height or 512, 512))
+
+
+def _preview_steps(request: GenerationRequest) -> int:
+    """Inference steps used for preview generation"""
+    return min(28, request.num_inference_steps or 20)
+
+
+def _final_size(request: GenerationRequest) -> int:
+    """Square edge used for final generation - kept close to requested size to save VRAM"""
+    return max(256, min(request.width, request.height, 768))
+
+
+# Aspect-ratio buckets: instead of squashing every photo to a square, inputs are cropped to the nearest bucket
+# ratio and sized to the tier's pixel budget (edge * edge from _preview_size/_final_size/target_size), with both
+# sides multiples of 16 as FLUX requires
+ASPECT_BUCKETS = [
+    (label, int(w) / int(h))
+    for label in os.environ.get("ASPECT_BUCKETS", "1:1,5:4,4:5,4:3,3:4,3:2,2:3,16:9,9:16").split(",")
+    for w, h in [label.strip().split(":")]
+]
+
+
+@functools.lru_cache(maxsize=1024)
+def aspect_bucket(width: int, height: int, edge: int) -> tuple:
+    """(bucket_width, bucket_height, label) for a width x height input and an edge * edge pixel budget"""
+    ratio = width / height
+    label, bucket_ratio = min(ASPECT_BUCKETS, key=lambda bucket: abs(math.log(bucket[1] / ratio)))
+    budget = edge * edge
+    bucket_width = max(16, int(math.sqrt(budget * bucket_ratio)) // 16 * 16)
+    bucket_height = max(16, int(math.sqrt(budget / bucket_ratio)) // 16 * 16)
+    return bucket_width, bucket_height, label.strip()
+
+
+def _fit_to_bucket(img, edge: int, resample=None):
+    """Center-crop `img` to its aspect bucket and resize to the bucket size -> (image, label)"""
+    bucket_width, bucket_height, label = aspect_bucket(img.width, img.height, edge)
+    if img.size != (bucket_width, bucket_height):
+        img = ImageOps.fit(img, (bucket_width, bucket_height), method=resample or Image.Resampling.BICUBIC)
+    return img, label
+
+
+# Upscale enhancement runs as one pass over the whole image. UPSCALE_TILE_SIZE > 0 opts into pixel-space tiles
+# (overlapping, seams feather-blended) so peak GPU memory depends on the tile size - experimental: Flux2Pipeline has
+# no img2img strength, so every tile is re-denoised on its own and overlaps can disagree (ghosting in the blend);
+# seamless tiles need latent tiles with shared noise inside a custom denoising loop
+UPSCALE_TILE_SIZE = int(os.environ.get("UPSCALE_TILE_SIZE", "0")) // 16 * 16
+UPSCALE_TILE_OVERLAP = int(os.environ.get("UPSCALE_TILE_OVERLAP", "128"))
+UPSCALE_MAX_TARGET_SIZE = int(os.environ.get("UPSCALE_MAX_TARGET_SIZE", "2048"))
+
+
+def plan_tiles(width: int, height: int, tile_size: int, overlap: int) -> list:
+    """Tile boxes (left, top, right, bottom) covering width x height; consecutive tiles overlap by at least
+    `overlap` pixels and tiles are at most tile_size on each side (the full side when it is smaller)"""
+    def spans(length: int) -> list:
+        size = min(tile_size, length)
+        if size == length:
+            return [(0, length)]
+        step_overlap = min(overlap, size // 2)
+        count = math.ceil((length - step_overlap) / (size - step_overlap))
+        stride = (length - size) / (count - 1)
+        return [(round(i * stride), round(i * stride) + size) for i in range(count)]
+
+    return [(left, top, right, bottom) for top, bottom in spans(height) for left, right in spans(width)]
+
+
+def _tile_weights(box: tuple, width: int, height: int, overlap: int):
+    """Feather mask for a tile: linear ramps over `overlap` pixels on sides shared with other tiles"""
+    left, top, right, bottom = box
+
+    def ramp(length: int, start_inside: bool, end_inside: bool):
+        weights = np.ones(length, dtype=np.float32)
+        if overlap > 0:
+            edge = np.minimum(1.0, (np.arange(length, dtype=np.float32) + 1) / (overlap + 1))
+            if start_inside:
+                weights = np.minimum(weights, edge)
+            if end_inside:
+                weights = np.minimum(weights, edge[::-1])
+        return weights
+
+    return np.outer(ramp(bottom - top, top > 0, bottom < height), ramp(right - left, left > 0, right < width))
+
+
+def blend_tiles(width: int, height: int, tiles: list, overlap: int):
+    """Weighted average of (box, HxWxC array) tiles into one height x width x C float array"""
+    channels = tiles[0][1].shape[2]
+    total = np.zeros((height, width, channels), dtype=np.float32)
+    weight_sum = np.zeros((height, width, 1), dtype=np.float32)
+    for box, pixels in tiles:
+        left, top, right, bottom = box
+        weights = _tile_weights(box, width, height, overlap)[:, :, None]
+        total[top:bottom, left:right] += pixels.astype(np.float32) * weights
+        weight_sum[top:bottom, left:right] += weights
+    return total / np.maximum(weight_sum, 1e-6)
+
+
+# Text-encoder outputs per canonical prompt fingerprint (kept on CPU); the same prompt is encoded for previews,
+# the final render and the upscale pass
+FLUX_PROMPT_EMBED_CACHE_SIZE = int(os.environ.get("FLUX_PROMPT_EMBED_CACHE_SIZE", "16"))
+UPSCALE_DEFAULT_PROMPT = "Enhance image quality, preserve all details"
+
+# Finished generations on the web tier, keyed by prompt fingerprint + input images + sampling settings (the GPU
+# falls back to a fixed seed, so identical keys produce identical images); retries and double submits are free
+GENERATION_RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("GENERATION_RESULT_CACHE_MAX_ENTRIES", "32"))
+GENERATION_RESULT_CACHE_TTL_SECONDS = float(os.environ.get("GENERATION_RESULT_CACHE_TTL_SECONDS", "900"))
+generation_result_cache = AsyncTTLCache(GENERATION_RESULT_CACHE_MAX_ENTRIES, GENERATION_RESULT_CACHE_TTL_SECONDS)
+
+
+def _generation_images_digest(image_bytes: bytes, inspiration_images_bytes: Optional[List[bytes]]) -> tuple:
+    """(digest of the (pre-resized) base + inspiration images, base image size) for _generation_cache_key"""
+    images = hashlib.sha256()
+    for data in [image_bytes] + list(inspiration_images_bytes or []):
+        images.update(hashlib.sha256(data).digest())
+    with Image.open(BytesIO(image_bytes)) as img:  # header only
+        return images.hexdigest(), img.size
+
+
+def _generation_cache_key(mode: str, gpu_request: GenerationRequest, images_digest: tuple) -> tuple:
+    """Result-cache key: canonical prompt fingerprint, digests of the images, the output aspect bucket and
+    sampling settings"""
+    digest, (width, height) = images_digest
+    edge = _preview_size(gpu_request) if mode == "preview" else _final_size(gpu_request)
+    return (
+        mode,
+        canonicalize_prompt(gpu_request.prompt)[1],
+        digest,
+        aspect_bucket(width, height, edge),
+        gpu_request.seed,
+        gpu_request.num_inference_steps,
+        gpu_request.guidance_scale,
+        gpu_request.num_images,
+    )
+
+
+def _cache_summary(cache: AsyncTTLCache) -> dict:
+    """Size and hit counters of an AsyncTTLCache for /health"""
+    return {"entries": len(cache._entries), "hits": cache.hits, "misses": cache.misses, "coalesced": cache.coalesced}
 
 @app.cls(
     image=image,
@@ -286,11 +1003,30 @@ class Flux2Model:
             except Exception as e:
                 print(f"Memory optimization setup warning: {e}")
             
+            self._prompt_embeds = OrderedDict()
             print("FLUX.2 Dev 4-bit model loaded successfully!")
         except Exception as e:
             print(f"Error loading FLUX Dev model: {str(e)}")
             raise e
 
+    def _encode_prompt(self, prompt: str):
+        """Embeddings of `prompt` as written, LRU-cached by its canonical fingerprint -> (embeds, fingerprint)"""
+        fingerprint = canonicalize_prompt(prompt)[1]
+        embeds = self._prompt_embeds.get(fingerprint)
+        if embeds is not None:
+            self._prompt_embeds.move_to_end(fingerprint)
+            print(f"[FLUX] Prompt embeddings cache hit ({fingerprint})")
+        else:
+            with torch.inference_mode():
+                embeds, _ = self.pipe.encode_prompt(
+                    prompt=prompt, device=self.pipe._execution_device, num_images_per_prompt=1
+                )
+            embeds = embeds.to("cpu")
+            self._prompt_embeds[fingerprint] = embeds
+            while len(self._prompt_embeds) > FLUX_PROMPT_EMBED_CACHE_SIZE:
+                self._prompt_embeds.popitem(last=False)
+        return embeds.to(self.pipe._execution_device), fingerprint
+
     @modal.method()
     def generate_previews(self, request: GenerationRequest, image_bytes: bytes = None, inspiration_images_bytes: Optional[List[bytes]] = None) -> dict:
         """Generate fast preview images at 512x512 for quick selection"""
@@ -301,12 +1037,12 @@ class Flux2Model:
                 raise ValueError("FLUX 2 requires a base image for image-to-image editing!")
             
             # Preview settings: 512x512 (0.26MP - valid per BFL docs, min 64x64)
-            preview_size = max(256, min(request.width or 512, request.height or 512, 512))
-            preview_steps = min(28, request.num_inference_steps or 20)  # keep steps modest for VRAM
+            preview_size = _preview_size(request)
+            preview_steps = _preview_steps(request)  # keep steps modest for VRAM
             
-            # Load and prepare base image
-            init_image = Image.open(BytesIO(image_bytes)).convert('RGB').resize((preview_size, preview_size))
-            print(f"Loaded base image for preview, resized to: {init_image.size}")
+            # Load and prepare base image - nearest aspect bucket at the preview pixel budget
+            init_image, bucket = _fit_to_bucket(Image.open(BytesIO(image_bytes)).convert('RGB'), preview_size)
+            print(f"Loaded base image for preview, resized to: {init_image.size} (bucket {bucket})")
             
             # Prepare image list for FLUX 2 (supports multi-reference)
             image_list = [init_image]
@@ -317,8 +1053,8 @@ class Flux2Model:
                 for i, insp_bytes in enumerate(inspiration_images_bytes[:6]):  # FLUX 2 dev supports up to 6 reference images
                     try:
                         insp_img = Image.open(BytesIO(insp_bytes)).convert('RGB')
-                        # Resize to match preview size
-                        insp_img = insp_img.resize((preview_size, preview_size))
+                        # Resize to the preview pixel budget in its own aspect bucket
+                        insp_img, _ = _fit_to_bucket(insp_img, preview_size)
                         image_list.append(insp_img)
                         print(f"Loaded inspiration image {i+1}, size: {insp_img.size}")
                     except Exception as e:
@@ -340,23 +1076,28 @@ class Flux2Model:
                     torch.cuda.manual_seed(seed)
             
             # Generate preview images with FLUX 2
-            print(f"Running FLUX 2 Dev preview generation (512x512, {preview_steps} steps) with {len(image_list)} reference image(s)...")
+            print(f"Running FLUX 2 Dev preview generation ({init_image.width}x{init_image.height}, {preview_steps} steps) with {len(image_list)} reference image(s)...")
             
             # Clear CUDA cache before generation to prevent OOM
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
                 torch.cuda.ipc_collect()
             
+            inference_started = time.perf_counter()
+            prompt_embeds, prompt_fingerprint = self._encode_prompt(request.prompt)
             with torch.inference_mode():
                 result = self.pipe(
-                    prompt=request.prompt,
+                    prompt_embeds=prompt_embeds,
                     image=image_list,  # FLUX 2 accepts list of images for multi-reference
+                    width=init_image.width,
+                    height=init_image.height,
                     guidance_scale=request.guidance_scale,
                     num_inference_steps=preview_steps,  # FLUX 2 minimum: 28 steps
                     output_type="pil",
                     generator=torch.Generator(device=self.device).manual_seed(seed),
                     num_images_per_prompt=request.num_images,
                 )
+            inference_ms = round((time.perf_counter() - inference_started) * 1000)
             
             # Clear CUDA cache after generation
             if torch.cuda.is_available():
@@ -379,14 +1120,17 @@ class Flux2Model:
                 "generation_info": {
                     "model": MODEL_NAME,
                     "prompt": request.prompt[:200],  # Truncate for logging
+                    "prompt_fingerprint": prompt_fingerprint,
                     "num_images": request.num_images,
                     "guidance_scale": request.guidance_scale,
                     "num_inference_steps": preview_steps,
-                    "width": preview_size,
-                    "height": preview_size,
+                    "width": init_image.width,
+                    "height": init_image.height,
+                    "aspect_bucket": bucket,
                     "seed": seed,
                     "multi_reference": len(image_list) > 1,
                     "reference_count": len(image_list),
+                    "inference_ms": inference_ms,
                     "mode": "preview"
                 },
                 "cost_estimate": cost_estimate
@@ -410,9 +1154,9 @@ class Flux2Model:
             print(f"[PROMPT] Token count: {prompt_tokens} (FLUX 2 supports up to 32K tokens)")
             
             # Load and prepare base image - keep close to requested size to save VRAM
-            target_size = max(256, min(request.width, request.height, 768))
-            init_image = Image.open(BytesIO(image_bytes)).convert('RGB').resize((target_size, target_size))
-            print(f"Loaded base image, resized to: {init_image.size}")
+            target_size = _final_size(request)
+            init_image, bucket = _fit_to_bucket(Image.open(BytesIO(image_bytes)).convert('RGB'), target_size)
+            print(f"Loaded base image, resized to: {init_image.size} (bucket {bucket})")
             
             # Prepare image list for FLUX 2 (single base only to reduce VRAM; multi-reference disabled)
             image_list = [init_image]
@@ -438,16 +1182,21 @@ class Flux2Model:
                 torch.cuda.empty_cache()
                 torch.cuda.ipc_collect()
             
+            inference_started = time.perf_counter()
+            prompt_embeds, prompt_fingerprint = self._encode_prompt(request.prompt)
             with torch.inference_mode():
                 result = self.pipe(
-                    prompt=request.prompt,
+                    prompt_embeds=prompt_embeds,
                     image=image_list,  # FLUX 2 accepts list of images for multi-reference
+                    width=init_image.width,
+                    height=init_image.height,
                     guidance_scale=request.guidance_scale,
                     num_inference_steps=request.num_inference_steps,
                     output_type="pil",
                     generator=torch.Generator(device=self.device).manual_seed(seed),
                     num_images_per_prompt=request.num_images,
                 )
+            inference_ms = round((time.perf_counter() - inference_started) * 1000)
             
             # Clear CUDA cache after generation
             if torch.cuda.is_available():
@@ -470,14 +1219,17 @@ class Flux2Model:
                 "generation_info": {
                     "model": MODEL_NAME,
                     "prompt": request.prompt[:200],  # Truncate for logging
+                    "prompt_fingerprint": prompt_fingerprint,
                     "num_images": request.num_images,
                     "guidance_scale": request.guidance_scale,
                     "num_inference_steps": request.num_inference_steps,
-                    "width": request.width,
-                    "height": request.height,
+                    "width": init_image.width,
+                    "height": init_image.height,
+                    "aspect_bucket": bucket,
                     "seed": seed,
                     "multi_reference": len(image_list) > 1,
-                    "reference_count": len(image_list)
+                    "reference_count": len(image_list),
+                    "inference_ms": inference_ms
                 },
                 "cost_estimate": cost_estimate
             }
@@ -490,10 +1242,7 @@ class Flux2Model:
     def upscale_image(self, image_bytes: bytes, target_size: int = 1024, seed: int = None, prompt: str = None, inspiration_images_bytes: Optional[List[bytes]] = None) -> dict:
         """Upscale a selected preview image to full resolution - NO inspiration images, only the selected image"""
         try:
-            print(f"Upscaling image to {target_size}x{target_size} with seed {seed}...")
-            
-            # Ensure target_size is multiple of 16 (FLUX 2 requirement)
-            target_size = (target_size // 16) * 16
+            print(f"Upscaling image to ~{target_size}x{target_size} pixels with seed {seed}...")
             
             # Aggressive memory cleanup before upscaling
             if torch.cuda.is_available():
@@ -509,10 +1258,10 @@ class Flux2Model:
             original_size = original_image.size
             print(f"Loaded original image, size: {original_size}")
             
-            # Simple resize using high-quality Lanczos resampling
-            # This preserves the image structure without generation
-            upscaled_image = original_image.resize((target_size, target_size), Image.Resampling.LANCZOS)
-            print(f"Upscaled image using Lanczos resampling to: {upscaled_image.size}")
+            # Simple resize using high-quality Lanczos resampling into the image's aspect bucket at the target
+            # pixel budget (multiples of 16, FLUX 2 requirement) - preserves the structure without generation
+            upscaled_image, bucket = _fit_to_bucket(original_image, target_size, Image.Resampling.LANCZOS)
+            print(f"Upscaled image using Lanczos resampling to: {upscaled_image.size} (bucket {bucket})")
             
             # Set seed for reproducibility (if we do any enhancement)
             if seed is not None:
@@ -527,7 +1276,10 @@ class Flux2Model:
             
             # Optional: Light enhancement pass with very few steps to improve quality
             # Skip image-to-image if original is already close to target size
-            skip_generation = abs(original_size[0] - target_size) < 200
+            skip_generation = abs(original_size[0] - upscaled_image.width) < 200
+            prompt_fingerprint = None
+            inference_ms = 0
+            tiles = []
             
             if skip_generation:
                 print("Original image size close to target, skipping image-to-image enhancement")
@@ -543,17 +1295,37 @@ class Flux2Model:
                     torch.cuda.empty_cache()
                     torch.cuda.synchronize()
                 
-                with torch.inference_mode():
-                    result = self.pipe(
-                        prompt=prompt or "Enhance image quality, preserve all details",
-                        image=upscaled_image,  # Single image - already upscaled
-                        guidance_scale=2.5,  # Very low guidance to minimize changes
-                        num_inference_steps=enhancement_steps,  # Minimal steps
-                        output_type="pil",
-                        generator=torch.Generator(device=self.device).manual_seed(seed),
-                        num_images_per_prompt=1,
-                    )
-                    result_images = result.images
+                inference_started = time.perf_counter()
+                # Neutral prompt: the scene prompt would make the pass (and every tile crop) re-imagine the scene
+                prompt_embeds, prompt_fingerprint = self._encode_prompt(UPSCALE_DEFAULT_PROMPT)
+                # One pass over the whole image unless tiling is enabled and the image is larger than a tile
+                tile_size = UPSCALE_TILE_SIZE or max(upscaled_image.size)
+                tiles = plan_tiles(upscaled_image.width, upscaled_image.height, tile_size, UPSCALE_TILE_OVERLAP)
+                if len(tiles) > 1:
+                    print(f"Tiled enhancement: {len(tiles)} tiles of up to {UPSCALE_TILE_SIZE}px, overlap {UPSCALE_TILE_OVERLAP}px")
+                enhanced_tiles = []
+                for box in tiles:
+                    tile = upscaled_image.crop(box)
+                    tile_dims = {"width": tile.width, "height": tile.height} if len(tiles) > 1 else {}
+                    with torch.inference_mode():
+                        result = self.pipe(
+                            prompt_embeds=prompt_embeds,
+                            image=tile,  # Single image - already upscaled
+                            **tile_dims,
+                            guidance_scale=2.5,  # Very low guidance to minimize changes
+                            num_inference_steps=enhancement_steps,  # Minimal steps
+                            output_type="pil",
+                            generator=torch.Generator(device=self.device).manual_seed(seed),
+                            num_images_per_prompt=1,
+                        )
+                    enhanced_tiles.append((box, np.asarray(result.images[0].convert("RGB"))))
+                    del result
+                if len(enhanced_tiles) == 1:
+                    result_images = [Image.fromarray(enhanced_tiles[0][1])]
+                else:
+                    blended = blend_tiles(upscaled_image.width, upscaled_image.height, enhanced_tiles, UPSCALE_TILE_OVERLAP)
+                    result_images = [Image.fromarray(np.clip(blended + 0.5, 0, 255).astype(np.uint8))]
+                inference_ms = round((time.perf_counter() - inference_started) * 1000)
             
             # Clear CUDA cache after generation
             if torch.cuda.is_available():
@@ -576,16 +1348,23 @@ class Flux2Model:
                 "image": img_b64,
                 "generation_info": {
                     "model": MODEL_NAME,
-                    "prompt": prompt[:200] if prompt else "Enhance image quality",
+                    "prompt": UPSCALE_DEFAULT_PROMPT,
+                    "prompt_fingerprint": prompt_fingerprint,
                     "guidance_scale": 2.5 if not skip_generation else None,
                     "num_inference_steps": 10 if not skip_generation else 0,
-                    "width": target_size,
-                    "height": target_size,
+                    "width": upscaled_image.width,
+                    "height": upscaled_image.height,
+                    "aspect_bucket": bucket,
                     "seed": seed,
                     "multi_reference": False,
                     "reference_count": 1,
+                    "inference_ms": inference_ms,
                     "mode": "upscale",
-                    "method": "resize_lanczos" if skip_generation else "resize_lanczos+light_enhancement"
+                    "method": "resize_lanczos" if skip_generation else
+                              "resize_lanczos+tiled_enhancement" if len(tiles) > 1 else "resize_lanczos+light_enhancement",
+                    "tiles": len(tiles),
+                    "tile_size": UPSCALE_TILE_SIZE if len(tiles) > 1 else None,
+                    "tile_overlap": UPSCALE_TILE_OVERLAP if len(tiles) > 1 else None
                 },
                 "cost_estimate": cost_estimate
             }
@@ -598,158 +1377,1379 @@ class Flux2Model:
                 torch.cuda.synchronize()
             raise e
 
-# HIDDEN: Gemma 3 kept in code but not used - replaced by Gemini 2.5 Flash-Lite
-# The frontend now uses /api/google/analyze-inspiration instead of this Modal endpoint
-# This class remains in code for potential future use but is not called automatically
-# Gemma 3 4B-IT Model - MULTIMODAL MODEL WITH EXCELLENT POLISH SUPPORT
-@app.cls(
-    image=image,
-    gpu="T4",  # Changed from H100 to T4 for cost savings (~$0.59/h vs $4.76/h) - 4B model fits in 16GB
-    volumes=volumes,
-    secrets=[modal.Secret.from_name("huggingface-secret-new")],
-    scaledown_window=120,  # Reduced to 2 minutes to save costs
-    max_containers=1,  # Limit to 1 container - all requests (room analysis, 10 inspirations) in one container
-    min_containers=0  # Allow scaling down when not in use
-)
-@modal.concurrent(max_inputs=10)  # Allow up to 10 parallel requests (10 inspirations) in one container = 1 GPU instead of 10
-class Gemma3VisionModel:
-    """Gemma 3 4B-IT multimodal model for room analysis and comments with excellent Polish support
-    
-    Using H100 (same as FLUX) for:
-    - Single cold start instead of two separate GPUs
-    - Faster initialization (parallel loading with FLUX)
-    - Better resource utilization (80GB VRAM is plenty for both)
+# Palette extraction for analyze_inspiration: dominant colours come from the pixels (k-means in OKLab on a
+# downsampled copy, a few ms on CPU) instead of hex codes guessed by Gemma
+PALETTE_MAX_SIDE = int(os.environ.get("PALETTE_MAX_SIDE", "64"))
+PALETTE_MAX_COLORS = 4
+PALETTE_MIN_COLORS = 2
+PALETTE_MIN_SHARE = 0.05  # clusters below this share of the pixels are noise, not a "main" colour
+PALETTE_KMEANS_ITERATIONS = 10
+
+# Interior-design colour names on top of the CSS/X11 names Pillow ships (ImageColor.colormap)
+DESIGN_COLOR_NAMES = {
+    'cream': '#FFFDD0',
+    'charcoal': '#36454F',
+    'warm beige': '#D4A574',
+    'light oak': '#D4A574',
+    'earth brown': '#8B7355',
+    'sage green': '#9DC183',
+    'burgundy': '#800020',
+    'taupe': '#8B8589',
+    'terracotta': '#E2725B',
+    'mustard': '#E1AD01',
+    'olive green': '#708238',
+    'greige': '#BEB6AA',
+    'walnut': '#5D432C',
+    'off white': '#FAF9F6',
+    'dusty pink': '#DCAE96',
+    'forest green': '#228B22',
+    'slate blue': '#6A5ACD',
+    'rust': '#B7410E',
+    'sand': '#C2B280',
+    'stone gray': '#928E85',
+}
+
+
+def _srgb_to_oklab(rgb):
+    """sRGB in [0, 1], shape (..., 3) -> OKLab"""
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    lms = linear @ np.array([
+        [0.4122214708, 0.2119034982, 0.0883024619],
+        [0.5363325363, 0.6806995451, 0.2817188376],
+        [0.0514459929, 0.1073969566, 0.6299787005],
+    ], dtype=np.float32)
+    return np.cbrt(lms) @ np.array([
+        [0.2104542553, 1.9779984951, 0.0259040371],
+        [0.7936177850, -2.4285922050, 0.7827717662],
+        [-0.0040720468, 0.4505937099, -0.8086757660],
+    ], dtype=np.float32)
+
+
+def _oklab_to_srgb(lab):
+    """OKLab, shape (..., 3) -> sRGB clipped to [0, 1]"""
+    lms = lab @ np.array([
+        [1.0, 1.0, 1.0],
+        [0.3963377774, -0.1055613458, -0.0894841775],
+        [0.2158037573, -0.0638541728, -1.2914855480],
+    ], dtype=np.float32)
+    linear = (lms ** 3) @ np.array([
+        [4.0767416621, -1.2684380046, -0.0041960863],
+        [-3.3077115913, 2.6097574011, -0.7034186147],
+        [0.2309699292, -0.3413193965, 1.7076147010],
+    ], dtype=np.float32)
+    linear = np.clip(linear, 0.0, 1.0)
+    return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1 / 2.4) - 0.055)
+
+
+def _to_hex(rgb) -> str:
+    r, g, b = (int(round(float(channel) * 255)) for channel in rgb)
+    return f"#{r:02X}{g:02X}{b:02X}"
+
+
+def extract_palette(image, max_colors: int = PALETTE_MAX_COLORS) -> List[tuple]:
+    """Dominant colours of `image` as [(hex, share), ...], most common first.
+
+    Vectorized k-means (k-means++ init, fixed seed so results are deterministic) in OKLab, where
+    Euclidean distance tracks perceived colour difference, on a copy downsampled to PALETTE_MAX_SIDE.
     """
-    
-    @modal.enter()
-    def enter(self):
-        """Initialize Gemma 3 4B-IT model"""
-        try:
-            print("Downloading Gemma 3 4B-IT model if necessary...")
-            
-            # Set up secrets
-            import os
-            self.hf_token = os.environ["HF_NEWTOKEN"]
-            
-            self.device = "cuda" if torch.cuda.is_available() else "cpu"
-            print(f"Using device: {self.device}")
-            
-            # Load Gemma 3 4B-IT model (multimodal vision-language model, supports 140+ languages including Polish)
-            from transformers import Gemma3ForConditionalGeneration
-            
-            self.model = Gemma3ForConditionalGeneration.from_pretrained(
-                "google/gemma-3-4b-it",
-                torch_dtype=torch.bfloat16,
-                cache_dir=CACHE_DIR,
-                token=self.hf_token,
-                device_map="auto",
-                low_cpu_mem_usage=True
-            )
-            print("Gemma 3 vision model loaded successfully")
-            
-            # Load processor for image-text tasks
-            self.processor = AutoProcessor.from_pretrained(
-                "google/gemma-3-4b-it",
-                cache_dir=CACHE_DIR,
-                token=self.hf_token
-            )
-            print("Processor loaded successfully")
-            
-            print("Gemma 3 4B-IT model loaded successfully!")
-        except Exception as e:
-            print(f"Error loading Gemma 3 4B-IT model: {str(e)}")
-            raise e
+    small = image.convert("RGB")
+    small.thumbnail((PALETTE_MAX_SIDE, PALETTE_MAX_SIDE))
+    pixels = _srgb_to_oklab(np.asarray(small, dtype=np.float32).reshape(-1, 3) / 255.0)
 
-    @modal.method()
-    def analyze_room_and_comment(self, image_bytes: bytes) -> dict:
-        """Analyze room and generate intelligent comment using Gemma 3 4B-IT"""
-        import time
-        start_time = time.time()
-        
-        try:
-            print(f"Starting room analysis and comment generation... Image size: {len(image_bytes)} bytes")
-            
-            # Load and process image
-            image_start = time.time()
-            image = Image.open(BytesIO(image_bytes))
-            print(f"Image loaded in {time.time() - image_start:.2f}s - mode: {image.mode}, size: {image.size}")
-            
-            # Convert to RGB if needed
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-                print(f"Converted image to RGB mode")
-            
-            # Prepare messages for Gemma 3 multimodal API
-            messages = [
+    rng = np.random.default_rng(0)
+    centers = pixels[[rng.integers(len(pixels))]]
+    while len(centers) < max_colors:
+        distances = ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(-1).min(axis=1)
+        if distances.sum() <= 0:
+            break  # fewer distinct colours than clusters
+        centers = np.vstack([centers, pixels[rng.choice(len(pixels), p=distances / distances.sum())]])
+
+    for _ in range(PALETTE_KMEANS_ITERATIONS):
+        labels = ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(-1).argmin(axis=1)
+        counts = np.bincount(labels, minlength=len(centers))
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, pixels)
+        updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        if np.allclose(updated, centers, atol=1e-4):
+            break
+        centers = updated
+
+    shares = np.bincount(labels, minlength=len(centers)) / len(pixels)
+    order = np.argsort(-shares)
+    keep = [index for rank, index in enumerate(order) if rank < PALETTE_MIN_COLORS or shares[index] >= PALETTE_MIN_SHARE]
+    colors = _oklab_to_srgb(centers[keep])
+    return [(_to_hex(rgb), float(shares[index])) for rgb, index in zip(colors, keep) if shares[index] > 0]
+
+
+@functools.lru_cache(maxsize=1)
+def _named_color_table() -> tuple:
+    """(names, OKLab array) for every named colour, built once per container"""
+    from PIL import ImageColor
+    named = {name: ImageColor.getrgb(value) for name, value in ImageColor.colormap.items()}
+    named.update({name: ImageColor.getrgb(value) for name, value in DESIGN_COLOR_NAMES.items()})
+    names = list(named)
+    rgb = np.array([named[name][:3] for name in names], dtype=np.float32) / 255.0
+    return names, _srgb_to_oklab(rgb)
+
+
+def nearest_color_names(hex_colors: List[str]) -> List[str]:
+    """Closest named colour (OKLab distance) for each hex code, all looked up in one vectorized pass"""
+    if not hex_colors:
+        return []
+    names, table = _named_color_table()
+    rgb = np.array([[int(code[i:i + 2], 16) for i in (1, 3, 5)] for code in hex_colors], dtype=np.float32) / 255.0
+    distances = ((_srgb_to_oklab(rgb)[:, None, :] - table[None, :, :]) ** 2).sum(-1)
+    return [names[index] for index in distances.argmin(axis=1)]
+
+# Fixed vocabularies of the inspiration analysis - shared by the prompt and the decoding grammar
+INSPIRATION_STYLES = [
+    "modern", "scandinavian", "industrial", "bohemian", "minimalist", "rustic", "contemporary", "traditional",
+    "mid-century", "art-deco", "eclectic", "maximalist", "japandi", "coastal", "farmhouse", "mediterranean",
+    "hygge", "zen", "vintage", "transitional", "japanese", "gothic", "tropical",
+]
+INSPIRATION_MATERIALS = ["wood", "metal", "glass", "stone", "fabric", "leather", "concrete", "ceramic", "velvet", "marble", "rug"]
+
+# Gemma 3 analysis prompts and per-task generation settings
+GEMMA_ROOM_TYPE_LABELS = ["kuchnia", "pokój dzienny", "sypialnia", "łazienka", "biuro", "puste pomieszczenie"]
+GEMMA_ROOM_ANALYSIS_PROMPT = f"Przeanalizuj to pomieszczenie i napisz krótki komentarz.\n\nTYP: [{'/'.join(GEMMA_ROOM_TYPE_LABELS)}]\nKOMENTARZ: [maksymalnie 2 krótkie zdania, naturalne, bez ozdóbek]"
+GEMMA_INSPIRATION_ANALYSIS_PROMPT = f"""Analyze this interior photo and extract key design elements for a FLUX 2 prompt.
+
+REQUIREMENTS (STRICT):
+- STYLE: Return 1-3 main styles. Valid set only: {', '.join(INSPIRATION_STYLES)}. Use lowercase.
+- MATERIALS: Return 2-4 main materials. Valid set only: {', '.join(INSPIRATION_MATERIALS)}.
+- BIOPHILIA: Integer 0-3 (0 = no plants, 1 = 1-2 plants, 2 = 3-5 plants, 3 = lush/6+ or green walls).
+- DESCRIPTION: Short English description (max 80 words), specific visual cues (furniture, textures, lighting), no generalities.
+
+OUTPUT FORMAT (one section per line, exactly):
+STYLE: style1, style2, style3
+MATERIALS: material1, material2, material3
+BIOPHILIA: N
+DESCRIPTION: <english description, <= 80 words>
+
+EXAMPLE:
+STYLE: modern, scandinavian
+MATERIALS: wood, fabric, metal
+BIOPHILIA: 2
+DESCRIPTION: Modern Scandinavian living room with light wood furniture, white walls, and natural textiles. Minimalist design with clean lines and warm neutral tones. Soft natural lighting creates a cozy, inviting atmosphere."""
+GEMMA_PROMPTS = {
+    "room": GEMMA_ROOM_ANALYSIS_PROMPT,
+    "inspiration": GEMMA_INSPIRATION_ANALYSIS_PROMPT,
+}
+GEMMA_GENERATION_KWARGS = {
+    "room": {"max_new_tokens": 80, "do_sample": False, "temperature": 0.1, "top_p": 0.4},
+    # More tokens for detailed responses with descriptions (colours come from extract_palette, not the model)
+    "inspiration": {"max_new_tokens": 170, "do_sample": False, "temperature": 0.1, "top_p": 0.8},
+}
+
+# Dynamic batching: concurrent analyze_* inputs (@modal.concurrent) are gathered for a short window
+# and run as one padded generate() instead of one batch-1 generate per input
+GEMMA_BATCH_WINDOW_MS = int(os.environ.get("GEMMA_BATCH_WINDOW_MS", "50"))
+GEMMA_MAX_BATCH_SIZE = int(os.environ.get("GEMMA_MAX_BATCH_SIZE", "10"))
+
+# KV prefix caching: the static instruction text is placed before the image, so its keys/values are
+# computed once per container and each request only prefills the image tokens and the chat suffix
+GEMMA_PREFIX_CACHE_ENABLED = os.environ.get("GEMMA_PREFIX_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+
+
+# Grammar-constrained decoding for analyze_inspiration: STYLE/MATERIALS only from the fixed vocabularies,
+# BIOPHILIA 0-3, and the only token allowed after the DESCRIPTION line is EOS
+GEMMA_CONSTRAINED_DECODING = os.environ.get("GEMMA_CONSTRAINED_DECODING", "1").lower() in ("1", "true", "yes")
+
+
+class TokenGrammar:
+    """Token-level NFA over a tokenizer's vocabulary.
+
+    Literal pieces are tokenized on their own and added as chains of single-token edges. Free-text nodes
+    accept any token that isn't blocked; their regular edges (e.g. newlines) take precedence. The accept
+    node only allows EOS.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        self.edges: List[dict] = []  # node -> {token_id: set of next nodes}
+        self.free_text: dict = {}  # node -> (blocked token ids, next node)
+        self.start = self.node()
+        self.accept = self.node()
+        self._masks: dict = {}
+
+    def node(self) -> int:
+        self.edges.append({})
+        return len(self.edges) - 1
+
+    def _edge(self, src: int, token_id: int, dst: int) -> None:
+        self.edges[src].setdefault(token_id, set()).add(dst)
+
+    def literal(self, src: int, text: str, dst: Optional[int] = None) -> int:
+        """Chain of edges for the tokens of `text`, returns the node after it"""
+        token_ids = self.tokenizer.encode(text, add_special_tokens=False)
+        for index, token_id in enumerate(token_ids):
+            nxt = dst if (dst is not None and index == len(token_ids) - 1) else self.node()
+            self._edge(src, token_id, nxt)
+            src = nxt
+        return src
+
+    def choice(self, src: int, texts: List[str]) -> int:
+        dst = self.node()
+        for text in texts:
+            self.literal(src, text, dst)
+        return dst
+
+    def repeat(self, src: int, add_item, separator: str, terminator: str, min_items: int, max_items: int) -> int:
+        """`item (separator item)*` with min_items..max_items items, then `terminator`"""
+        end = self.node()
+        for count in range(1, max_items + 1):
+            src = add_item(src)
+            if count >= min_items:
+                self.literal(src, terminator, end)
+            if count < max_items:
+                src = self.literal(src, separator)
+        return end
+
+    def text_line(self, src: int, dst: int, blocked: set, min_tokens: int = 1) -> None:
+        """Free text of at least `min_tokens` tokens ended by a newline token, which leads to `dst`"""
+        newline_tokens = [token_id for token_id, token in enumerate(self.vocab) if token and "\n" in token]
+        for _ in range(min_tokens):
+            nxt = self.node()
+            self.free_text[src] = (blocked | set(newline_tokens), nxt)
+            src = nxt
+        self.free_text[src] = (blocked, src)
+        for token_id in newline_tokens:
+            self._edge(src, token_id, dst)
+
+    def advance(self, states: frozenset, token_id: int) -> frozenset:
+        next_states = set()
+        for node in states:
+            if token_id in self.edges[node]:
+                next_states.update(self.edges[node][token_id])
+            elif node in self.free_text and token_id not in self.free_text[node][0]:
+                next_states.add(self.free_text[node][1])
+        return frozenset(next_states)
+
+    def mask(self, states: frozenset, eos_token_ids: List[int], scores):
+        """Additive logits mask for the next token (cached per state set)"""
+        mask = self._masks.get(states)
+        if mask is None:
+            free_nodes = [node for node in states if node in self.free_text]
+            if free_nodes:
+                mask = torch.zeros_like(scores)
+                blocked = set.intersection(*[self.free_text[node][0] - set(self.edges[node]) for node in free_nodes])
+                if blocked:
+                    mask[list(blocked)] = float("-inf")
+            else:
+                allowed = set(eos_token_ids) if self.accept in states else set()
+                for node in states:
+                    allowed.update(self.edges[node])
+                mask = torch.full_like(scores, float("-inf"))
+                mask[list(allowed)] = 0
+            self._masks[states] = mask
+        return mask
+
+
+class GrammarLogitsProcessor:
+    """Logits processor for generate() that masks every token the grammar doesn't allow.
+
+    Each row's NFA state is a function of the prefix passed in: states are memoized per consumed token and
+    recomputed from the longest prefix shared with the previous call, so calls on shorter or diverging prefixes
+    (speculative verification after drafting) see exactly the state generate() would. Rows that left the
+    grammar (finished or padding) are no longer constrained.
+    """
+
+    rewind_safe = True  # see _spec_decoding_safe
+
+    def __init__(self, grammar: TokenGrammar, prompt_len: int, eos_token_ids: List[int]):
+        self.grammar = grammar
+        self.prompt_len = prompt_len
+        self.eos_token_ids = eos_token_ids
+        self._rows: dict = {}  # row -> (generated tokens consumed, NFA states after each of them)
+
+    def __call__(self, input_ids, scores):
+        for row in range(input_ids.shape[0]):
+            tokens, history = self._rows.get(row, ([], [frozenset([self.grammar.start])]))
+            generated = input_ids[row, self.prompt_len:].tolist()
+            # Speculative decoding rewinds rejected draft tokens - resume from the longest shared prefix
+            shared = 0
+            while shared < min(len(tokens), len(generated)) and tokens[shared] == generated[shared]:
+                shared += 1
+            tokens, history = tokens[:shared], history[:shared + 1]
+            for token_id in generated[shared:]:
+                history.append(self.grammar.advance(history[-1], token_id))
+                tokens.append(token_id)
+            self._rows[row] = (tokens, history)
+            states = history[-1]
+            if states:
+                scores[row] = scores[row] + self.grammar.mask(states, self.eos_token_ids, scores[row])
+        return scores
+
+
+def _build_inspiration_grammar(tokenizer, eos_token_ids: List[int]) -> TokenGrammar:
+    """Grammar of the analyze_inspiration OUTPUT FORMAT"""
+    grammar = TokenGrammar(tokenizer)
+    blocked = set(tokenizer.all_special_ids) - set(eos_token_ids)
+
+    node = grammar.literal(grammar.start, "STYLE:")
+    node = grammar.repeat(node, lambda src: grammar.choice(src, [f" {style}" for style in INSPIRATION_STYLES]), ",", "\n", 1, 3)
+    node = grammar.literal(node, "MATERIALS:")
+    node = grammar.repeat(node, lambda src: grammar.choice(src, [f" {material}" for material in INSPIRATION_MATERIALS]), ",", "\n", 2, 4)
+    node = grammar.literal(node, "BIOPHILIA:")
+    node = grammar.literal(grammar.choice(node, [" 0", " 1", " 2", " 3"]), "\n")
+    node = grammar.literal(node, "DESCRIPTION:")
+    grammar.text_line(node, grammar.accept, blocked)
+    return grammar
+
+
+# Room analysis early termination: stop as soon as TYP and a complete 2-sentence KOMENTARZ are out,
+# and (fast path) pick TYP by scoring every label's likelihood instead of generating it
+GEMMA_ROOM_EARLY_STOP = os.environ.get("GEMMA_ROOM_EARLY_STOP", "1").lower() in ("1", "true", "yes")
+GEMMA_ROOM_LABEL_SCORING = os.environ.get("GEMMA_ROOM_LABEL_SCORING", "1").lower() in ("1", "true", "yes")
+_SENTENCE_END_RE = re.compile(r"[.!?…]+(?=\s|$)")
+
+
+def _room_response_complete(text: str) -> bool:
+    """True once `text` has a TYP line and a KOMENTARZ with two finished sentences (or a finished line)"""
+    typ_at = text.find("TYP:")
+    comment_at = text.find("KOMENTARZ:")
+    if typ_at < 0 or comment_at < 0 or "\n" not in text[typ_at:comment_at]:
+        return False
+    comment = text[comment_at + len("KOMENTARZ:"):].lstrip()
+    if not comment:
+        return False
+    return "\n" in comment or len(_SENTENCE_END_RE.findall(comment)) >= 2
+
+
+# Map Polish room types to internal format
+GEMMA_ROOM_TYPE_MAPPING = {
+    "kuchnia": "kitchen",
+    "pokój dzienny": "living_room",
+    "pokoj dzienny": "living_room",
+    "sypialnia": "bedroom",
+    "łazienka": "bathroom",
+    "lazienka": "bathroom",
+    "biuro": "office",
+    "puste pomieszczenie": "empty_room"
+}
+
+
+# Short per-type comments for answers that don't come from Gemma (errors, pre-classifier tier)
+ROOM_FALLBACK_COMMENTS = {
+    "kitchen": "Świetna kuchnia! Dużo miejsca na gotowanie.",
+    "living_room": "Przytulny pokój dzienny. Idealne miejsce na relaks.",
+    "bedroom": "Spokojna sypialnia. Będzie się tu dobrze spało.",
+    "bathroom": "Elegancka łazienka. Ma dobry potencjał.",
+    "office": "Funkcjonalne biuro. Dobre miejsce do pracy.",
+    "empty_room": "Puste pomieszczenie - czysta karta do aranżacji."
+}
+
+
+def _room_confidence(label_confidence: Optional[float]) -> float:
+    """Probability of the scored room label; free-form answers (label scoring off) keep the old fixed 0.9"""
+    return round(label_confidence, 3) if label_confidence is not None else 0.9
+
+
+def parse_room_response(response: str) -> tuple:
+    """(room_type, comment) from a "TYP: ...\nKOMENTARZ: ..." room analysis response"""
+    lines = response.strip().split('\n')
+    room_type = "living_room"  # default
+    comment = "Świetne pomieszczenie! Widzę tutaj ogromny potencjał na stworzenie wspaniałej przestrzeni."
+
+    print(f"Parsing {len(lines)} lines from response")
+    for i, line in enumerate(lines):
+        line = line.strip()
+        print(f"Line {i}: '{line}'")
+        if line.startswith("TYP:"):
+            room_type_raw = line.replace("TYP:", "").strip().lower()
+            print(f"Found room type: {room_type_raw}")
+            room_type = GEMMA_ROOM_TYPE_MAPPING.get(room_type_raw, "living_room")
+            print(f"Mapped room type: {room_type}")
+        elif line.startswith("KOMENTARZ:"):
+            comment = line.replace("KOMENTARZ:", "").strip()
+            print(f"Found comment: {comment}")
+    return room_type, comment
+
+
+class RoomCommentStoppingCriteria:
+    """Stopping criterion for generate(): a row is done once _room_response_complete() holds for
+    `prefix_text` (text forced into the prompt, e.g. the scored TYP line) plus its generated text"""
+
+    def __init__(self, tokenizer, prompt_len: int, prefix_text: str = ""):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.prefix_text = prefix_text
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = [
+            _room_response_complete(self.prefix_text + self.tokenizer.decode(row[self.prompt_len:], skip_special_tokens=True))
+            for row in input_ids
+        ]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+class BatchTextStreamer:
+    """Streamer for generate() that pushes each row's newly decoded text to that row's queue (None = finished).
+
+    Unlike transformers' TextIteratorStreamer it handles padded batches, so streamed requests can still share
+    the batcher's generate() on the model thread. The prompt (generate()'s first put) is skipped and text ending
+    in an incomplete UTF-8 sequence is held back until the next token completes it.
+    """
+
+    def __init__(self, tokenizer, queues: list):
+        self.tokenizer = tokenizer
+        self.queues = queues
+        self._tokens = [[] for _ in queues]
+        self._sent = [0] * len(queues)
+        self._prompt_skipped = False
+
+    def put(self, value):
+        if not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+        for row, token_ids in enumerate(value.reshape(len(self.queues), -1).tolist()):
+            self._tokens[row].extend(token_ids)
+            text = self.tokenizer.decode(self._tokens[row], skip_special_tokens=True)
+            if len(text) > self._sent[row] and not text.endswith("\ufffd"):
+                self.queues[row].put(text[self._sent[row]:])
+                self._sent[row] = len(text)
+
+    def end(self):
+        for stream in self.queues:
+            stream.put(None)
+
+
+class RoomStreamParser:
+    """Incremental parser for a streamed room response: `feed(text)` returns the events the new text completes -
+    ("room_type", internal type) once the TYP line is finished, then ("comment", delta) for the KOMENTARZ line"""
+
+    def __init__(self):
+        self.text = ""
+        self.room_type = None
+        self._comment_sent = 0
+
+    def feed(self, text: str) -> list:
+        self.text += text
+        events = []
+        if self.room_type is None:
+            match = re.search(r"TYP:([^\n]*)\n", self.text)
+            if match:
+                self.room_type = GEMMA_ROOM_TYPE_MAPPING.get(match.group(1).strip().lower(), "living_room")
+                events.append(("room_type", self.room_type))
+        comment_at = self.text.find("KOMENTARZ:")
+        if comment_at >= 0:
+            comment = self.text[comment_at + len("KOMENTARZ:"):].lstrip().split("\n")[0]
+            if len(comment) > self._comment_sent:
+                events.append(("comment", comment[self._comment_sent:]))
+                self._comment_sent = len(comment)
+        return events
+
+
+class DynamicBatcher:
+    """Collects items submitted from concurrent threads and runs them in batches on one worker thread.
+
+    `run_batch(kind, items)` must return one result per item; items of different kinds are never mixed.
+    """
+
+    def __init__(self, run_batch, window_seconds: float, max_batch_size: int, name: str = "BATCH"):
+        self.run_batch = run_batch
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self.name = name
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        self._worker = threading.Thread(target=self._loop, name=f"{name.lower()}-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, kind: str, item):
+        """Queue an item and block until its batch has run"""
+        future = Future()
+        self._queue.put((kind, item, future, time.time()))
+        return future.result()
+
+    def _collect(self) -> list:
+        jobs = [self._queue.get()]
+        deadline = time.monotonic() + self.window_seconds
+        while len(jobs) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return jobs
+
+    def _loop(self) -> None:
+        while True:
+            jobs_by_kind: "OrderedDict[str, list]" = OrderedDict()
+            for job in self._collect():
+                jobs_by_kind.setdefault(job[0], []).append(job)
+
+            for kind, jobs in jobs_by_kind.items():
+                start = time.time()
+                try:
+                    results = list(self.run_batch(kind, [job[1] for job in jobs]))
+                    if len(results) != len(jobs):
+                        raise RuntimeError(f"run_batch returned {len(results)} results for {len(jobs)} items")
+                    for job, result in zip(jobs, results):
+                        job[2].set_result(result)
+                except Exception as exc:
+                    # Fail every caller still waiting, so no future hangs on a short or partial batch
+                    for job in jobs:
+                        if not job[2].done():
+                            job[2].set_exception(exc)
+                batch_time = time.time() - start
+                max_wait = start - min(job[3] for job in jobs)
+                print(f"[{self.name}] kind={kind} batch_size={len(jobs)} batch_time={batch_time:.2f}s "
+                      f"per_item={batch_time / len(jobs):.2f}s max_queue_wait={max_wait:.2f}s")
+
+# Image-embedding cache: projected vision features keyed by the image's content hash, so analyzing the same
+# picture again (room -> inspiration, comment regeneration) skips the SigLIP vision tower entirely
+GEMMA_EMBED_CACHE_ENABLED = os.environ.get("GEMMA_EMBED_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+GEMMA_EMBED_CACHE_VRAM_MB = int(os.environ.get("GEMMA_EMBED_CACHE_VRAM_MB", "256"))
+GEMMA_EMBED_CACHE_RAM_MB = int(os.environ.get("GEMMA_EMBED_CACHE_RAM_MB", "1024"))
+
+
+class ImageEmbeddingCache:
+    """Two-tier LRU cache of image feature tensors.
+
+    Entries live on the model device until the VRAM budget is exceeded; the least recently used ones are
+    then moved to CPU RAM, and dropped once the RAM budget is exceeded too. A hit from RAM is promoted back.
+    """
+
+    def __init__(self, device, vram_bytes: int, ram_bytes: int):
+        self.device = device
+        self.vram_bytes = vram_bytes
+        self.ram_bytes = ram_bytes
+        self._vram: "OrderedDict[str, object]" = OrderedDict()
+        self._ram: "OrderedDict[str, object]" = OrderedDict()
+        self._vram_used = 0
+        self._ram_used = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(tensor) -> int:
+        return tensor.numel() * tensor.element_size()
+
+    def get(self, key: str):
+        with self._lock:
+            if key in self._vram:
+                self._vram.move_to_end(key)
+                self.hits += 1
+                return self._vram[key]
+            if key in self._ram:
+                tensor = self._ram.pop(key)
+                self._ram_used -= self._size(tensor)
+                self.hits += 1
+                return self._store(key, tensor.to(self.device, non_blocking=True))
+            self.misses += 1
+            return None
+
+    def put(self, key: str, tensor) -> None:
+        with self._lock:
+            if key not in self._vram and key not in self._ram:
+                self._store(key, tensor.detach())
+
+    def _store(self, key: str, tensor):
+        self._vram[key] = tensor
+        self._vram_used += self._size(tensor)
+        while self._vram_used > self.vram_bytes and self._vram:
+            old_key, old = self._vram.popitem(last=False)
+            self._vram_used -= self._size(old)
+            self._ram[old_key] = old.to("cpu")
+            self._ram_used += self._size(old)
+        while self._ram_used > self.ram_bytes and self._ram:
+            _, old = self._ram.popitem(last=False)
+            self._ram_used -= self._size(old)
+            self.evictions += 1
+        return tensor
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "vram_entries": len(self._vram),
+                "ram_entries": len(self._ram),
+                "vram_mb": round(self._vram_used / 2**20, 1),
+                "ram_mb": round(self._ram_used / 2**20, 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+# CPU backend: Gemma3VisionModelCPU runs the same code without a GPU (float32 + int8 dynamic quantization),
+# so a room can be classified in low-traffic hours without cold-starting a T4
+GEMMA_CPU_CORES = float(os.environ.get("GEMMA_CPU_CORES", "8"))
+GEMMA_CPU_MEMORY_MB = int(os.environ.get("GEMMA_CPU_MEMORY_MB", "24576"))
+GEMMA_CPU_THREADS = int(os.environ.get("GEMMA_CPU_THREADS", "0"))  # 0 = one per reserved core
+GEMMA_CPU_INT8 = os.environ.get("GEMMA_CPU_INT8", "1").lower() in ("1", "true", "yes")
+GEMMA_CPU_IMAGE_SIZE = int(os.environ.get("GEMMA_CPU_IMAGE_SIZE", "0"))  # 0 = native 896px; 448/672 encode faster
+
+
+def _quantize_dynamic_int8(model):
+    """int8 dynamic quantization of every nn.Linear (weights int8, activations quantized on the fly) - CPU only.
+
+    Done in place: the default deep-copies the fp32 model first, which doesn't fit next to it in the CPU
+    container (GEMMA_CPU_MEMORY_MB). Each fp32 Linear is freed as soon as its int8 replacement exists.
+    """
+    start = time.time()
+    quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    import gc
+    gc.collect()
+    print(f"[GEMMA_CPU] int8 dynamic quantization done in {time.time() - start:.1f}s")
+    return quantized
+
+
+def _reduce_vision_resolution(model, processor, image_size: int) -> int:
+    """Encode images at `image_size` instead of the native SigLIP resolution.
+
+    The vision tower interpolates its position embeddings and the projector pools with a smaller kernel, so an
+    image still becomes mm_tokens_per_image tokens and the prompts don't change - the vision encode is
+    (native / image_size)^2 times cheaper. Returns the size actually used (a multiple of patch * tokens_per_side).
+    """
+    config = model.config
+    patch_size = config.vision_config.patch_size
+    tokens_per_side = int(config.mm_tokens_per_image ** 0.5)
+    step = patch_size * tokens_per_side
+    image_size = max(step, min(image_size, config.vision_config.image_size) // step * step)
+
+    projector = getattr(model, "model", model).multi_modal_projector
+    projector.patches_per_image = image_size // patch_size
+    projector.kernel_size = projector.patches_per_image // tokens_per_side
+    projector.avg_pool = torch.nn.AvgPool2d(kernel_size=projector.kernel_size, stride=projector.kernel_size)
+    processor.image_processor.size = {"height": image_size, "width": image_size}
+    print(f"[GEMMA_CPU] vision resolution {config.vision_config.image_size}px -> {image_size}px")
+    return image_size
+
+
+# Speculative decoding: a small text-only draft model proposes a few tokens that the 4B model verifies in
+# one forward pass. Greedy acceptance makes the output identical to decoding without it. Off unless a model is set.
+GEMMA_DRAFT_MODEL = os.environ.get("GEMMA_DRAFT_MODEL", "")  # e.g. "google/gemma-3-1b-it"
+GEMMA_DRAFT_NUM_TOKENS = int(os.environ.get("GEMMA_DRAFT_NUM_TOKENS", "5"))  # initial draft length, adapted per request
+
+
+def _spec_decoding_safe(logits_processor) -> bool:
+    """speculative_generate() calls processors on drafted prefixes and then on shorter verify prefixes. Only
+    processors whose output depends on nothing but the prefix they are given (`rewind_safe`) may see that;
+    anything else (stateful third-party processors) falls back to plain generate()."""
+    return all(getattr(processor, "rewind_safe", False) for processor in (logits_processor or []))
+
+
+def _prepare_draft_model(draft_model, main_vocab_size: int):
+    """Make a text-only draft usable next to the multimodal model.
+
+    Drafts are text-only: the draft sees the same prompt ids, image placeholders included, but gets no image
+    features, so it predicts from the instructions and the text generated so far. Its vocabulary is grown to
+    the main model's (the extra rows are only ever looked up for image tokens and never predicted in practice)
+    and both logits share a shape for the logits processors. Verification keeps the output identical either
+    way; how often the draft is right is reported as the acceptance rate (speculative_generate `stats`).
+    """
+    if draft_model.get_input_embeddings().num_embeddings != main_vocab_size:
+        draft_model.resize_token_embeddings(main_vocab_size, mean_resizing=False)
+    return draft_model.eval()
+
+
+def speculative_generate(model, draft_model, input_ids, past_key_values=None, max_new_tokens: int = 64,
+                         eos_token_ids: List[int] = (), logits_processor=None, stopping_criteria=None,
+                         streamer=None, num_draft_tokens: int = GEMMA_DRAFT_NUM_TOKENS, stats: dict = None):
+    """Greedy decoding of a single row with draft-and-verify, returns prompt + new ids like generate().
+
+    `past_key_values` may already hold every prompt token but the last (prefix / embedding cache paths) -
+    generate(assistant_model=...) re-feeds the whole prompt on its first step, so it can't start from one.
+    Processors are applied to the verified logits exactly as generate() would, and stopping criteria are
+    checked after every accepted token, so the result matches model.generate(do_sample=False).
+    `streamer` gets the prompt and then every accepted token, like generate() feeds it. The draft length grows by 2 after a fully accepted draft and shrinks by 1 otherwise.
+    Processors must be `rewind_safe` (see _spec_decoding_safe). `stats`, if given, accumulates "drafted" and
+    "accepted" draft-token counts.
+    """
+    if input_ids.shape[0] != 1:
+        raise ValueError("speculative_generate only supports single-row batches")
+    device = input_ids.device
+    if past_key_values is None:
+        past_key_values = model(input_ids=input_ids[:, :-1], use_cache=True).past_key_values
+    draft_cache = draft_model(input_ids=input_ids[:, :-1], use_cache=True).past_key_values
+    prompt_len = input_ids.shape[-1]
+    ids = input_ids
+    eos = set(eos_token_ids)
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    def process(prefix, logits):
+        return logits_processor(prefix, logits) if logits_processor else logits
+
+    while ids.shape[-1] - prompt_len < max_new_tokens:
+        remaining = max_new_tokens - (ids.shape[-1] - prompt_len)
+        draft_len = max(1, min(num_draft_tokens, remaining - 1))
+
+        # Draft: feed what the draft cache is missing, then extend greedily
+        candidates = ids
+        feed = ids[:, draft_cache.get_seq_length():]
+        for _ in range(draft_len):
+            logits = draft_model(input_ids=feed, past_key_values=draft_cache, use_cache=True).logits[:, -1, :].float()
+            feed = process(candidates, logits).argmax(dim=-1, keepdim=True)
+            candidates = torch.cat([candidates, feed], dim=-1)
+            if feed.item() in eos:
+                break
+        drafted = candidates.shape[-1] - ids.shape[-1]
+
+        # Verify: one forward over the last accepted token plus the drafted ones
+        logits = model(
+            input_ids=candidates[:, ids.shape[-1] - 1:],
+            attention_mask=torch.ones_like(candidates),
+            past_key_values=past_key_values,
+            use_cache=True,
+        ).logits[0].float()
+        accepted = []
+        for i in range(drafted + 1):
+            token = process(candidates[:, :ids.shape[-1] + i], logits[i:i + 1]).argmax(dim=-1).item()
+            accepted.append(token)
+            if i == drafted or token != candidates[0, ids.shape[-1] + i].item():
+                break
+        num_draft_tokens = num_draft_tokens + 2 if len(accepted) > drafted else max(1, num_draft_tokens - 1)
+        if stats is not None:
+            stats["drafted"] = stats.get("drafted", 0) + drafted
+            stats["accepted"] = stats.get("accepted", 0) + len(accepted) - 1  # the last one is the model's own token
+
+        done = False
+        for token in accepted:
+            ids = torch.cat([ids, torch.tensor([[token]], device=device)], dim=-1)
+            if streamer is not None:
+                streamer.put(ids[:, -1].cpu())
+            if (token in eos or ids.shape[-1] - prompt_len >= max_new_tokens
+                    or (stopping_criteria and stopping_criteria(ids, None).any())):
+                done = True
+                break
+        if done:
+            break
+        # Both caches end up holding everything but the newest token (rejected draft tokens are dropped)
+        for cache in (past_key_values, draft_cache):
+            excess = cache.get_seq_length() - (ids.shape[-1] - 1)
+            if excess > 0:
+                cache.crop(-excess)
+    if streamer is not None:
+        streamer.end()
+    return ids
+
+
+def benchmark_speculative(model, draft_model, prompts: list, max_new_tokens: int = 64, **generate_kwargs) -> dict:
+    """Greedy generate() of each prompt (a 1-row input_ids tensor) against speculative_generate() with `draft_model`.
+    Reports whether the outputs are identical and the wall-clock speed-up."""
+    baseline_s = assisted_s = 0.0
+    identical = True
+    stats = {}
+    kwargs = dict(generate_kwargs, max_new_tokens=max_new_tokens, do_sample=False)
+    eos_token_id = model.generation_config.eos_token_id
+    eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id] if eos_token_id is not None else []
+    with torch.no_grad():
+        for input_ids in prompts:
+            start = time.perf_counter()
+            plain = model.generate(input_ids, **kwargs)
+            baseline_s += time.perf_counter() - start
+
+            start = time.perf_counter()
+            assisted = speculative_generate(model, draft_model, input_ids, max_new_tokens=max_new_tokens,
+                                            eos_token_ids=eos_token_ids, logits_processor=kwargs.get("logits_processor"),
+                                            stats=stats)
+            assisted_s += time.perf_counter() - start
+            identical = identical and torch.equal(plain, assisted)
+    return {
+        "prompts": len(prompts),
+        "identical": identical,
+        "baseline_s": round(baseline_s, 3),
+        "assisted_s": round(assisted_s, 3),
+        "speedup": round(baseline_s / assisted_s, 2) if assisted_s else None,
+        "acceptance_rate": round(stats["accepted"] / stats["drafted"], 3) if stats.get("drafted") else None,
+    }
+
+
+# HIDDEN: Gemma 3 kept in code but not used - replaced by Gemini 2.5 Flash-Lite
+# The frontend now uses /api/google/analyze-inspiration instead of this Modal endpoint
+# This class remains in code for potential future use but is not called automatically
+# Gemma 3 4B-IT Model - MULTIMODAL MODEL WITH EXCELLENT POLISH SUPPORT
+class Gemma3VisionBackend:
+    """Gemma 3 4B-IT multimodal model for room analysis and comments with excellent Polish support
+
+    Shared by the GPU (Gemma3VisionModel) and CPU (Gemma3VisionModelCPU) Modal classes; `backend` picks the device.
+    """
+
+    backend = "cuda"
+    
+    @modal.enter()
+    def enter(self):
+        """Initialize Gemma 3 4B-IT model"""
+        try:
+            print("Downloading Gemma 3 4B-IT model if necessary...")
+            
+            # Set up secrets
+            import os
+            self.hf_token = os.environ["HF_NEWTOKEN"]
+            
+            self.device = "cuda" if torch.cuda.is_available() and self.backend == "cuda" else "cpu"
+            print(f"Using device: {self.device}")
+            if self.device == "cpu":
+                torch.set_num_threads(GEMMA_CPU_THREADS or max(1, int(GEMMA_CPU_CORES)))
+                print(f"[GEMMA_CPU] torch threads: {torch.get_num_threads()}")
+            
+            # Load Gemma 3 4B-IT model (multimodal vision-language model, supports 140+ languages including Polish)
+            from transformers import Gemma3ForConditionalGeneration
+            
+            self.model = Gemma3ForConditionalGeneration.from_pretrained(
+                "google/gemma-3-4b-it",
+                # bf16 matmuls are slow on most CPUs and dynamic quantization needs float32 Linear layers
+                torch_dtype=torch.bfloat16 if self.device == "cuda" else torch.float32,
+                cache_dir=CACHE_DIR,
+                token=self.hf_token,
+                device_map="auto" if self.device == "cuda" else None,
+                low_cpu_mem_usage=True
+            )
+            print("Gemma 3 vision model loaded successfully")
+            
+            # Load processor for image-text tasks
+            self.processor = AutoProcessor.from_pretrained(
+                "google/gemma-3-4b-it",
+                cache_dir=CACHE_DIR,
+                token=self.hf_token
+            )
+            print("Processor loaded successfully")
+            
+            # Decoder-only batching needs left padding so every row ends at the generation prompt
+            self.processor.tokenizer.padding_side = "left"
+            self.draft_model = None
+            self._draft_stats = {"drafted": 0, "accepted": 0}
+            if GEMMA_DRAFT_MODEL:
+                draft_model = AutoModelForCausalLM.from_pretrained(
+                    GEMMA_DRAFT_MODEL,
+                    torch_dtype=self.model.dtype,
+                    cache_dir=CACHE_DIR,
+                    token=self.hf_token,
+                    low_cpu_mem_usage=True
+                ).to(self.model.device)
+                self.draft_model = _prepare_draft_model(draft_model, self.model.config.text_config.vocab_size)
+                print(f"Draft model {GEMMA_DRAFT_MODEL} loaded for speculative decoding")
+            self._configure_cpu_backend()
+            self._prefix_caches = {}
+            self._batcher = DynamicBatcher(
+                self._generate_batch,
+                window_seconds=GEMMA_BATCH_WINDOW_MS / 1000,
+                max_batch_size=GEMMA_MAX_BATCH_SIZE,
+                name="GEMMA_BATCH",
+            )
+            eos_token_id = self.model.generation_config.eos_token_id
+            self._eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+            self._inspiration_grammar = _build_inspiration_grammar(self.processor.tokenizer, self._eos_token_ids)
+            self._image_embeds = ImageEmbeddingCache(
+                self.model.device,
+                vram_bytes=GEMMA_EMBED_CACHE_VRAM_MB * 2**20,
+                ram_bytes=GEMMA_EMBED_CACHE_RAM_MB * 2**20,
+            )
+            
+            print("Gemma 3 4B-IT model loaded successfully!")
+        except Exception as e:
+            print(f"Error loading Gemma 3 4B-IT model: {str(e)}")
+            raise e
+
+    def _configure_cpu_backend(self) -> None:
+        """CPU-only setup: optional reduced vision resolution and int8 dynamic quantization"""
+        self._vision_image_size = None
+        if self.device != "cpu":
+            return
+        if GEMMA_CPU_IMAGE_SIZE and GEMMA_CPU_IMAGE_SIZE < self.model.config.vision_config.image_size:
+            self._vision_image_size = _reduce_vision_resolution(self.model, self.processor, GEMMA_CPU_IMAGE_SIZE)
+        if GEMMA_CPU_INT8:
+            self.model = _quantize_dynamic_int8(self.model)
+            if self.draft_model is not None:
+                self.draft_model = _quantize_dynamic_int8(self.draft_model)
+
+    def _generate_from_cache(self, input_ids, attention_mask, cache, **generate_kwargs):
+        """generate() continuing from a cache that holds all but the last prompt token. Single rows go through
+        speculative_generate() when a draft model is loaded - larger batches already amortize the decode steps"""
+        if (self.draft_model is None or input_ids.shape[0] != 1 or generate_kwargs.get("do_sample")
+                or not _spec_decoding_safe(generate_kwargs.get("logits_processor"))):
+            return self.model.generate(input_ids=input_ids, attention_mask=attention_mask, past_key_values=cache, **generate_kwargs)
+        stats = {}
+        output = speculative_generate(
+            self.model, self.draft_model, input_ids, cache,
+            max_new_tokens=generate_kwargs["max_new_tokens"],
+            eos_token_ids=self._eos_token_ids,
+            logits_processor=generate_kwargs.get("logits_processor"),
+            stopping_criteria=generate_kwargs.get("stopping_criteria"),
+            streamer=generate_kwargs.get("streamer"),
+            stats=stats,
+        )
+        for key in ("drafted", "accepted"):
+            self._draft_stats[key] += stats.get(key, 0)
+        if stats.get("drafted"):
+            print(f"[SPECULATIVE] accepted {stats['accepted']}/{stats['drafted']} draft tokens "
+                  f"(running acceptance {self._draft_stats['accepted'] / self._draft_stats['drafted']:.0%})")
+        return output
+
+    def _build_inputs(self, kind: str, images: list):
+        """Tokenize a batch for the `kind` prompt. The static instructions come before the image,
+        so every request shares the same token prefix (see _prefill_with_prefix_cache)."""
+        messages = [
+            [
                 {
                     "role": "user",
                     "content": [
-                        {"type": "image", "image": image},
-                        {"type": "text", "text": "Przeanalizuj to pomieszczenie i napisz krótki komentarz.\n\nTYP: [kuchnia/pokój dzienny/sypialnia/łazienka/biuro/puste pomieszczenie]\nKOMENTARZ: [maksymalnie 2 krótkie zdania, naturalne, bez ozdóbek]"}
+                        {"type": "text", "text": GEMMA_PROMPTS[kind]},
+                        {"type": "image", "image": image}
                     ]
                 }
             ]
+            for image in images
+        ]
+        
+        # Apply chat template and process inputs
+        return self.processor.apply_chat_template(
+            messages,
+            add_generation_prompt=True,
+            tokenize=True,
+            return_dict=True,
+            return_tensors="pt",
+            padding=True
+        ).to(self.model.device)
+
+    def _prefix_cache(self, kind: str, prefix_ids):
+        """KV cache of the static prompt prefix for `kind`, computed once per container"""
+        entry = self._prefix_caches.get(kind)
+        if entry is None or not torch.equal(entry[0], prefix_ids):
+            start = time.time()
+            out = self.model(input_ids=prefix_ids.unsqueeze(0), use_cache=True)
+            entry = (prefix_ids, out.past_key_values)
+            self._prefix_caches[kind] = entry
+            print(f"[PREFIX_CACHE] kind={kind} computed {prefix_ids.shape[0]}-token prefix in {time.time() - start:.3f}s")
+        return entry[1]
+
+    def _prefill_with_prefix_cache(self, kind: str, inputs):
+        """Prefill everything but the last prompt token on top of a copy of the cached prefix.
+
+        Returns the filled cache for generate(), or None when the batch can't reuse the prefix
+        (padded rows, no image, or a prompt that doesn't start with the cached prefix).
+        """
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs["attention_mask"]
+        batch_size, seq_len = input_ids.shape
+        if not bool(attention_mask.all()):
+            return None
+        image_starts = (input_ids[0] == self.model.config.boi_token_index).nonzero()
+        if len(image_starts) == 0:
+            return None
+
+        prefix_len = int(image_starts[0])
+        prefix_ids = input_ids[0, :prefix_len]
+        if not bool((input_ids[:, :prefix_len] == prefix_ids).all()):
+            return None
+
+        start = time.time()
+        cache = copy.deepcopy(self._prefix_cache(kind, prefix_ids))
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+
+        # token_type_ids must span the cached prefix too - the bidirectional image mask uses absolute positions
+        token_type_ids = inputs.get("token_type_ids")
+        if "inputs_embeds" in inputs:
+            suffix = {"inputs_embeds": inputs["inputs_embeds"][:, prefix_len:seq_len - 1]}
+        else:
+            suffix = {"input_ids": input_ids[:, prefix_len:seq_len - 1], "pixel_values": inputs["pixel_values"]}
+        self.model(
+            **suffix,
+            token_type_ids=token_type_ids[:, :seq_len - 1] if token_type_ids is not None else None,
+            attention_mask=attention_mask[:, :seq_len - 1],
+            past_key_values=cache,
+            use_cache=True,
+        )
+        print(f"[PREFIX_CACHE] kind={kind} batch={batch_size} prefilled {seq_len - 1 - prefix_len} tokens "
+              f"in {time.time() - start:.3f}s (reused {prefix_len}-token prefix)")
+        return cache
+
+    def _generate_batch(self, kind: str, images: list) -> List[str]:
+        """Run one padded generate() for a batch of images with the `kind` prompt, return decoded responses
+        (for room analyses: (response, label probability or None) pairs).
+
+        "room_stream" items are (image, queue) pairs: room analyses whose text is also pushed to the queue
+        while it is generated (see analyze_room_stream).
+        """
+        streams = None
+        if kind == "room_stream":
+            kind = "room"
+            images, streams = [image for image, _ in images], [stream for _, stream in images]
+        if kind == "room" and GEMMA_ROOM_LABEL_SCORING:
+            return self._generate_room_batch(images, streams)
+
+        inputs = self._build_inputs(kind, images)
+        input_len = inputs["input_ids"].shape[-1]
+        generate_kwargs = dict(
+            GEMMA_GENERATION_KWARGS[kind],
+            pad_token_id=self.processor.tokenizer.pad_token_id or self.processor.tokenizer.eos_token_id,
+        )
+        if kind == "inspiration" and GEMMA_CONSTRAINED_DECODING:
+            generate_kwargs["logits_processor"] = LogitsProcessorList([
+                GrammarLogitsProcessor(self._inspiration_grammar, input_len, self._eos_token_ids)
+            ])
+        if kind == "room" and GEMMA_ROOM_EARLY_STOP:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([
+                RoomCommentStoppingCriteria(self.processor.tokenizer, input_len)
+            ])
+        if streams:
+            generate_kwargs["streamer"] = BatchTextStreamer(self.processor.tokenizer, streams)
+        generation_start = time.time()
+        with torch.no_grad():
+            if GEMMA_EMBED_CACHE_ENABLED or self._vision_image_size:
+                inputs = self._embed_images(inputs, images)
+            cache = self._prefill_with_prefix_cache(kind, inputs) if GEMMA_PREFIX_CACHE_ENABLED else None
+            if cache is None and "inputs_embeds" in inputs:
+                # generate() doesn't take inputs_embeds for Gemma 3 - prefill them here instead
+                cache = self._prefill_embeds(inputs)
+            if cache is not None:
+                # Only the last prompt token is left to process - the image is already in the cache
+                generation = self._generate_from_cache(inputs["input_ids"], inputs["attention_mask"], cache, **generate_kwargs)
+            else:
+                generation = self.model.generate(**inputs, **generate_kwargs)
+        if kind == "room":
+            self._log_room_tokens_saved(generation.shape[-1] - input_len, time.time() - generation_start, 0)
+        
+        # Decode response
+        responses = [self.processor.decode(row[input_len:], skip_special_tokens=True) for row in generation]
+        if kind == "room":
+            return [(response, None) for response in responses]  # free-form TYP line, no label probability
+        return responses
+
+    def _prefill_embeds(self, inputs):
+        """Prefill all but the last prompt token from inputs_embeds into a fresh cache (no prefix reuse)"""
+        attention_mask = inputs["attention_mask"][:, :-1]
+        # Same positions generate() derives from the attention mask, so left-padded rows stay aligned
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+        token_type_ids = inputs.get("token_type_ids")
+        out = self.model(
+            inputs_embeds=inputs["inputs_embeds"][:, :-1],
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            token_type_ids=token_type_ids[:, :-1] if token_type_ids is not None else None,
+            use_cache=True,
+        )
+        return out.past_key_values
+
+    def _image_features(self, pixel_values):
+        """Projected vision features, shape (images, mm_tokens_per_image, hidden)"""
+        if self._vision_image_size:
+            # Reduced resolution: the vision tower has to interpolate its position embeddings
+            base = getattr(self.model, "model", self.model)
+            vision = base.vision_tower(pixel_values=pixel_values, interpolate_pos_encoding=True)
+            return base.multi_modal_projector(vision.last_hidden_state)
+        features = self.model.get_image_features(pixel_values)
+        # transformers 5 returns a model output with the projected features in pooler_output, 4.x the tensor
+        return getattr(features, "pooler_output", features)
+
+    def _embed_images(self, inputs, images: list):
+        """Swap pixel_values for inputs_embeds, taking each image's vision features from the embedding cache
+        when its content hash was seen before; all misses go through the vision tower in one pass"""
+        keys = [image.info.get("content_hash") if GEMMA_EMBED_CACHE_ENABLED else None for image in images]
+        features = [self._image_embeds.get(key) if key else None for key in keys]
+        missing = [index for index, feature in enumerate(features) if feature is None]
+        start = time.time()
+        if missing:
+            for index, feature in zip(missing, self._image_features(inputs["pixel_values"][missing])):
+                features[index] = feature
+                if keys[index]:
+                    self._image_embeds.put(keys[index], feature)
+        print(f"[EMBED_CACHE] {len(images) - len(missing)}/{len(images)} cached, encoded {len(missing)} "
+              f"in {time.time() - start:.3f}s {self._image_embeds.stats()}")
+
+        input_ids = inputs["input_ids"]
+        embedding = self.model.get_input_embeddings()
+        image_mask = input_ids == self.model.config.image_token_index
+        # The image placeholder id may be outside the text vocabulary - its embedding is overwritten anyway
+        text_ids = input_ids.masked_fill(image_mask, 0) if self.model.config.image_token_index >= embedding.num_embeddings else input_ids
+        embeds = embedding(text_ids)
+        image_features = torch.stack(features).to(embeds.device, embeds.dtype)
+        embeds = embeds.masked_scatter(image_mask.unsqueeze(-1).expand_as(embeds), image_features)
+
+        embedded = {key: value for key, value in inputs.items() if key != "pixel_values"}
+        embedded["inputs_embeds"] = embeds
+        return embedded
+
+    def _append_tokens(self, inputs, token_ids):
+        """Append the same text tokens to every row of `inputs` (forcing the start of the answer)"""
+        batch_size = inputs["input_ids"].shape[0]
+        extra = token_ids.to(inputs["input_ids"].device).unsqueeze(0).expand(batch_size, -1)
+        extended = {
+            "input_ids": torch.cat([inputs["input_ids"], extra], dim=1),
+            "attention_mask": torch.cat([inputs["attention_mask"], torch.ones_like(extra)], dim=1),
+        }
+        if inputs.get("token_type_ids") is not None:
+            extended["token_type_ids"] = torch.cat([inputs["token_type_ids"], torch.zeros_like(extra)], dim=1)
+        if inputs.get("pixel_values") is not None:
+            extended["pixel_values"] = inputs["pixel_values"]
+        return extended
+
+    def _prefill_context(self, kind: str, inputs):
+        """KV cache of the whole prompt plus the logits for the next token"""
+        cache = self._prefill_with_prefix_cache(kind, inputs) if GEMMA_PREFIX_CACHE_ENABLED else None
+        if cache is None:
+            # The model takes input_ids or inputs_embeds, never both
+            forward_inputs = {key: value for key, value in inputs.items() if not (key == "input_ids" and "inputs_embeds" in inputs)}
+            out = self.model(**forward_inputs, use_cache=True)
+        else:
+            out = self.model(
+                input_ids=inputs["input_ids"][:, -1:],
+                attention_mask=inputs["attention_mask"],
+                past_key_values=cache,
+                use_cache=True,
+            )
+        return out.past_key_values, out.logits[:, -1].float()
+
+    def _score_room_labels(self, cache, attention_mask, next_logits) -> tuple:
+        """Log-likelihood of every GEMMA_ROOM_TYPE_LABELS continuation (label + newline) after the "TYP:" context.
+        All rows x labels are scored in one forward pass on a copy of the context cache."""
+        tokenizer = self.processor.tokenizer
+        label_tokens = [tokenizer.encode(f" {label}\n", add_special_tokens=False) for label in GEMMA_ROOM_TYPE_LABELS]
+        num_rows, num_labels = next_logits.shape[0], len(label_tokens)
+        width = max(len(tokens) for tokens in label_tokens)
+
+        label_ids = torch.zeros((num_labels, width), dtype=torch.long, device=next_logits.device)
+        label_mask = torch.zeros_like(label_ids)
+        for index, tokens in enumerate(label_tokens):
+            label_ids[index, :len(tokens)] = torch.tensor(tokens)
+            label_mask[index, :len(tokens)] = 1
+        label_ids, label_mask = label_ids.repeat(num_rows, 1), label_mask.repeat(num_rows, 1)
+
+        label_cache = copy.deepcopy(cache)
+        label_cache.batch_repeat_interleave(num_labels)
+        out = self.model(
+            input_ids=label_ids,
+            attention_mask=torch.cat([attention_mask.repeat_interleave(num_labels, dim=0), label_mask], dim=1),
+            past_key_values=label_cache,
+            use_cache=True,
+        )
+        # Position i predicts label token i: the first one comes from the context's next-token logits
+        logits = torch.cat([next_logits.repeat_interleave(num_labels, dim=0).unsqueeze(1), out.logits[:, :-1].float()], dim=1)
+        token_logprobs = torch.log_softmax(logits, dim=-1).gather(-1, label_ids.unsqueeze(-1)).squeeze(-1)
+        scores = (token_logprobs * label_mask).sum(dim=-1).view(num_rows, num_labels)
+        return label_tokens, scores
+
+    def _generate_room_batch(self, images: list, streams: Optional[list] = None) -> List[str]:
+        """Room analysis fast path: "TYP:" is forced, the label is picked by likelihood and only the
+        KOMENTARZ is generated. Returns (response, label probability) pairs, responses in the same
+        "TYP: ...\nKOMENTARZ: ..." format.
+        With `streams` (one queue per image) the scored TYP line is pushed before any comment is generated."""
+        tokenizer = self.processor.tokenizer
+        inputs = self._build_inputs("room", images)
+        typ_ids = torch.tensor(tokenizer.encode("TYP:", add_special_tokens=False))
+        comment_ids = tokenizer.encode("KOMENTARZ:", add_special_tokens=False)
+        context = self._append_tokens(inputs, typ_ids)
+        generate_kwargs = dict(
+            GEMMA_GENERATION_KWARGS["room"],
+            pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+        )
+
+        responses: List[Optional[str]] = [None] * len(images)
+        with torch.no_grad():
+            scoring_start = time.time()
+            if GEMMA_EMBED_CACHE_ENABLED or self._vision_image_size:
+                context = self._embed_images(context, images)
+            cache, next_logits = self._prefill_context("room", context)
+            label_tokens, scores = self._score_room_labels(cache, context["attention_mask"], next_logits)
+            confidences, best = torch.softmax(scores, dim=-1).max(dim=-1)
+            confidences, best = confidences.tolist(), best.tolist()
+            scoring_time = time.time() - scoring_start
+            for row, label_index in enumerate(best if streams else []):
+                streams[row].put(f"TYP: {GEMMA_ROOM_TYPE_LABELS[label_index]}\nKOMENTARZ:")
+
+            # Rows with the same label have the same forced text, so each group is one unpadded generate()
+            groups = sorted(set(best))
+            for label_index in groups:
+                rows = [row for row, choice in enumerate(best) if choice == label_index]
+                forced = torch.tensor(label_tokens[label_index] + comment_ids)
+                selected = {key: value[rows] for key, value in context.items() if key not in ("pixel_values", "inputs_embeds")}
+                group_inputs = self._append_tokens(selected, forced)
+                group_cache = cache if len(groups) == 1 else copy.deepcopy(cache)
+                if len(rows) < len(images):
+                    group_cache.batch_select_indices(torch.tensor(rows, device=next_logits.device))
+
+                input_len = group_inputs["input_ids"].shape[-1]
+                prefix_text = f"TYP: {GEMMA_ROOM_TYPE_LABELS[label_index]}\nKOMENTARZ:"
+                stopping = StoppingCriteriaList([RoomCommentStoppingCriteria(tokenizer, input_len, prefix_text)]) if GEMMA_ROOM_EARLY_STOP else None
+                generation_start = time.time()
+                streamer = BatchTextStreamer(tokenizer, [streams[row] for row in rows]) if streams else None
+                generation = self._generate_from_cache(
+                    group_inputs["input_ids"], group_inputs["attention_mask"], group_cache,
+                    stopping_criteria=stopping, streamer=streamer, **generate_kwargs
+                )
+                self._log_room_tokens_saved(generation.shape[-1] - input_len, time.time() - generation_start,
+                                            len(typ_ids) + len(forced), scoring_time)
+                for row, output in zip(rows, generation):
+                    responses[row] = prefix_text + " " + self.processor.decode(output[input_len:], skip_special_tokens=True).strip()
+        return list(zip(responses, confidences))
+
+    def _log_room_tokens_saved(self, generated: int, generation_time: float, forced: int, scoring_time: float = 0.0) -> None:
+        """Log how many decode steps early stopping and label scoring saved against the max_new_tokens budget"""
+        budget = GEMMA_GENERATION_KWARGS["room"]["max_new_tokens"]
+        per_token = generation_time / max(generated, 1)
+        # Forced tokens ("TYP:" + label + "KOMENTARZ:") come out of the same budget, they just cost no decode step
+        saved_time = (budget - generated) * per_token - scoring_time
+        print(f"[ROOM_EARLY_STOP] generated={generated}/{budget} tokens (forced={forced}) in {generation_time:.2f}s "
+              f"+ {scoring_time:.2f}s label scoring, {per_token * 1000:.0f}ms/token, saved ~{saved_time:.2f}s vs full budget")
+
+    @modal.method()
+    def benchmark_prefill(self, image_bytes: bytes, kind: str = "inspiration", repeats: int = 5) -> dict:
+        """Measure prompt prefill time with and without the cached static prefix"""
+        image = Image.open(BytesIO(image_bytes)).convert('RGB')
+        inputs = self._build_inputs(kind, [image])
+
+        def _timed(fn) -> float:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            start = time.time()
+            fn()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            return time.time() - start
+
+        with torch.no_grad():
+            self._prefill_with_prefix_cache(kind, inputs)  # warm-up, builds the prefix cache
+            full = [_timed(lambda: self.model(**inputs, use_cache=True)) for _ in range(repeats)]
+            cached = [_timed(lambda: self._prefill_with_prefix_cache(kind, inputs)) for _ in range(repeats)]
+        return {
+            "kind": kind,
+            "prompt_tokens": int(inputs["input_ids"].shape[-1]),
+            "full_prefill_s": sorted(full)[len(full) // 2],
+            "cached_prefix_prefill_s": sorted(cached)[len(cached) // 2],
+        }
+
+    @modal.method()
+    def benchmark_speculative_decoding(self, image_bytes: bytes, kind: str = "inspiration", repeats: int = 3) -> dict:
+        """Single-image analysis latency with and without the draft model, and whether the outputs match"""
+        if self.draft_model is None:
+            return {"error": "No draft model loaded - set GEMMA_DRAFT_MODEL"}
+        image = Image.open(BytesIO(image_bytes)).convert('RGB')
+        draft_model = self.draft_model
+        timings, outputs = {}, {}
+        draft_stats = dict(self._draft_stats)
+        try:
+            for mode, model in (("baseline", None), ("speculative", draft_model)):
+                self.draft_model = model
+                latencies = []
+                for _ in range(repeats):
+                    start = time.time()
+                    outputs[mode] = self._generate_batch(kind, [image])[0]
+                    latencies.append(time.time() - start)
+                timings[mode] = sorted(latencies)[len(latencies) // 2]
+        finally:
+            self.draft_model = draft_model
+        return {
+            "kind": kind,
+            "identical": outputs["baseline"] == outputs["speculative"],
+            "baseline_s": timings["baseline"],
+            "speculative_s": timings["speculative"],
+            "speedup": timings["baseline"] / timings["speculative"],
+            # Text-only draft (no image features) - this is how often it still guesses the next token right
+            "acceptance_rate": (self._draft_stats["accepted"] - draft_stats["accepted"])
+                               / max(1, self._draft_stats["drafted"] - draft_stats["drafted"]),
+        }
+
+    @modal.method()
+    def analyze_room_and_comment(self, image_bytes: bytes) -> dict:
+        """Analyze room and generate intelligent comment using Gemma 3 4B-IT"""
+        return self._analyze_room(image_bytes)
+
+    @modal.method()
+    def analyze_inspiration(self, image_bytes: bytes) -> dict:
+        """Analyze inspiration image and extract design elements using Gemma 3 4B-IT"""
+        return self._analyze_inspiration(image_bytes)
+
+    @modal.method(is_generator=True)
+    def analyze_batch(self, room_image_bytes: Optional[bytes], inspiration_images_bytes: List[bytes]):
+        """Analyze a room image and inspirations in one call, yielding each result as soon as it is ready.
+
+        All images are submitted at once, so the batcher runs them as a few padded generate() calls.
+        Yields {"kind": "room" | "inspiration", "index": int, "result": dict}.
+        """
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=1 + len(inspiration_images_bytes)) as pool:
+            futures = {}
+            if room_image_bytes is not None:
+                futures[pool.submit(self._analyze_room, room_image_bytes)] = ("room", 0)
+            for index, image_bytes in enumerate(inspiration_images_bytes):
+                futures[pool.submit(self._analyze_inspiration, image_bytes)] = ("inspiration", index)
+
+            for future in as_completed(futures):
+                kind, index = futures[future]
+                print(f"[ANALYZE_BATCH] {kind}[{index}] done after {time.time() - start:.2f}s")
+                yield {"kind": kind, "index": index, "result": future.result()}
+
+    @modal.method(is_generator=True)
+    def analyze_room_stream(self, image_bytes: bytes):
+        """Room analysis that yields as it decodes: {"event": "room_type"} as soon as the TYP line is known,
+        {"event": "comment", "text"} per KOMENTARZ delta, then {"event": "result"} with the analyze_room_and_comment
+        dict. Generation still goes through the batcher, so concurrent streamed requests share a generate()."""
+        start = time.time()
+        image = Image.open(BytesIO(image_bytes)).convert('RGB')
+        image.info["content_hash"] = hashlib.sha256(image_bytes).hexdigest()
+        chunks: "queue.Queue[Optional[str]]" = queue.Queue()
+        parser = RoomStreamParser()
+        first_event_at = None
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(self._batcher.submit, "room_stream", (image, chunks))
+            while True:
+                try:
+                    chunk = chunks.get(timeout=0.1)
+                except queue.Empty:
+                    if future.done():
+                        break  # generation failed before the streamer finished - future.result() raises below
+                    continue
+                if chunk is None:
+                    break
+                for event, value in parser.feed(chunk):
+                    if first_event_at is None:
+                        first_event_at = time.time() - start
+                    if event == "room_type":
+                        yield {"event": "room_type", "detected_room_type": value}
+                    else:
+                        yield {"event": "comment", "text": value}
+            response, label_confidence = future.result()
+
+        room_type, comment = parse_room_response(response)
+        print(f"[ROOM_STREAM] first event after {first_event_at or 0:.2f}s, done after {time.time() - start:.2f}s")
+        yield {
+            "event": "result",
+            "result": {
+                "detected_room_type": room_type,
+                "confidence": _room_confidence(label_confidence),
+                "room_description": f"Analiza pomieszczenia wykonana przez Gemma 3 4B-IT",
+                "suggestions": [],
+                "comment": comment,
+                "human_comment": self._generate_human_comment(room_type, comment),
+            },
+        }
+
+    def _analyze_room(self, image_bytes: bytes) -> dict:
+        """Room type + Polish comment for one image (shared by analyze_room_and_comment and analyze_batch)"""
+        import time
+        start_time = time.time()
+        
+        try:
+            print(f"Starting room analysis and comment generation... Image size: {len(image_bytes)} bytes")
+            
+            # Load and process image
+            image_start = time.time()
+            image = Image.open(BytesIO(image_bytes))
+            print(f"Image loaded in {time.time() - image_start:.2f}s - mode: {image.mode}, size: {image.size}")
             
-            # Apply chat template and process inputs
-            inputs = self.processor.apply_chat_template(
-                messages, 
-                add_generation_prompt=True, 
-                tokenize=True,
-                return_dict=True, 
-                return_tensors="pt"
-            ).to(self.model.device)
+            # Convert to RGB if needed
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+                print(f"Converted image to RGB mode")
+            # The content hash travels with the image so the batcher can reuse its cached vision features
+            image.info["content_hash"] = hashlib.sha256(image_bytes).hexdigest()
             
-            # Generate response with optimized parameters for speed
+            # Generate response - concurrent calls are batched into one generate() by the batcher
             generation_start = time.time()
             print("Starting Gemma 3 4B-IT inference...")
-            
-            input_len = inputs["input_ids"].shape[-1]
-            
-            with torch.no_grad():
-                generation = self.model.generate(
-                    **inputs,
-                    max_new_tokens=80,
-                    do_sample=False,  # Greedy decoding for speed
-                    temperature=0.1,
-                    top_p=0.4
-                )
-                generation = generation[0][input_len:]
-            
-            # Decode response
-            response = self.processor.decode(generation, skip_special_tokens=True)
+            response, label_confidence = self._batcher.submit("room", image)
             
             generation_time = time.time() - generation_start
             print(f"Gemma 3 4B-IT inference completed in {generation_time:.2f}s")
             print(f"Gemma 3 4B-IT response: {response}")
             
-            # Parse response
-            lines = response.strip().split('\n')
-            room_type = "living_room"  # default
-            comment = "Świetne pomieszczenie! Widzę tutaj ogromny potencjał na stworzenie wspaniałej przestrzeni."
-            
-            print(f"Parsing {len(lines)} lines from response")
-            for i, line in enumerate(lines):
-                line = line.strip()
-                print(f"Line {i}: '{line}'")
-                if line.startswith("TYP:"):
-                    room_type_raw = line.replace("TYP:", "").strip().lower()
-                    print(f"Found room type: {room_type_raw}")
-                    # Map Polish room types to internal format
-                    room_mapping = {
-                        "kuchnia": "kitchen",
-                        "pokój dzienny": "living_room",
-                        "pokoj dzienny": "living_room", 
-                        "sypialnia": "bedroom",
-                        "łazienka": "bathroom",
-                        "lazienka": "bathroom",
-                        "biuro": "office",
-                        "puste pomieszczenie": "empty_room"
-                    }
-                    room_type = room_mapping.get(room_type_raw, "living_room")
-                    print(f"Mapped room type: {room_type}")
-                elif line.startswith("KOMENTARZ:"):
-                    comment = line.replace("KOMENTARZ:", "").strip()
-                    print(f"Found comment: {comment}")
+            room_type, comment = parse_room_response(response)
             
             # Generate human Polish comment using Gemma 3's excellent Polish capabilities
             human_comment = self._generate_human_comment(room_type, comment)
@@ -757,7 +2757,7 @@ class Gemma3VisionModel:
             total_time = time.time() - start_time
             result = {
                 "detected_room_type": room_type,
-                "confidence": 0.9,  # Gemma 3 is very reliable
+                "confidence": _room_confidence(label_confidence),
                 "room_description": f"Analiza pomieszczenia wykonana przez Gemma 3 4B-IT",
                 "suggestions": [],
                 "comment": comment,  # Polish comment from Gemma 3
@@ -773,21 +2773,12 @@ class Gemma3VisionModel:
             traceback.print_exc()
             
             # Fallback response - krótkie i naturalne
-            fallback_comments = {
-                "kitchen": "Świetna kuchnia! Dużo miejsca na gotowanie.",
-                "living_room": "Przytulny pokój dzienny. Idealne miejsce na relaks.",
-                "bedroom": "Spokojna sypialnia. Będzie się tu dobrze spało.",
-                "bathroom": "Elegancka łazienka. Ma dobry potencjał.",
-                "office": "Funkcjonalne biuro. Dobre miejsce do pracy.",
-                "empty_room": "Puste pomieszczenie - czysta karta do aranżacji."
-            }
-            
             return {
                 "detected_room_type": "living_room",
                 "confidence": 0.5,
                 "room_description": "Fallback analysis due to model error",
                 "suggestions": [],
-                "comment": fallback_comments.get("living_room", "Świetne pomieszczenie! Ma dobry potencjał."),
+                "comment": ROOM_FALLBACK_COMMENTS.get("living_room", "Świetne pomieszczenie! Ma dobry potencjał."),
                 "human_comment": "O, widzę że dzisiaj będziemy aranżować wspólnie to wnętrze! Mam już kilka pomysłów."
             }
     
@@ -807,47 +2798,8 @@ class Gemma3VisionModel:
             return f"{base} {tail}"
         return base
     
-    def _color_name_to_hex(self, color_name: str) -> Optional[str]:
-        """Convert color name to hex code"""
-        color_map = {
-            # Basic colors
-            'white': '#FFFFFF',
-            'black': '#000000',
-            'gray': '#808080',
-            'grey': '#808080',
-            'red': '#FF0000',
-            'green': '#008000',
-            'blue': '#0000FF',
-            'yellow': '#FFFF00',
-            'orange': '#FFA500',
-            'purple': '#800080',
-            'pink': '#FFC0CB',
-            'brown': '#8B4513',
-            'beige': '#F5F5DC',
-            'cream': '#FFFDD0',
-            'neutral': '#F5F5F5',
-            # Interior design colors
-            'warm neutrals': '#F5F5DC',
-            'cool grays': '#A9A9A9',
-            'earth tones': '#8B7355',
-            'charcoal': '#36454F',
-            'warm beige': '#D4A574',
-            'light oak': '#D4A574',
-            'warm gray': '#8B7355',
-            'sage green': '#9DC183',
-            'navy': '#000080',
-            'burgundy': '#800020',
-            'teal': '#008080',
-            'coral': '#FF7F50',
-            'lavender': '#E6E6FA',
-            'ivory': '#FFFFF0',
-            'taupe': '#8B8589',
-        }
-        return color_map.get(color_name.lower().strip())
-    
-    @modal.method()
-    def analyze_inspiration(self, image_bytes: bytes) -> dict:
-        """Analyze inspiration image and extract design elements using Gemma 3 4B-IT"""
+    def _analyze_inspiration(self, image_bytes: bytes) -> dict:
+        """Design elements of one inspiration image (shared by analyze_inspiration and analyze_batch)"""
         import time
         start_time = time.time()
         
@@ -863,72 +2815,23 @@ class Gemma3VisionModel:
             if image.mode != 'RGB':
                 image = image.convert('RGB')
                 print(f"Converted image to RGB mode")
+            # The content hash travels with the image so the batcher can reuse its cached vision features
+            image.info["content_hash"] = hashlib.sha256(image_bytes).hexdigest()
             
-            # Prepare messages for Gemma 3 multimodal API (English-only, strict format)
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image", "image": image},
-                        {"type": "text", "text": """Analyze this interior photo and extract key design elements for a FLUX 2 prompt.
-
-REQUIREMENTS (STRICT):
-- STYLE: Return 1-3 main styles. Valid set only: modern, scandinavian, industrial, bohemian, minimalist, rustic, contemporary, traditional, mid-century, art-deco, eclectic, maximalist, japandi, coastal, farmhouse, mediterranean, hygge, zen, vintage, transitional, japanese, gothic, tropical. Use lowercase.
-- COLORS: REQUIRED. Return 2-4 main colors as pure hex codes in #RRGGBB. No words, no adjectives. If you cannot find colors, return: #FFFFFF, #F5F5F5, #36454F, #8B7355.
-- MATERIALS: Return 2-4 main materials. Valid set only: wood, metal, glass, stone, fabric, leather, concrete, ceramic, velvet, marble, rug.
-- BIOPHILIA: Integer 0-3 (0 = no plants, 1 = 1-2 plants, 2 = 3-5 plants, 3 = lush/6+ or green walls).
-- DESCRIPTION: Short English description (max 80 words), specific visual cues (furniture, textures, lighting), no generalities.
-
-OUTPUT FORMAT (one section per line, exactly):
-STYLE: style1, style2, style3
-COLORS: #RRGGBB, #RRGGBB, #RRGGBB, #RRGGBB
-MATERIALS: material1, material2, material3
-BIOPHILIA: N
-DESCRIPTION: <english description, <= 80 words>
-
-EXAMPLE:
-STYLE: modern, scandinavian
-COLORS: #FFFFFF, #F5F5DC, #36454F, #8B7355
-MATERIALS: wood, fabric, metal
-BIOPHILIA: 2
-DESCRIPTION: Modern Scandinavian living room with light wood furniture, white walls, and natural textiles. Minimalist design with clean lines and warm neutral tones. Soft natural lighting creates a cozy, inviting atmosphere."""}
-                    ]
-                }
-            ]
-            
-            # Apply chat template and process inputs
-            inputs = self.processor.apply_chat_template(
-                messages, 
-                add_generation_prompt=True, 
-                tokenize=True,
-                return_dict=True, 
-                return_tensors="pt"
-            ).to(self.model.device)
+            # Colours come from the pixels, not from the model
+            palette_start = time.time()
+            palette = extract_palette(image)
+            colors = [hex_color for hex_color, _ in palette]
+            color_names = nearest_color_names(colors)
+            print(f"[PALETTE] {list(zip(colors, color_names))} in {(time.time() - palette_start) * 1000:.1f}ms")
             
-            # Generate response with optimized parameters for speed
-            generation_start = time.time()
+            # Generate response - concurrent calls are batched into one generate() by the batcher
             print("Starting Gemma 3 4B-IT inference for inspiration analysis...")
-            
-            input_len = inputs["input_ids"].shape[-1]
-            
-            with torch.no_grad():
-                generation = self.model.generate(
-                    **inputs,
-                    max_new_tokens=200,  # Increased for more detailed responses with hex colors and descriptions
-                    do_sample=False,  # Greedy decoding for speed
-                    temperature=0.1,
-                    top_p=0.8,
-                    pad_token_id=self.processor.tokenizer.eos_token_id
-                )
-                generation = generation[0][input_len:]
-            
-            # Decode response
-            response = self.processor.decode(generation, skip_special_tokens=True).strip()
+            response = self._batcher.submit("inspiration", image).strip()
             print(f"Gemma 3 response: {response}")
             
             # Parse response
             styles = []
-            colors = []
             materials = []
             biophilia = 1
             description = "Interior design inspiration"
@@ -938,25 +2841,6 @@ DESCRIPTION: Modern Scandinavian living room with light wood furniture, white wa
                 if line.startswith("STYLE:"):
                     styles_raw = line.replace("STYLE:", "").strip()
                     styles = [s.strip() for s in styles_raw.split(',') if s.strip()]
-                elif line.startswith("KOLORY:") or line.startswith("COLORS:"):
-                    colors_raw = line.replace("KOLORY:", "").replace("COLORS:", "").strip()
-                    colors_raw_list = [c.strip() for c in colors_raw.split(',') if c.strip()]
-                    # Convert colors to hex format if needed
-                    colors = []
-                    for color in colors_raw_list:
-                        # If already hex code, use as is
-                        if color.startswith('#'):
-                            colors.append(color)
-                        else:
-                            # Try to convert color name to hex
-                            hex_color = self._color_name_to_hex(color)
-                            if hex_color:
-                                colors.append(hex_color)
-                            # Skip if can't convert (descriptive terms like "bold colors", "vibrant")
-                    
-                    # If no valid hex colors found, use fallback
-                    if not colors:
-                        colors = ["#808080"]  # Default gray
                 elif line.startswith("MATERIAŁY:") or line.startswith("MATERIALS:"):
                     materials_raw = line.replace("MATERIAŁY:", "").replace("MATERIALS:", "").strip()
                     materials = [m.strip() for m in materials_raw.split(',') if m.strip()]
@@ -973,7 +2857,7 @@ DESCRIPTION: Modern Scandinavian living room with light wood furniture, white wa
             if not styles:
                 styles = ["modern"]
             if not colors:
-                colors = ["#808080"]  # Default gray hex code
+                colors, color_names = ["#808080"], ["gray"]  # Default gray hex code
             if not materials:
                 materials = ["wood"]
             
@@ -981,6 +2865,7 @@ DESCRIPTION: Modern Scandinavian living room with light wood furniture, white wa
             result = {
                 "styles": styles,
                 "colors": colors,
+                "color_names": color_names,
                 "materials": materials,
                 "biophilia": biophilia,
                 "description": description
@@ -1003,9 +2888,89 @@ DESCRIPTION: Modern Scandinavian living room with light wood furniture, white wa
                 "description": "Modern interior design inspiration"
             }
 
+@app.cls(
+    image=image,
+    gpu="T4",  # Changed from H100 to T4 for cost savings (~$0.59/h vs $4.76/h) - 4B model fits in 16GB
+    volumes=volumes,
+    secrets=[modal.Secret.from_name("huggingface-secret-new")],
+    scaledown_window=120,  # Reduced to 2 minutes to save costs
+    max_containers=1,  # Limit to 1 container - all requests (room analysis, 10 inspirations) in one container
+    min_containers=0  # Allow scaling down when not in use
+)
+@modal.concurrent(max_inputs=10)  # Allow up to 10 parallel requests (10 inspirations) in one container = 1 GPU instead of 10
+class Gemma3VisionModel(Gemma3VisionBackend):
+    """Gemma 3 4B-IT on a T4 GPU"""
+
+    backend = "cuda"
+
+
+@app.cls(
+    image=image,
+    cpu=GEMMA_CPU_CORES,
+    memory=GEMMA_CPU_MEMORY_MB,
+    volumes=volumes,
+    secrets=[modal.Secret.from_name("huggingface-secret-new")],
+    scaledown_window=300,  # CPU containers are cheap to keep around between sparse requests
+    max_containers=1,
+    min_containers=0
+)
+@modal.concurrent(max_inputs=4)  # Requests still share one batched generate(), CPU throughput is the limit
+class Gemma3VisionModelCPU(Gemma3VisionBackend):
+    """Gemma 3 4B-IT on CPU with int8 dynamic quantization, for low-traffic hours"""
+
+    backend = "cpu"
+
 # Initialize model instances
 flux_model = Flux2Model()
 gemma3_vision_model = Gemma3VisionModel()
+gemma3_vision_model_cpu = Gemma3VisionModelCPU()
+
+# Canonical prompts: prompts that differ only in unicode form, case, whitespace, punctuation or exactly repeated
+# clauses map to one fingerprint, which keys every generation-path cache. Only lossless rewrites are allowed -
+# two prompts that can render differently must never share a cache entry. The canonical text is only a key -
+# FLUX always gets the prompt as written.
+_PROMPT_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def _canonical_json(value):
+    """JSON (structured) prompts: whitespace-normalized strings; key order is handled by sort_keys"""
+    if isinstance(value, dict):
+        return {key: _canonical_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_canonical_json(item) for item in value]
+    if isinstance(value, str):
+        return " ".join(value.split())
+    return value
+
+
+@functools.lru_cache(maxsize=4096)
+def canonicalize_prompt(prompt: str) -> tuple:
+    """(canonical prompt, 16-hex fingerprint).
+
+    Natural-language prompts are NFKC-normalized and lower-cased, whitespace and the punctuation around
+    comma-separated clauses are normalized, and exact repeats of a clause or sentence are dropped; clause order is
+    kept. JSON prompts are re-serialized with sorted keys instead, their values are only whitespace-normalized.
+    """
+    text = unicodedata.normalize("NFKC", prompt).strip()
+    canonical = None
+    if text.startswith("{"):
+        try:
+            canonical = json.dumps(_canonical_json(json.loads(text)), sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        except ValueError:
+            pass
+    if canonical is None:
+        sentences = []
+        for sentence in _PROMPT_SENTENCE_SPLIT_RE.split(text.lower()):
+            items = [" ".join(item.split()).strip(" .!?") for item in re.split(r"[,;]", sentence)]
+            items = [item for item in items if item]
+            if not items:
+                continue
+            sentence = ", ".join(dict.fromkeys(items))
+            if sentence not in sentences:
+                sentences.append(sentence)
+        canonical = ". ".join(sentences)
+    return canonical, hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
 
 def build_prompt(request: GenerationRequest) -> str:
     """Build comprehensive prompt from user preferences"""
@@ -1013,337 +2978,67 @@ def build_prompt(request: GenerationRequest) -> str:
     full_prompt = request.prompt
     return full_prompt
 
-@app.function(
-    image=image,
-    timeout=600,  # 10 minutes timeout
-    secrets=[modal.Secret.from_name("huggingface-secret-new")],
-)
-@modal.fastapi_endpoint(method="OPTIONS", label="aura-flux-api")
-def generate_images_options():
-    """Handle CORS preflight requests"""
-    from fastapi import Response
-    return Response(
-        content="",
-        headers={
-            "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Methods": "POST, OPTIONS",
-            "Access-Control-Allow-Headers": "Content-Type, Authorization",
-            "Access-Control-Max-Age": "3600"
-        }
-    )
+def _decode_inspiration_images(inspiration_images: Optional[List[str]]) -> Optional[List[bytes]]:
+    """Decode up to 6 base64 inspiration images, skipping the ones that fail"""
+    if not inspiration_images:
+        return None
 
-@app.function(
-    image=image,
-    timeout=600,  # 10 minutes timeout
-    secrets=[modal.Secret.from_name("huggingface-secret-new")],
-)
-@modal.fastapi_endpoint(method="POST", label="aura-flux-api")
-def generate_images_endpoint(request: GenerationRequest):
-    """Generate images endpoint with CORS support"""
-    from fastapi import Response
-    import json
-    try:
-        print(f"Received generation request: {request.prompt[:100]}...")
-        
-        if not request.base_image:
-            raise HTTPException(status_code=400, detail="FLUX 2 requires a base_image for image-to-image editing")
-        
-        # Build comprehensive prompt
-        full_prompt = build_prompt(request)
-        
-        # Decode base64 image to bytes
-        image_bytes = decode_base64_image(request.base_image)
-        print(f"Decoded base image: {len(image_bytes)} bytes")
-        
-        # Decode inspiration images if provided (for multi-reference)
-        inspiration_images_bytes = None
-        if request.inspiration_images and len(request.inspiration_images) > 0:
-            inspiration_images_bytes = []
-            for i, insp_b64 in enumerate(request.inspiration_images[:6]):  # Limit to 6 for FLUX.2 [dev]
-                try:
-                    insp_bytes = decode_base64_image(insp_b64)
-                    inspiration_images_bytes.append(insp_bytes)
-                    print(f"Decoded inspiration image {i+1}, size: {len(insp_bytes)} bytes")
-                except Exception as e:
-                    print(f"Failed to decode inspiration image {i+1}: {e}")
-                    # Continue with other images
-            print(f"Decoded {len(inspiration_images_bytes)} inspiration images for multi-reference")
-        
-        # Generate images in image-to-image mode with optional multi-reference
-        result = flux_model.generate_images.remote(
-            GenerationRequest(
-                prompt=full_prompt,
-                base_image=request.base_image,
-                inspiration_images=request.inspiration_images,
-                negative_prompt=request.negative_prompt,
-                num_images=request.num_images,
-                guidance_scale=request.guidance_scale,
-                num_inference_steps=request.num_inference_steps,
-                width=request.width,
-                height=request.height,
-                seed=request.seed,
-            ),
-            image_bytes,  # Pass the decoded bytes
-            inspiration_images_bytes  # Pass inspiration images bytes
-        )
-        
-        response_data = GenerationResponse(
-            images=result["images"],
-            generation_info=result["generation_info"],
-            cost_estimate=result["cost_estimate"]
-        )
-        
-        # Add CORS headers - return Pydantic model directly, Modal will serialize it
-        # We'll use a custom response to add headers
-        response_dict = response_data.model_dump()
-        
-        response = Response(
-            content=json.dumps(response_dict),
-            media_type="application/json",
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, Authorization",
-                "Access-Control-Max-Age": "3600"
-            }
-        )
-        
-        return response
-        
-    except HTTPException as e:
-        print(f"HTTP Error in generate_images_endpoint: {str(e)}")
-        from fastapi import Response
-        import json
-        error_response = Response(
-            content=json.dumps({"detail": str(e.detail)}),
-            media_type="application/json",
-            status_code=e.status_code,
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, Authorization"
-            }
-        )
-        return error_response
-    except Exception as e:
-        print(f"Error in generate_images_endpoint: {str(e)}")
-        from fastapi import Response
-        import json
-        error_response = Response(
-            content=json.dumps({"detail": str(e)}),
-            media_type="application/json",
-            status_code=500,
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, Authorization"
-            }
-        )
-        return error_response
+    inspiration_images_bytes = []
+    for i, insp_b64 in enumerate(inspiration_images[:6]):  # Limit to 6 for FLUX.2 [dev]
+        try:
+            insp_bytes = decode_base64_image(insp_b64)
+            inspiration_images_bytes.append(insp_bytes)
+            print(f"Decoded inspiration image {i+1}, size: {len(insp_bytes)} bytes")
+        except Exception as e:
+            print(f"Failed to decode inspiration image {i+1}: {e}")
+            # Continue with other images
+    print(f"Decoded {len(inspiration_images_bytes)} inspiration images for multi-reference")
+    return inspiration_images_bytes
 
-@app.function(
-    image=image,
-    timeout=600,  # 10 minutes timeout
-    secrets=[modal.Secret.from_name("huggingface-secret-new")],
-)
-@modal.fastapi_endpoint(method="POST", label="aura-flux-api")
-def generate_previews_endpoint(request: GenerationRequest):
-    """Generate preview images endpoint with CORS support"""
-    from fastapi import Response
-    import json
+def _preresize_image_bytes(image_bytes: bytes, size: int) -> bytes:
+    """Fit to the aspect bucket the GPU would use and re-encode as JPEG (CPU work on the web tier)"""
     try:
-        print(f"Received preview generation request: {request.prompt[:100]}...")
-        
-        if not request.base_image:
-            raise HTTPException(status_code=400, detail="FLUX 2 requires a base_image for image-to-image editing")
-        
-        # Build comprehensive prompt
-        full_prompt = build_prompt(request)
-        
-        # Decode base64 image to bytes
-        image_bytes = decode_base64_image(request.base_image)
-        print(f"Decoded base image: {len(image_bytes)} bytes")
-        
-        # Decode inspiration images if provided (for multi-reference)
-        inspiration_images_bytes = None
-        if request.inspiration_images and len(request.inspiration_images) > 0:
-            inspiration_images_bytes = []
-            for i, insp_b64 in enumerate(request.inspiration_images[:6]):  # Limit to 6 for FLUX.2 [dev]
-                try:
-                    insp_bytes = decode_base64_image(insp_b64)
-                    inspiration_images_bytes.append(insp_bytes)
-                    print(f"Decoded inspiration image {i+1}, size: {len(insp_bytes)} bytes")
-                except Exception as e:
-                    print(f"Failed to decode inspiration image {i+1}: {e}")
-                    # Continue with other images
-            print(f"Decoded {len(inspiration_images_bytes)} inspiration images for multi-reference")
-        
-        # Generate preview images in image-to-image mode with optional multi-reference
-        result = flux_model.generate_previews.remote(
-            GenerationRequest(
-                prompt=full_prompt,
-                base_image=request.base_image,
-                inspiration_images=request.inspiration_images,
-                negative_prompt=request.negative_prompt,
-                num_images=request.num_images,
-                guidance_scale=request.guidance_scale,
-                num_inference_steps=request.num_inference_steps,
-                width=request.width,
-                height=request.height,
-                seed=request.seed,
-            ),
-            image_bytes,  # Pass the decoded bytes
-            inspiration_images_bytes  # Pass inspiration images bytes
-        )
-        
-        response_data = GenerationResponse(
-            images=result["images"],
-            generation_info=result["generation_info"],
-            cost_estimate=result["cost_estimate"]
-        )
-        
-        # Add CORS headers
-        response_dict = response_data.model_dump()
-        
-        response = Response(
-            content=json.dumps(response_dict),
-            media_type="application/json",
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, Authorization",
-                "Access-Control-Max-Age": "3600"
-            }
-        )
-        
-        return response
-        
-    except HTTPException as e:
-        print(f"HTTP Error in generate_previews_endpoint: {str(e)}")
-        from fastapi import Response
-        import json
-        error_response = Response(
-            content=json.dumps({"detail": str(e.detail)}),
-            media_type="application/json",
-            status_code=e.status_code,
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, Authorization"
-            }
-        )
-        return error_response
+        img = Image.open(BytesIO(image_bytes))
+        if img.width * img.height <= size * size:
+            # Never upscale here - the GPU resize handles small inputs and the bytes are already small
+            return image_bytes
+        # Same crop/resize the GPU applies, so the GPU-side fit becomes a no-op
+        img, _ = _fit_to_bucket(img.convert('RGB'), size)
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=WEB_PRERESIZE_JPEG_QUALITY, optimize=True)
+        resized = buffer.getvalue()
+        print(f"[PRERESIZE] {len(image_bytes)} -> {len(resized)} bytes at {img.width}x{img.height}")
+        return resized
     except Exception as e:
-        print(f"Error in generate_previews_endpoint: {str(e)}")
-        from fastapi import Response
-        import json
-        error_response = Response(
-            content=json.dumps({"detail": str(e)}),
-            media_type="application/json",
-            status_code=500,
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, Authorization"
-            }
-        )
-        return error_response
+        # Let the GPU container deal with (or reject) the original bytes
+        print(f"[PRERESIZE] Skipped, could not process image: {e}")
+        return image_bytes
 
-@app.function(
-    image=image,
-    timeout=600,  # 10 minutes timeout
-    secrets=[modal.Secret.from_name("huggingface-secret-new")],
-)
-@modal.fastapi_endpoint(method="POST", label="aura-flux-api")
-def upscale_image_endpoint(request: UpscaleRequest):
-    """Upscale image endpoint with CORS support"""
-    from fastapi import Response
-    import json
-    try:
-        print(f"Received upscale request: target_size={request.target_size}, seed={request.seed}...")
-        
-        if not request.image:
-            raise HTTPException(status_code=400, detail="Upscale requires an image")
-        
-        # Decode base64 image to bytes
-        image_bytes = decode_base64_image(request.image)
-        print(f"Decoded preview image: {len(image_bytes)} bytes")
-        
-        # Decode inspiration images if provided (for multi-reference)
-        inspiration_images_bytes = None
-        if request.inspiration_images and len(request.inspiration_images) > 0:
-            inspiration_images_bytes = []
-            for i, insp_b64 in enumerate(request.inspiration_images[:6]):  # Limit to 6 for FLUX.2 [dev]
-                try:
-                    insp_bytes = decode_base64_image(insp_b64)
-                    inspiration_images_bytes.append(insp_bytes)
-                    print(f"Decoded inspiration image {i+1}, size: {len(insp_bytes)} bytes")
-                except Exception as e:
-                    print(f"Failed to decode inspiration image {i+1}: {e}")
-                    # Continue with other images
-            print(f"Decoded {len(inspiration_images_bytes)} inspiration images for multi-reference")
-        
-        # Upscale image
-        result = flux_model.upscale_image.remote(
-            image_bytes,
-            request.target_size,
-            request.seed,
-            request.prompt,
-            inspiration_images_bytes
-        )
-        
-        response_data = UpscaleResponse(
-            image=result["image"],
-            generation_info=result["generation_info"],
-            cost_estimate=result["cost_estimate"]
-        )
-        
-        # Add CORS headers
-        response_dict = response_data.model_dump()
-        
-        response = Response(
-            content=json.dumps(response_dict),
-            media_type="application/json",
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, Authorization",
-                "Access-Control-Max-Age": "3600"
-            }
-        )
-        
-        return response
-        
-    except HTTPException as e:
-        print(f"HTTP Error in upscale_image_endpoint: {str(e)}")
-        from fastapi import Response
-        import json
-        error_response = Response(
-            content=json.dumps({"detail": str(e.detail)}),
-            media_type="application/json",
-            status_code=e.status_code,
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, Authorization"
-            }
-        )
-        return error_response
-    except Exception as e:
-        print(f"Error in upscale_image_endpoint: {str(e)}")
-        from fastapi import Response
-        import json
-        error_response = Response(
-            content=json.dumps({"detail": str(e)}),
-            media_type="application/json",
-            status_code=500,
-            headers={
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Methods": "POST, OPTIONS",
-                "Access-Control-Allow-Headers": "Content-Type, Authorization"
-            }
-        )
-        return error_response
+def _prepare_generation_inputs(request: GenerationRequest, full_prompt: str, mode: str) -> tuple:
+    """Decode request images and build the payload for Flux2Model.generate_previews/generate_images"""
+    image_bytes = decode_base64_image(request.base_image)
+    print(f"Decoded base image: {len(image_bytes)} bytes")
+
+    inspiration_images_bytes = _decode_inspiration_images(request.inspiration_images)
+
+    if WEB_PRERESIZE_ENABLED:
+        size = _preview_size(request) if mode == "preview" else _final_size(request)
+        image_bytes = _preresize_image_bytes(image_bytes, size)
+        if inspiration_images_bytes:
+            inspiration_images_bytes = [_preresize_image_bytes(b, size) for b in inspiration_images_bytes]
+
+    # The GPU methods only read the decoded bytes - don't ship the base64 originals a second time
+    gpu_request = GenerationRequest(
+        prompt=full_prompt,
+        negative_prompt=request.negative_prompt,
+        num_images=request.num_images,
+        guidance_scale=request.guidance_scale,
+        num_inference_steps=request.num_inference_steps,
+        width=request.width,
+        height=request.height,
+        seed=request.seed,
+    )
+    return gpu_request, image_bytes, inspiration_images_bytes
 
 # FastAPI app for additional endpoints
 web_app = FastAPI(title="Aura FLUX API", version="1.0.0")
@@ -1373,36 +3068,353 @@ web_app.add_middleware(
     expose_headers=["*"],
 )
 
+# Async dispatch for the generation routes: GPU calls go through .remote.aio() via flux_scheduler,
+# CPU-bound request work (base64 decode, PIL, JSON) runs in a worker pool instead of on the event loop
+WEB_CPU_WORKERS = int(os.environ.get("WEB_CPU_WORKERS", "4"))
+
+_web_cpu_pool = ThreadPoolExecutor(max_workers=WEB_CPU_WORKERS, thread_name_prefix="web-cpu")
+
+
+async def _run_in_pool(fn, *args, **kwargs):
+    """Run a blocking callable in the web worker pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_web_cpu_pool, functools.partial(fn, *args, **kwargs))
+
+
+async def _json_response(model: BaseModel) -> Response:
+    """Serialize a response model (mostly base64 image data) off the event loop"""
+    content = await _run_in_pool(model.model_dump_json)
+    return Response(content=content, media_type="application/json")
+
+# FLUX load model: GPU seconds per generation cost unit (see _generation_cost), calibrated from the inference_ms
+# the GPU reports, plus the work this web container has queued on the single Flux2Model container
+FLUX_SECONDS_PER_COST_UNIT = float(os.environ.get("FLUX_SECONDS_PER_COST_UNIT", "8"))
+FLUX_OVERHEAD_SECONDS = float(os.environ.get("FLUX_OVERHEAD_SECONDS", "1.5"))
+FLUX_COST_EMA_ALPHA = float(os.environ.get("FLUX_COST_EMA_ALPHA", "0.2"))
+FLUX_PRIORITIES = {"preview": 0, "upscale": 1, "final": 2, "batch": 3}  # request classes, served in this order
+# Admission control: a FLUX request whose estimated wait (backlog of its class and above + its own cost)
+# exceeds FLUX_ADMISSION_MAX_WAIT_SECONDS, or that finds FLUX_ADMISSION_MAX_QUEUE requests already admitted,
+# gets 503 + Retry-After instead of waiting into the 600s function timeout
+FLUX_ADMISSION_MAX_WAIT_SECONDS = float(os.environ.get("FLUX_ADMISSION_MAX_WAIT_SECONDS", "420"))
+FLUX_ADMISSION_MAX_QUEUE = int(os.environ.get("FLUX_ADMISSION_MAX_QUEUE", "32"))
+# Preview quality ladder, best rung first ("<edge>x<steps>"); the best rung that fits the deadline behind the
+# current backlog is used, the last rung when none does
+PREVIEW_QUALITY_LADDER = os.environ.get("PREVIEW_QUALITY_LADDER", "512x28,512x20,448x16,384x12,320x8")
+PREVIEW_DEFAULT_DEADLINE_MS = int(os.environ.get("PREVIEW_DEFAULT_DEADLINE_MS", "25000"))
+
+
+class FluxLoad:
+    """Cost model (overhead + seconds_per_unit * cost units) and the backlog of FLUX calls in flight"""
+
+    def __init__(self, seconds_per_unit: float, overhead_seconds: float, alpha: float):
+        self.seconds_per_unit = seconds_per_unit
+        self.overhead_seconds = overhead_seconds
+        self.alpha = alpha
+        self.samples = 0
+        self._pending: dict = {}  # job id -> [priority, estimated seconds, dispatched to the GPU]
+        self._next_id = 0
+
+    def estimate_seconds(self, units: float) -> float:
+        return self.overhead_seconds + units * self.seconds_per_unit
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def queue_seconds(self, kind: str = None) -> float:
+        """Estimated GPU time of everything admitted (the container runs one call at a time); with `kind`, only
+        the work done before a new request of that class: calls already dispatched, whatever their class, plus
+        queued calls the scheduler serves first"""
+        limit = FLUX_PRIORITIES[kind] if kind else max(FLUX_PRIORITIES.values())
+        return sum(seconds for priority, seconds, dispatched in self._pending.values() if dispatched or priority <= limit)
+
+    @contextlib.contextmanager
+    def reserve(self, units: float, kind: str):
+        """Count a request towards the backlog from admission until its response, so a burst of requests
+        sees the ones admitted just before it. Yields the job id for dispatched()"""
+        self._next_id += 1
+        job = self._next_id
+        self._pending[job] = [FLUX_PRIORITIES[kind], self.estimate_seconds(units), False]
+        try:
+            yield job
+        finally:
+            del self._pending[job]
+
+    def dispatched(self, job: Optional[int]) -> None:
+        """The scheduler handed this job's call to the GPU - it now delays every class"""
+        if job in self._pending:
+            self._pending[job][2] = True
+
+    def observe(self, units: float, seconds: float) -> None:
+        """Fold a measured inference time into seconds_per_unit (EMA)"""
+        if units <= 0:
+            return
+        sample = max(0.0, seconds - self.overhead_seconds) / units
+        self.seconds_per_unit += self.alpha * (sample - self.seconds_per_unit)
+        self.samples += 1
+
+    def summary(self) -> dict:
+        return {
+            "queue_depth": self.depth,
+            "queue_seconds": round(self.queue_seconds(), 1),
+            "seconds_per_cost_unit": round(self.seconds_per_unit, 3),
+            "calibration_samples": self.samples,
+        }
+
+
+flux_load = FluxLoad(FLUX_SECONDS_PER_COST_UNIT, FLUX_OVERHEAD_SECONDS, FLUX_COST_EMA_ALPHA)
+_admission_rejections = {kind: 0 for kind in FLUX_PRIORITIES}
+
+
+def _estimated_wait_seconds(kind: str, units: float) -> float:
+    """Time until a new request of this class would finish: backlog served before it plus its own cost"""
+    return flux_load.queue_seconds(kind) + flux_load.estimate_seconds(units)
+
+
+def _admit_flux_request(kind: str, units: float) -> None:
+    """Raise 503 with Retry-After and the wait estimate when the FLUX backlog is too long to take this request"""
+    eta = _estimated_wait_seconds(kind, units)
+    depth = flux_load.depth
+    if eta <= FLUX_ADMISSION_MAX_WAIT_SECONDS and depth < FLUX_ADMISSION_MAX_QUEUE:
+        return
+
+    # Retry once enough of the backlog has drained for the request to fit under both limits
+    per_request = flux_load.queue_seconds() / max(1, depth)
+    retry_after = max(1, math.ceil(max(eta - FLUX_ADMISSION_MAX_WAIT_SECONDS,
+                                       (depth - FLUX_ADMISSION_MAX_QUEUE + 1) * per_request)))
+    _admission_rejections[kind] += 1
+    print(f"[ADMISSION] Rejecting {kind} request: ~{eta:.0f}s estimated wait, {depth} admitted, retry after {retry_after}s")
+    raise HTTPException(
+        status_code=503,
+        detail={
+            "message": "Image generation is busy right now. Please retry shortly.",
+            "estimated_wait_seconds": round(eta),
+            "retry_after_seconds": retry_after,
+            "queue_depth": depth,
+        },
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+@contextlib.asynccontextmanager
+async def _flux_admission(kind: str, units: float, session_id: Optional[str], cache_key=None):
+    """Admission control, backlog reservation and quota for one FLUX request; yields the backlog job id.
+    Requests the result cache already holds or is computing add no GPU work and skip all three (job None)."""
+    if cache_key is not None and generation_result_cache.has(cache_key):
+        yield None
+        return
+    _admit_flux_request(kind, units)
+    with flux_load.reserve(units, kind) as job:
+        await generation_quota.check(session_id, units)
+        yield job
+
+
+def _admission_summary() -> dict:
+    """Current wait estimates (one standard 512px/28-step image) per class for /health and the frontend"""
+    return {
+        "max_wait_seconds": FLUX_ADMISSION_MAX_WAIT_SECONDS,
+        "max_queue": FLUX_ADMISSION_MAX_QUEUE,
+        "estimated_wait_seconds": {kind: round(_estimated_wait_seconds(kind, 1.0), 1) for kind in FLUX_PRIORITIES},
+        "accepting": flux_load.depth < FLUX_ADMISSION_MAX_QUEUE,
+        "rejections": dict(_admission_rejections),
+    }
+
+
+async def _run_flux(units: float, call):
+    """Await a Flux2Model call and calibrate the cost model from the inference time it reports"""
+    result = await call()
+    inference_ms = result.get("generation_info", {}).get("inference_ms")
+    if inference_ms:
+        flux_load.observe(units, inference_ms / 1000)
+    return result
+
+
+def _preview_rungs(request: GenerationRequest) -> list:
+    """Ladder rungs as (edge, steps), capped by what the request itself asks for"""
+    max_size, max_steps = _preview_size(request), _preview_steps(request)
+    rungs = []
+    for rung in PREVIEW_QUALITY_LADDER.split(","):
+        size, steps = (int(v) for v in rung.strip().lower().split("x"))
+        rung = (min(size, max_size), min(steps, max_steps))
+        if rung not in rungs:
+            rungs.append(rung)
+    return rungs or [(max_size, max_steps)]
+
+
+# FLUX scheduler: the single Flux2Model container runs one call at a time, so the web tier decides the order.
+# Priority classes first, start-time fair queueing by session within a class (a session's next request starts
+# after its previous ones' cost), and any request waiting longer than FLUX_SCHEDULER_MAX_WAIT_SECONDS goes next
+# regardless of class. FLUX_SCHEDULER_SLOTS calls are kept in flight so the GPU never idles between calls.
+FLUX_SCHEDULER_SLOTS = int(os.environ.get("FLUX_SCHEDULER_SLOTS", "2"))
+FLUX_SCHEDULER_MAX_WAIT_SECONDS = float(os.environ.get("FLUX_SCHEDULER_MAX_WAIT_SECONDS", "90"))
+FLUX_BATCH_MIN_IMAGES = int(os.environ.get("FLUX_BATCH_MIN_IMAGES", "4"))  # /generate calls this large run as "batch"
+
+
+class FluxScheduler:
+    """Priority + per-session fair-share admission of calls to Flux2Model, with starvation protection"""
+
+    def __init__(self, slots: int, max_wait_seconds: float):
+        self.slots = slots
+        self.max_wait_seconds = max_wait_seconds
+        self._running = 0
+        self._waiting: list = []
+        self._seq = 0
+        self._virtual_time = {kind: 0.0 for kind in FLUX_PRIORITIES}
+        self._flow_finish: dict = {}  # (kind, session) -> virtual finish of its last queued request
+        self._stats = {kind: {"dispatched": 0, "waits": deque(maxlen=256)} for kind in FLUX_PRIORITIES}
+        self.promotions = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, kind: str, session_id: Optional[str], cost: float):
+        """Wait for this request's turn, hold one of the in-flight slots for the body"""
+        self._seq += 1
+        flow = (kind, session_id or f"anonymous-{self._seq}")
+        start = max(self._virtual_time[kind], self._flow_finish.get(flow, 0.0))
+        self._flow_finish[flow] = start + cost
+        entry = {
+            "kind": kind, "start": start, "seq": self._seq, "enqueued": time.monotonic(),
+            "future": asyncio.get_running_loop().create_future(),
+        }
+        self._waiting.append(entry)
+        self._dispatch()
+        try:
+            await entry["future"]
+        except BaseException:
+            if entry in self._waiting:
+                self._waiting.remove(entry)
+            elif entry["future"].done() and not entry["future"].cancelled():
+                self._release()  # granted just as the caller went away
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        self._running -= 1
+        self._dispatch()
+
+    def _pick(self) -> dict:
+        now = time.monotonic()
+        overdue = [entry for entry in self._waiting if now - entry["enqueued"] >= self.max_wait_seconds]
+        best = min(self._waiting, key=lambda entry: (FLUX_PRIORITIES[entry["kind"]], entry["start"], entry["seq"]))
+        if overdue:
+            oldest = min(overdue, key=lambda entry: entry["seq"])
+            if FLUX_PRIORITIES[oldest["kind"]] > FLUX_PRIORITIES[best["kind"]]:
+                self.promotions += 1
+                print(f"[SCHED] Promoting {oldest['kind']} request after {now - oldest['enqueued']:.1f}s wait")
+            return oldest
+        return best
+
+    def _dispatch(self) -> None:
+        while self._running < self.slots and self._waiting:
+            entry = self._pick()
+            self._waiting.remove(entry)
+            self._running += 1
+            kind = entry["kind"]
+            self._virtual_time[kind] = max(self._virtual_time[kind], entry["start"])
+            wait_s = time.monotonic() - entry["enqueued"]
+            self._stats[kind]["dispatched"] += 1
+            self._stats[kind]["waits"].append(wait_s)
+            if wait_s >= 1:
+                print(f"[SCHED] Dispatching {kind} after {wait_s:.1f}s ({len(self._waiting)} still waiting)")
+            entry["future"].set_result(None)
+        if len(self._flow_finish) > 1024:
+            # Flows that are behind their class clock no longer affect ordering
+            self._flow_finish = {flow: finish for flow, finish in self._flow_finish.items()
+                                 if finish > self._virtual_time[flow[0]]}
+
+    def waiting(self, kind: str = None) -> int:
+        return sum(1 for entry in self._waiting if kind is None or entry["kind"] == kind)
+
+    def summary(self) -> dict:
+        classes = {}
+        for kind, stats in self._stats.items():
+            waits = sorted(stats["waits"])
+            classes[kind] = {
+                "waiting": self.waiting(kind),
+                "dispatched": stats["dispatched"],
+                "wait_ms_avg": round(sum(waits) / len(waits) * 1000) if waits else None,
+                "wait_ms_p95": round(waits[math.ceil(0.95 * len(waits)) - 1] * 1000) if waits else None,
+                "wait_ms_max": round(waits[-1] * 1000) if waits else None,
+            }
+        return {"slots": self.slots, "running": self._running, "promotions": self.promotions, "classes": classes}
+
+
+flux_scheduler = FluxScheduler(FLUX_SCHEDULER_SLOTS, FLUX_SCHEDULER_MAX_WAIT_SECONDS)
+
+
+def _choose_preview_rung(request: GenerationRequest) -> dict:
+    """Best preview rung whose estimated completion (backlog + own cost) fits the request's deadline"""
+    deadline_ms = request.deadline_ms or PREVIEW_DEFAULT_DEADLINE_MS
+    wait_s = flux_load.queue_seconds("preview")
+    rungs = _preview_rungs(request)
+    for index, (size, steps) in enumerate(rungs):
+        estimate_s = wait_s + flux_load.estimate_seconds(_generation_cost(steps, size, size, request.num_images))
+        if deadline_ms <= 0 or estimate_s * 1000 <= deadline_ms:
+            break
+    return {
+        "rung": index,
+        "rungs": len(rungs),
+        "size": size,
+        "steps": steps,
+        "deadline_ms": deadline_ms,
+        "estimated_ms": round(estimate_s * 1000),
+        "queue_depth": flux_load.depth,
+        "queue_wait_ms": round(wait_s * 1000),
+    }
+
+# Single web entry point: every HTTP route (generation, upscale, analysis, health) and CORS preflights are
+# served by this one ASGI app, so a single warm web container handles all traffic instead of one pool per endpoint
+WEB_MAX_CONCURRENT_INPUTS = int(os.environ.get("WEB_MAX_CONCURRENT_INPUTS", "100"))
+WEB_MIN_CONTAINERS = int(os.environ.get("WEB_MIN_CONTAINERS", "0"))
+WEB_SCALEDOWN_WINDOW = int(os.environ.get("WEB_SCALEDOWN_WINDOW", "600"))
+
+_web_container_started_at = time.time()
+_web_requests_served = 0
+
 @app.function(
-    image=image,
+    image=web_image,
     timeout=600,
     secrets=[modal.Secret.from_name("huggingface-secret-new")],
+    volumes=volumes,  # pre-classifier ONNX weights
+    scaledown_window=WEB_SCALEDOWN_WINDOW,
+    min_containers=WEB_MIN_CONTAINERS,
 )
+@modal.concurrent(max_inputs=WEB_MAX_CONCURRENT_INPUTS)
 @modal.asgi_app()
 def fastapi_app():
-    """FastAPI app for additional endpoints"""
+    """FastAPI app serving all HTTP endpoints"""
     return web_app
 
+@web_app.on_event("startup")
+async def preload_prompt_tokenizer():
+    """Load the prompt tokenizer in the background when the web container starts (first refinements wait for it)"""
+    async def _preload():
+        try:
+            await _run_in_pool(_prompt_tokenizer)
+        except RuntimeError:
+            pass  # logged once by _prompt_tokenizer
+
+    web_app.state.prompt_tokenizer_preload = asyncio.get_running_loop().create_task(_preload())
+
+@web_app.on_event("shutdown")
+async def close_http_clients():
+    """Close pooled outbound HTTP clients when the web container shuts down"""
+    await _close_groq_client()
+
+@web_app.middleware("http")
+async def count_web_requests(request, call_next):
+    """Count requests served by this web container (reported in /health for cold-start tracking)"""
+    global _web_requests_served
+    _web_requests_served += 1
+    return await call_next(request)
+
 @web_app.get("/")
 async def root():
     """Root endpoint"""
     return {"message": "Aura FLUX API", "status": "running", "model": "flux-2-dev"}
 
-@app.function(
-    image=image,
-    timeout=60,
-    secrets=[modal.Secret.from_name("huggingface-secret-new")],
-)
-@modal.fastapi_endpoint(method="GET", label="aura-flux-api")
-def health_check():
-    """Health check endpoint"""
-    return {
-        "status": "healthy",
-        "model": "flux-2-dev",
-        "vision_model": "gemma-3-4b-it",
-        "legacy_models": "minicpm-o-2.6 (commented out), florence-2 (hidden but available)"
-    }
-
 @web_app.get("/health")
 async def health_check_web():
     """Health check endpoint for web app"""
@@ -1410,7 +3422,17 @@ async def health_check_web():
         "status": "healthy",
         "model": "flux-2-dev",
         "vision_model": "gemma-3-4b-it",
-        "legacy_models": "minicpm-o-2.6 (commented out), florence-2 (hidden but available)"
+        "legacy_models": "minicpm-o-2.6 (commented out), florence-2 (hidden but available)",
+        "web_container": {
+            "id": os.environ.get("MODAL_TASK_ID", "local"),
+            "uptime_s": round(time.time() - _web_container_started_at, 1),
+            "requests_served": _web_requests_served,
+        },
+        "room_analysis_tiers": _room_tier_summary(),
+        "generation_result_cache": _cache_summary(generation_result_cache),
+        "flux_load": flux_load.summary(),
+        "flux_scheduler": flux_scheduler.summary(),
+        "flux_admission": _admission_summary(),
     }
 
 @web_app.post("/generate-previews", response_model=GenerationResponse)
@@ -1425,48 +3447,43 @@ async def generate_previews(request: GenerationRequest):
         # Build comprehensive prompt
         full_prompt = build_prompt(request)
         
-        # Decode base64 image to bytes
-        image_bytes = decode_base64_image(request.base_image)
-        print(f"Decoded base image: {len(image_bytes)} bytes")
+        # Decode (and optionally pre-resize) base and inspiration images on the web tier
+        gpu_request, image_bytes, inspiration_images_bytes = await _run_in_pool(
+            _prepare_generation_inputs, request, full_prompt, mode="preview"
+        )
+        images_digest = await _run_in_pool(_generation_images_digest, image_bytes, inspiration_images_bytes)
         
-        # Decode inspiration images if provided (for multi-reference)
-        inspiration_images_bytes = None
-        if request.inspiration_images and len(request.inspiration_images) > 0:
-            inspiration_images_bytes = []
-            for i, insp_b64 in enumerate(request.inspiration_images[:6]):  # Limit to 6 for FLUX.2 [dev]
-                try:
-                    insp_bytes = decode_base64_image(insp_b64)
-                    inspiration_images_bytes.append(insp_bytes)
-                    print(f"Decoded inspiration image {i+1}, size: {len(insp_bytes)} bytes")
-                except Exception as e:
-                    print(f"Failed to decode inspiration image {i+1}: {e}")
-                    # Continue with other images
-            print(f"Decoded {len(inspiration_images_bytes)} inspiration images for multi-reference")
+        # Pick steps/resolution for the deadline under the current FLUX backlog; the GPU derives both from the
+        # request. Nothing is awaited from here to the reservation, so a burst sees the requests admitted before it.
+        rung = _choose_preview_rung(request)
+        if rung["rung"]:
+            print(f"[LADDER] Preview rung {rung['rung']}/{rung['rungs'] - 1}: {rung['size']}px, {rung['steps']} steps "
+                  f"(backlog {rung['queue_depth']} calls, ~{rung['queue_wait_ms']}ms)")
+        gpu_request = gpu_request.model_copy(update={"width": rung["size"], "height": rung["size"], "num_inference_steps": rung["steps"]})
+        units = _generation_cost(rung["steps"], rung["size"], rung["size"], request.num_images)
+        cache_key = _generation_cache_key("preview", gpu_request, images_digest)
         
-        # Generate preview images in image-to-image mode with optional multi-reference
-        result = flux_model.generate_previews.remote(
-            GenerationRequest(
-                prompt=full_prompt,
-                base_image=request.base_image,
-                inspiration_images=request.inspiration_images,
-                negative_prompt=request.negative_prompt,
-                num_images=request.num_images,
-                guidance_scale=request.guidance_scale,
-                num_inference_steps=request.num_inference_steps,
-                width=request.width,
-                height=request.height,
-                seed=request.seed,
-            ),
-            image_bytes,  # Pass the decoded bytes
-            inspiration_images_bytes  # Pass inspiration images bytes
-        )
+        async with _flux_admission("preview", units, request.session_id, cache_key) as job:
+            # Generate preview images in image-to-image mode with optional multi-reference
+            async def run():
+                async with flux_scheduler.slot("preview", request.session_id, units):
+                    flux_load.dispatched(job)
+                    return await _run_flux(units, lambda: flux_model.generate_previews.remote.aio(
+                        gpu_request,
+                        image_bytes,  # Pass the decoded bytes
+                        inspiration_images_bytes  # Pass inspiration images bytes
+                    ))
+
+            result = await generation_result_cache.get_or_compute(cache_key, run)
         
-        return GenerationResponse(
+        return await _json_response(GenerationResponse(
             images=result["images"],
-            generation_info=result["generation_info"],
+            generation_info={**result["generation_info"], "quality_rung": rung},
             cost_estimate=result["cost_estimate"]
-        )
+        ))
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in generate_previews: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1479,40 +3496,39 @@ async def upscale_image(request: UpscaleRequest):
         
         if not request.image:
             raise HTTPException(status_code=400, detail="Upscale requires an image")
+        if request.target_size > UPSCALE_MAX_TARGET_SIZE:
+            raise HTTPException(status_code=400, detail=f"target_size must be at most {UPSCALE_MAX_TARGET_SIZE}")
         
-        # Decode base64 image to bytes
-        image_bytes = decode_base64_image(request.image)
-        print(f"Decoded preview image: {len(image_bytes)} bytes")
-        
-        # Decode inspiration images if provided (for multi-reference)
-        inspiration_images_bytes = None
-        if request.inspiration_images and len(request.inspiration_images) > 0:
-            inspiration_images_bytes = []
-            for i, insp_b64 in enumerate(request.inspiration_images[:6]):  # Limit to 6 for FLUX.2 [dev]
-                try:
-                    insp_bytes = decode_base64_image(insp_b64)
-                    inspiration_images_bytes.append(insp_bytes)
-                    print(f"Decoded inspiration image {i+1}, size: {len(insp_bytes)} bytes")
-                except Exception as e:
-                    print(f"Failed to decode inspiration image {i+1}: {e}")
-                    # Continue with other images
-            print(f"Decoded {len(inspiration_images_bytes)} inspiration images for multi-reference")
-        
-        # Upscale image
-        result = flux_model.upscale_image.remote(
-            image_bytes,
-            request.target_size,
-            request.seed,
-            request.prompt,
-            inspiration_images_bytes
-        )
+        # Charge the worst case: light enhancement pass (10 steps) at the target size
+        units = _generation_cost(10, request.target_size, request.target_size)
         
-        return UpscaleResponse(
-            image=result["image"],
-            generation_info=result["generation_info"],
-            cost_estimate=result["cost_estimate"]
-        )
+        async with _flux_admission("upscale", units, request.session_id) as job:
+            # Decode base64 image to bytes
+            image_bytes = await _run_in_pool(decode_base64_image, request.image)
+            print(f"Decoded preview image: {len(image_bytes)} bytes")
+
+            # Decode inspiration images if provided (for multi-reference)
+            inspiration_images_bytes = await _run_in_pool(_decode_inspiration_images, request.inspiration_images)
+
+            # Upscale image
+            async with flux_scheduler.slot("upscale", request.session_id, units):
+                flux_load.dispatched(job)
+                result = await _run_flux(units, lambda: flux_model.upscale_image.remote.aio(
+                    image_bytes,
+                    request.target_size,
+                    request.seed,
+                    request.prompt,
+                    inspiration_images_bytes
+                ))
+
+            return await _json_response(UpscaleResponse(
+                image=result["image"],
+                generation_info=result["generation_info"],
+                cost_estimate=result["cost_estimate"]
+            ))
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in upscale_image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1526,56 +3542,212 @@ async def generate_images(request: GenerationRequest):
         if not request.base_image:
             raise HTTPException(status_code=400, detail="FLUX 2 requires a base_image for image-to-image editing")
         
+        target_size = _final_size(request)
+        units = _generation_cost(request.num_inference_steps, target_size, target_size, request.num_images)
+        kind = "batch" if request.num_images >= FLUX_BATCH_MIN_IMAGES else "final"
+        
         # Build comprehensive prompt
         full_prompt = build_prompt(request)
         
-        # Decode base64 image to bytes
-        image_bytes = decode_base64_image(request.base_image)
-        print(f"Decoded base image: {len(image_bytes)} bytes")
-        
-        # Decode inspiration images if provided (for multi-reference)
-        inspiration_images_bytes = None
-        if request.inspiration_images and len(request.inspiration_images) > 0:
-            inspiration_images_bytes = []
-            for i, insp_b64 in enumerate(request.inspiration_images[:6]):  # Limit to 6 for FLUX.2 [dev]
-                try:
-                    insp_bytes = decode_base64_image(insp_b64)
-                    inspiration_images_bytes.append(insp_bytes)
-                    print(f"Decoded inspiration image {i+1}, size: {len(insp_bytes)} bytes")
-                except Exception as e:
-                    print(f"Failed to decode inspiration image {i+1}: {e}")
-                    # Continue with other images
-            print(f"Decoded {len(inspiration_images_bytes)} inspiration images for multi-reference")
-        
-        # Generate images in image-to-image mode with optional multi-reference
-        result = flux_model.generate_images.remote(
-            GenerationRequest(
-                prompt=full_prompt,
-                base_image=request.base_image,
-                inspiration_images=request.inspiration_images,
-                negative_prompt=request.negative_prompt,
-                num_images=request.num_images,
-                guidance_scale=request.guidance_scale,
-                num_inference_steps=request.num_inference_steps,
-                width=request.width,
-                height=request.height,
-                seed=request.seed,
-            ),
-            image_bytes,  # Pass the decoded bytes
-            inspiration_images_bytes  # Pass inspiration images bytes
+        # Decode (and optionally pre-resize) base and inspiration images on the web tier
+        gpu_request, image_bytes, inspiration_images_bytes = await _run_in_pool(
+            _prepare_generation_inputs, request, full_prompt, mode="final"
         )
+        images_digest = await _run_in_pool(_generation_images_digest, image_bytes, inspiration_images_bytes)
+        cache_key = _generation_cache_key("final", gpu_request, images_digest)
+        
+        async with _flux_admission(kind, units, request.session_id, cache_key) as job:
+            # Generate images in image-to-image mode with optional multi-reference
+            async def run():
+                async with flux_scheduler.slot(kind, request.session_id, units):
+                    flux_load.dispatched(job)
+                    return await _run_flux(units, lambda: flux_model.generate_images.remote.aio(
+                        gpu_request,
+                        image_bytes,  # Pass the decoded bytes
+                        inspiration_images_bytes  # Pass inspiration images bytes
+                    ))
+
+            result = await generation_result_cache.get_or_compute(cache_key, run)
         
-        return GenerationResponse(
+        return await _json_response(GenerationResponse(
             images=result["images"],
             generation_info=result["generation_info"],
             cost_estimate=result["cost_estimate"]
-        )
+        ))
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in generate_images: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # Gemma 3 4B-IT Endpoints - ACTIVE
+# Gemma backend for the single-image analysis routes: "gpu" (default), "cpu", or "auto" - CPU while the GPU
+# container is cold and the CPU queue is short, GPU once it is warm or the CPU backlog grows
+GEMMA_BACKEND = os.environ.get("GEMMA_BACKEND", "gpu").lower()
+GEMMA_CPU_MAX_BACKLOG = int(os.environ.get("GEMMA_CPU_MAX_BACKLOG", "2"))
+GEMMA_BACKEND_STATS_TTL_SECONDS = float(os.environ.get("GEMMA_BACKEND_STATS_TTL_SECONDS", "5"))
+_gemma_backend_stats: dict = {}  # backend -> (fetched_at, FunctionCurrentStats)
+
+
+async def _gemma_current_stats(backend: str, method):
+    """Live queue/container stats of a Gemma class, cached briefly so routing doesn't cost an RPC per request"""
+    cached = _gemma_backend_stats.get(backend)
+    if cached and time.time() - cached[0] < GEMMA_BACKEND_STATS_TTL_SECONDS:
+        return cached[1]
+    stats = await method.get_current_stats.aio()
+    _gemma_backend_stats[backend] = (time.time(), stats)
+    return stats
+
+
+async def _pick_gemma_model(method_name: str):
+    """Gemma instance (GPU or CPU class) that should serve `method_name`"""
+    if GEMMA_BACKEND == "cpu":
+        return gemma3_vision_model_cpu
+    if GEMMA_BACKEND != "auto":
+        return gemma3_vision_model
+
+    try:
+        gpu_stats = await _gemma_current_stats("gpu", getattr(gemma3_vision_model, method_name))
+        if gpu_stats.num_total_runners > 0:
+            return gemma3_vision_model  # warm GPU - always the fastest option
+        cpu_stats = await _gemma_current_stats("cpu", getattr(gemma3_vision_model_cpu, method_name))
+        cpu_queue = cpu_stats.backlog + cpu_stats.num_running_inputs
+        if cpu_queue < GEMMA_CPU_MAX_BACKLOG:
+            print(f"[GEMMA_BACKEND] {method_name} -> cpu (gpu cold, cpu queue={cpu_queue})")
+            return gemma3_vision_model_cpu
+        print(f"[GEMMA_BACKEND] {method_name} -> gpu (cpu queue={cpu_queue}, worth a cold start)")
+    except Exception as e:
+        print(f"[GEMMA_BACKEND] Stats unavailable, using GPU: {e}")
+    return gemma3_vision_model
+
+# Room pre-classifier tier: zero-shot CLIP (quantized ONNX, CPU) on the web container. Requests that don't need
+# a comment are answered from it when it is confident enough; everything else goes to Gemma as before.
+ROOM_PRECLASSIFIER_ENABLED = os.environ.get("ROOM_PRECLASSIFIER_ENABLED", "1").lower() in ("1", "true", "yes")
+ROOM_PRECLASSIFIER_REPO = os.environ.get("ROOM_PRECLASSIFIER_REPO", "Xenova/clip-vit-base-patch32")
+ROOM_PRECLASSIFIER_MIN_CONFIDENCE = float(os.environ.get("ROOM_PRECLASSIFIER_MIN_CONFIDENCE", "0.7"))
+ROOM_PRECLASSIFIER_THREADS = int(os.environ.get("ROOM_PRECLASSIFIER_THREADS", "2"))
+# Text prototypes per internal room type - their mean CLIP text embedding is the class prototype
+ROOM_PRECLASSIFIER_PROMPTS = {
+    "kitchen": ["a photo of a kitchen", "a kitchen interior with cabinets and a stove", "a kitchenette in an apartment"],
+    "living_room": ["a photo of a living room", "a living room with a sofa", "a cozy lounge with armchairs"],
+    "bedroom": ["a photo of a bedroom", "a bedroom with a bed", "a cozy bedroom interior"],
+    "bathroom": ["a photo of a bathroom", "a bathroom with a shower or bathtub", "a bathroom with a sink and tiles"],
+    "office": ["a photo of a home office", "an office with a desk and a chair", "a study room with a computer desk"],
+    "empty_room": ["a photo of an empty room", "an empty unfurnished room", "an empty apartment room before renovation"],
+}
+CLIP_IMAGE_SIZE = 224
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class RoomPreclassifier:
+    """Zero-shot room-type classifier: CLIP image embedding vs. per-type text prototypes.
+
+    The ONNX sessions and prototypes load once on first use (thread-safe); `classify` is CPU-bound, so
+    callers run it in the web thread pool.
+    """
+
+    def __init__(self, repo_id: str, prompts: dict):
+        self.repo_id = repo_id
+        self.prompts = prompts
+        self.labels = list(prompts)
+        self._lock = threading.Lock()
+        self._vision = None
+        self._prototypes = None
+
+    def _session(self, filename: str):
+        import onnxruntime
+        from huggingface_hub import hf_hub_download
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = ROOM_PRECLASSIFIER_THREADS
+        path = hf_hub_download(self.repo_id, filename, cache_dir=CACHE_DIR)
+        return onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def _load(self) -> None:
+        with self._lock:
+            if self._vision is not None:
+                return
+            from huggingface_hub import hf_hub_download
+            from tokenizers import Tokenizer
+            start = time.time()
+            tokenizer = Tokenizer.from_file(hf_hub_download(self.repo_id, "tokenizer.json", cache_dir=CACHE_DIR))
+            text = self._session("onnx/text_model_quantized.onnx")
+            prototypes = []
+            for label in self.labels:
+                embeds = []
+                for prompt in self.prompts[label]:
+                    ids = np.array([tokenizer.encode(prompt).ids], dtype=np.int64)
+                    feeds = {"input_ids": ids, "attention_mask": np.ones_like(ids)}
+                    embeds.append(text.run(["text_embeds"], {i.name: feeds[i.name] for i in text.get_inputs()})[0][0])
+                prototype = np.mean([e / np.linalg.norm(e) for e in embeds], axis=0)
+                prototypes.append(prototype / np.linalg.norm(prototype))
+            self._prototypes = np.stack(prototypes).astype(np.float32)
+            self._vision = self._session("onnx/vision_model_quantized.onnx")
+            print(f"[ROOM_PRECLASSIFIER] {self.repo_id} loaded with {len(self.labels)} prototypes in {time.time() - start:.2f}s")
+
+    @staticmethod
+    def preprocess(image) -> "np.ndarray":
+        """CLIP preprocessing: shortest side to 224 (bicubic), centre crop, normalize, NCHW float32"""
+        image = image.convert("RGB")
+        scale = CLIP_IMAGE_SIZE / min(image.size)
+        image = image.resize((max(CLIP_IMAGE_SIZE, round(image.width * scale)), max(CLIP_IMAGE_SIZE, round(image.height * scale))),
+                             Image.BICUBIC)
+        left, top = (image.width - CLIP_IMAGE_SIZE) // 2, (image.height - CLIP_IMAGE_SIZE) // 2
+        image = image.crop((left, top, left + CLIP_IMAGE_SIZE, top + CLIP_IMAGE_SIZE))
+        pixels = (np.asarray(image, dtype=np.float32) / 255.0 - CLIP_MEAN) / CLIP_STD
+        return pixels.transpose(2, 0, 1)[None].astype(np.float32)
+
+    def classify(self, image_bytes: bytes) -> tuple:
+        """(room_type, confidence, {room_type: probability}) - softmax over CLIP's scaled cosine similarities"""
+        self._load()
+        pixel_values = self.preprocess(Image.open(BytesIO(image_bytes)))
+        embed = self._vision.run(["image_embeds"], {"pixel_values": pixel_values})[0][0]
+        logits = 100.0 * self._prototypes @ (embed / np.linalg.norm(embed))
+        probabilities = np.exp(logits - logits.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return self.labels[best], float(probabilities[best]), dict(zip(self.labels, probabilities.round(4).tolist()))
+
+
+_room_preclassifier = RoomPreclassifier(ROOM_PRECLASSIFIER_REPO, ROOM_PRECLASSIFIER_PROMPTS)
+# tier -> [answered requests, total latency]; "preclassifier_only" counts classifier runs that fell through to Gemma
+_room_tier_stats = {"preclassifier": [0, 0.0], "gemma": [0, 0.0], "preclassifier_only": [0, 0.0]}
+
+
+def _record_room_tier(tier: str, seconds: float) -> None:
+    _room_tier_stats[tier][0] += 1
+    _room_tier_stats[tier][1] += seconds
+
+
+def _room_tier_summary() -> dict:
+    """Hit rate and mean latency per room-analysis tier, for /health"""
+    answered = _room_tier_stats["preclassifier"][0] + _room_tier_stats["gemma"][0]
+    return {
+        tier: {
+            "requests": count,
+            "hit_rate": round(count / answered, 3) if answered and tier != "preclassifier_only" else None,
+            "mean_latency_ms": round(total / count * 1000) if count else None,
+        }
+        for tier, (count, total) in _room_tier_stats.items()
+    }
+
+
+async def _preclassify_room(image_bytes: bytes) -> Optional[tuple]:
+    """Pre-classifier answer, or None when it is disabled or failed (the request then goes to Gemma)"""
+    if not ROOM_PRECLASSIFIER_ENABLED:
+        return None
+    start = time.time()
+    try:
+        room_type, confidence, probabilities = await _run_in_pool(_room_preclassifier.classify, image_bytes)
+    except Exception as e:
+        print(f"[ROOM_PRECLASSIFIER] Failed, falling back to Gemma: {e}")
+        return None
+    elapsed = time.time() - start
+    print(f"[ROOM_PRECLASSIFIER] {room_type} p={confidence:.3f} in {elapsed * 1000:.0f}ms {probabilities}")
+    return room_type, confidence, elapsed
+
+
 @web_app.post("/analyze-room", response_model=RoomAnalysisResponse)
 async def analyze_room(request: RoomAnalysisRequest):
     """Analyze room type and characteristics from uploaded image using Gemma 3 4B-IT"""
@@ -1584,7 +3756,7 @@ async def analyze_room(request: RoomAnalysisRequest):
 
         metadata_dict = request.metadata.dict() if request.metadata else {}
         session_id = metadata_dict.get("session_id")
-        _check_room_analysis_quota(session_id)
+        await _check_room_analysis_quota(session_id)
         
         # Decode base64 image
         image_bytes = decode_base64_image(request.image)
@@ -1597,12 +3769,30 @@ async def analyze_room(request: RoomAnalysisRequest):
             f"session={session_id} cache_key={metadata_dict.get('cache_key')} request_id={metadata_dict.get('request_id')}"
         )
         
-        # Analyze room using Gemma 3 4B-IT with timeout
-        import asyncio
+        # Tier 1: the CPU pre-classifier answers type-only requests it is confident about
+        start = time.time()
+        if not request.include_comment:
+            preclassified = await _preclassify_room(image_bytes)
+            if preclassified and preclassified[1] >= ROOM_PRECLASSIFIER_MIN_CONFIDENCE:
+                room_type, confidence, _ = preclassified
+                _record_room_tier("preclassifier", time.time() - start)
+                return RoomAnalysisResponse(
+                    detected_room_type=room_type,
+                    confidence=round(confidence, 3),
+                    room_description="Klasyfikacja pomieszczenia (CLIP, CPU)",
+                    suggestions=[],
+                    comment=ROOM_FALLBACK_COMMENTS[room_type],
+                )
+            if preclassified:
+                _record_room_tier("preclassifier_only", preclassified[2])
+
+        # Tier 2: Analyze room using Gemma 3 4B-IT with timeout
+        model = await _pick_gemma_model("analyze_room_and_comment")
         result = await asyncio.wait_for(
-            gemma3_vision_model.analyze_room_and_comment.remote.aio(image_bytes),
+            model.analyze_room_and_comment.remote.aio(image_bytes),
             timeout=300.0  # 5 minute timeout (T4 is slower, cold start can take longer)
         )
+        _record_room_tier("gemma", time.time() - start)
         
         return RoomAnalysisResponse(
             detected_room_type=result["detected_room_type"],
@@ -1634,24 +3824,14 @@ async def generate_llm_comment(request: LLMCommentRequest):
     try:
         print(f"Generating LLM comment for room type: {request.room_type}")
         
-        groq_comment = _call_groq_for_comment(request.room_type, request.room_description, request.context)
+        groq_comment = await _get_llm_comment(request.room_type, request.room_description, request.context)
         if groq_comment:
             return LLMCommentResponse(comment=groq_comment, suggestions=[])
         
         # For generated images, we don't have the actual image, so we generate a comment based on room type
         # This is a simplified version - in the future we could pass the generated image back to Gemma 3 4B-IT
-        
-        fallback_comments = {
-            "kitchen": "Świetnie! Ta wygenerowana kuchnia wygląda naprawdę fantastycznie! Widzę idealne miejsce do gotowania i spotkań rodzinnych.",
-            "living_room": "Świetnie! Ten pokój dzienny ma naprawdę przytulną atmosferę. Idealne miejsce na relaks i spędzanie czasu z bliskimi.",
-            "bedroom": "Uwielbiam tę sypialnię! Wygląda na bardzo komfortowe i spokojne miejsce do wypoczynku.",
-            "bathroom": "Ta łazienka ma naprawdę elegancki styl! Idealne miejsce na relaks i regenerację.",
-            "office": "Fantastyczne biuro! Widzę tu idealne warunki do pracy i kreatywności.",
-            "empty_room": "Świetnie! To puste pomieszczenie ma naprawdę duży potencjał - możemy stworzyć tu coś wyjątkowego!"
-        }
-        
         return LLMCommentResponse(
-            comment=fallback_comments.get(request.room_type, "Świetnie! To wygenerowane wnętrze wygląda naprawdę fantastycznie!"),
+            comment=LLM_FALLBACK_COMMENTS.get(request.room_type, LLM_FALLBACK_DEFAULT_COMMENT),
             suggestions=[]
         )
         
@@ -1677,9 +3857,10 @@ async def analyze_inspiration(request: InspirationAnalysisRequest):
         
         result = None
         try:
-            # Direct GPU call on class (same app), avoids lookup issues
+            # Direct call on class (same app), avoids lookup issues
+            model = await _pick_gemma_model("analyze_inspiration")
             result = await asyncio.wait_for(
-                gemma3_vision_model.analyze_inspiration.remote.aio(image_bytes),
+                model.analyze_inspiration.remote.aio(image_bytes),
                 timeout=300.0  # allow cold start on T4
             )
             print("Inspiration analyzed via Gemma3VisionModel.remote.aio (GPU)")
@@ -1693,7 +3874,8 @@ async def analyze_inspiration(request: InspirationAnalysisRequest):
             colors=result["colors"],
             materials=result["materials"],
             biophilia=result["biophilia"],
-            description=result["description"]
+            description=result["description"],
+            color_names=result.get("color_names")
         )
         
     except asyncio.TimeoutError:
@@ -1708,10 +3890,312 @@ async def analyze_inspiration_options():
     """Handle preflight request for inspiration analysis"""
     return {"message": "OK"}
 
+ANALYZE_ROOM_STREAM_TIMEOUT_SECONDS = float(os.environ.get("ANALYZE_ROOM_STREAM_TIMEOUT_SECONDS", "300"))
+
+
+def _sse_event(event: str, payload: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+@web_app.post("/analyze-room-stream")
+async def analyze_room_stream(request: RoomAnalysisRequest):
+    """Streaming /analyze-room (Server-Sent Events).
+
+    Events: `room_type` ({"detected_room_type"}) as soon as the TYP line is decoded, `comment` ({"text"}) for each
+    new piece of the KOMENTARZ, then `result` with the full RoomAnalysisResponse - or `error` ({"detail"}).
+    Every payload carries `elapsed_ms` since the request arrived.
+    """
+    received = time.time()
+    metadata_dict = request.metadata.dict() if request.metadata else {}
+    session_id = metadata_dict.get("session_id")
+    # Everything before the stream starts fails as a plain HTTP error, like /analyze-room
+    try:
+        await _check_room_analysis_quota(session_id)
+        image_bytes = decode_base64_image(request.image)
+        print(f"[ROOM_STREAM] hash={hashlib.sha256(image_bytes).hexdigest()[:16]} size={len(image_bytes)} session={session_id}")
+        model = await _pick_gemma_model("analyze_room_stream")
+    except HTTPException as http_exc:
+        print(f"[ROOM_STREAM] Quota or client error: {http_exc.detail}")
+        raise http_exc
+    except Exception as e:
+        print(f"[ROOM_STREAM] Could not start analysis: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def _stream():
+        first_byte_ms = None
+        deadline = time.monotonic() + ANALYZE_ROOM_STREAM_TIMEOUT_SECONDS
+        events = model.analyze_room_stream.remote_gen.aio(image_bytes)
+        try:
+            while True:
+                item = await asyncio.wait_for(events.__anext__(), timeout=max(deadline - time.monotonic(), 0))
+                event = item.pop("event")
+                if event == "result":
+                    item = RoomAnalysisResponse(**item["result"]).model_dump()
+                item["elapsed_ms"] = round((time.time() - received) * 1000)
+                if first_byte_ms is None:
+                    first_byte_ms = item["elapsed_ms"]
+                yield _sse_event(event, item)
+        except StopAsyncIteration:
+            pass
+        except asyncio.TimeoutError:
+            print(f"[ROOM_STREAM] Timed out after {ANALYZE_ROOM_STREAM_TIMEOUT_SECONDS:.0f}s")
+            yield _sse_event("error", {"detail": "Analysis timed out - model may still be loading (cold start)"})
+        except Exception as e:
+            print(f"[ROOM_STREAM] Remote analysis failed: {e}")
+            traceback.print_exc()
+            yield _sse_event("error", {"detail": str(e)})
+        finally:
+            await events.aclose()
+        print(f"[ROOM_STREAM] first useful byte after {first_byte_ms}ms, total {(time.time() - received) * 1000:.0f}ms")
+
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@web_app.options("/analyze-room-stream")
+async def analyze_room_stream_options():
+    """Handle preflight request for streaming room analysis"""
+    return {"message": "OK"}
+
+ANALYZE_BATCH_MAX_INSPIRATIONS = int(os.environ.get("ANALYZE_BATCH_MAX_INSPIRATIONS", "10"))
+ANALYZE_BATCH_TIMEOUT_SECONDS = float(os.environ.get("ANALYZE_BATCH_TIMEOUT_SECONDS", "300"))
+
+
+def _decode_analysis_batch(request: AnalyzeBatchRequest) -> tuple:
+    """Decode the batch images; returns (room bytes or None, inspiration bytes, {inspiration index: error})"""
+    room_image_bytes = decode_base64_image(request.room_image) if request.room_image else None
+    inspiration_images_bytes, errors = [], {}
+    for index, inspiration_b64 in enumerate(request.inspiration_images):
+        try:
+            inspiration_images_bytes.append(decode_base64_image(inspiration_b64))
+        except HTTPException as e:
+            errors[index] = e.detail
+    return room_image_bytes, inspiration_images_bytes, errors
+
+
+def _ndjson_line(payload: dict) -> bytes:
+    return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+@web_app.post("/analyze-batch")
+async def analyze_batch(request: AnalyzeBatchRequest):
+    """Analyze the room image and up to 10 inspirations in one Gemma call.
+
+    Streams NDJSON: one {"kind", "index", "result"} line per image as it finishes (index is the position in
+    `inspiration_images`; failed images get an "error" instead of "result"), then a final {"done": true} line.
+    """
+    if not request.room_image and not request.inspiration_images:
+        raise HTTPException(status_code=400, detail="Provide room_image and/or inspiration_images")
+    if len(request.inspiration_images) > ANALYZE_BATCH_MAX_INSPIRATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {ANALYZE_BATCH_MAX_INSPIRATIONS} inspiration images per batch")
+
+    metadata_dict = request.metadata.dict() if request.metadata else {}
+    session_id = metadata_dict.get("session_id")
+    if request.room_image:
+        await _check_room_analysis_quota(session_id)
+
+    try:
+        room_image_bytes, decoded_inspirations, decode_errors = await _run_in_pool(_decode_analysis_batch, request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid room image: {e}")
+
+    # Remote indices only cover the decoded inspirations - map them back to request positions
+    request_indices = [index for index in range(len(request.inspiration_images)) if index not in decode_errors]
+    print(f"[ANALYZE_BATCH] session={session_id} room={room_image_bytes is not None} "
+          f"inspirations={len(decoded_inspirations)} decode_errors={len(decode_errors)}")
+
+    async def _stream():
+        start = time.time()
+        for index, error in decode_errors.items():
+            yield _ndjson_line({"kind": "inspiration", "index": index, "error": error})
+
+        pending = {("inspiration", index) for index in request_indices}
+        if room_image_bytes is not None:
+            pending.add(("room", 0))
+        deadline = time.monotonic() + ANALYZE_BATCH_TIMEOUT_SECONDS
+        results = gemma3_vision_model.analyze_batch.remote_gen.aio(room_image_bytes, decoded_inspirations)
+        try:
+            while pending:
+                item = await asyncio.wait_for(results.__anext__(), timeout=max(deadline - time.monotonic(), 0))
+                if item["kind"] == "room":
+                    key = ("room", 0)
+                    result = RoomAnalysisResponse(**item["result"]).model_dump()
+                else:
+                    key = ("inspiration", request_indices[item["index"]])
+                    result = InspirationAnalysisResponse(**item["result"]).model_dump()
+                pending.discard(key)
+                yield _ndjson_line({"kind": key[0], "index": key[1], "result": result})
+        except StopAsyncIteration:
+            pass
+        except asyncio.TimeoutError:
+            print(f"[ANALYZE_BATCH] Timed out after {ANALYZE_BATCH_TIMEOUT_SECONDS:.0f}s with {len(pending)} images pending")
+        except Exception as e:
+            print(f"[ANALYZE_BATCH] Remote batch failed: {e}")
+            traceback.print_exc()
+        finally:
+            await results.aclose()
+
+        for kind, index in sorted(pending):
+            yield _ndjson_line({"kind": kind, "index": index, "error": "Analysis did not complete"})
+        yield _ndjson_line({"done": True, "elapsed_s": round(time.time() - start, 2)})
+
+    return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+@web_app.options("/analyze-batch")
+async def analyze_batch_options():
+    """Handle preflight request for batch analysis"""
+    return {"message": "OK"}
+
 # =========================================
 # PROMPT REFINEMENT (for prompt synthesis)
 # =========================================
 
+# Prompt compaction: token counts come from the tokenizer of FLUX.2's own text encoder (Mistral), read from the
+# pipeline repo's tokenizer subfolder and loaded once per container; compaction results are memoized per (prompt, target)
+PROMPT_TOKENIZER_REPO = os.environ.get("PROMPT_TOKENIZER_REPO", MODEL_NAME)
+PROMPT_TOKENIZER_FILE = os.environ.get("PROMPT_TOKENIZER_FILE", "tokenizer/tokenizer.json")
+PROMPT_COMPACTION_CACHE_SIZE = int(os.environ.get("PROMPT_COMPACTION_CACHE_SIZE", "4096"))
+PROMPT_REFINE_BATCH_MAX = int(os.environ.get("PROMPT_REFINE_BATCH_MAX", "10"))
+# Wordy phrasings rewritten before anything is dropped
+PROMPT_REWRITES = [
+    ("featuring a ", "with "),
+    ("that has ", "with "),
+    ("which includes ", "including "),
+    (", and also ", ", "),
+]
+# Modifiers that add tokens but little to the image - dropped first when a prompt is over budget
+PROMPT_LOW_VALUE_MODIFIERS = {
+    "very", "really", "quite", "extremely", "incredibly", "truly", "highly", "super", "absolutely", "perfectly",
+    "beautiful", "beautifully", "stunning", "amazing", "gorgeous", "lovely", "nice", "wonderful", "elegant",
+    "carefully", "thoughtfully", "tastefully", "subtle", "subtly", "overall", "also", "just", "some",
+}
+# Clauses naming a style or material are ranked above other clauses at the same position
+PROMPT_PRIORITY_TERMS = set(INSPIRATION_STYLES) | set(INSPIRATION_MATERIALS)
+_PROMPT_CLAUSE_SPLIT_RE = re.compile(r"\s*[,;]\s*|\.(?:\s+|$)")
+_PROMPT_WORD_RE = re.compile(r"[\w-]+")
+
+
+_prompt_tokenizer_lock = threading.Lock()
+_prompt_tokenizer_state: dict = {}  # "tokenizer" or "error", set once per container
+
+
+def _load_prompt_tokenizer():
+    from huggingface_hub import hf_hub_download
+    from tokenizers import Tokenizer
+    # The volume path and HF_NEWTOKEN only exist in Modal containers; local benchmarks use the default HF cache/login
+    cache_dir = CACHE_DIR if os.path.isdir(CACHE_DIR) else None
+    path = hf_hub_download(PROMPT_TOKENIZER_REPO, PROMPT_TOKENIZER_FILE, cache_dir=cache_dir,
+                           token=os.environ.get("HF_NEWTOKEN"))
+    return Tokenizer.from_file(path)
+
+
+def _prompt_tokenizer():
+    """The prompt tokenizer, loaded once per container (preloaded at web startup). A failed load is logged once
+    and cached: later calls raise without retrying, so prompt refinement fails loudly instead of miscounting"""
+    with _prompt_tokenizer_lock:
+        if not _prompt_tokenizer_state:
+            start = time.time()
+            try:
+                _prompt_tokenizer_state["tokenizer"] = _load_prompt_tokenizer()
+                print(f"[PROMPT] Tokenizer {PROMPT_TOKENIZER_REPO}/{PROMPT_TOKENIZER_FILE} loaded in {time.time() - start:.2f}s")
+            except Exception as exc:
+                print(f"[PROMPT] Tokenizer {PROMPT_TOKENIZER_REPO}/{PROMPT_TOKENIZER_FILE} failed to load, "
+                      f"prompt refinement is unavailable until the container restarts: {exc}")
+                _prompt_tokenizer_state["error"] = exc
+    if "error" in _prompt_tokenizer_state:
+        raise RuntimeError(f"Prompt tokenizer unavailable: {_prompt_tokenizer_state['error']}")
+    return _prompt_tokenizer_state["tokenizer"]
+
+
+@functools.lru_cache(maxsize=PROMPT_COMPACTION_CACHE_SIZE * 4)
+def count_prompt_tokens(text: str) -> int:
+    """Text-encoder tokens in `text`, without the start/end tokens"""
+    return len(_prompt_tokenizer().encode(text, add_special_tokens=False).ids)
+
+
+def _dedupe_clauses(clauses: List[str]) -> List[str]:
+    """Drop repeated clauses - exact repeats and clauses whose words all appear in another kept clause
+    (e.g. "warm lighting" next to "soft warm lighting"); the first / longest wording wins"""
+    words = [frozenset(_PROMPT_WORD_RE.findall(clause.lower())) for clause in clauses]
+    kept = []
+    for i, clause in enumerate(clauses):
+        if not words[i]:
+            continue
+        if any(words[i] <= words[j] and (words[i] != words[j] or j < i) for j in range(len(clauses)) if j != i):
+            continue
+        kept.append(clause)
+    return kept
+
+
+@functools.lru_cache(maxsize=PROMPT_COMPACTION_CACHE_SIZE)
+def compact_prompt(prompt: str, target_tokens: int) -> tuple:
+    """Fit `prompt` into `target_tokens` text-encoder tokens.
+
+    Steps, cheapest loss first: rewrite wordy phrases, split into clauses and drop duplicates, then drop
+    low-value modifiers (latest clauses first), then whole clauses by rank (position, with a bonus for
+    styles/materials; the first clause - the subject - is kept) and put back any that fit again, and only
+    then trim words from the end.
+    Returns (compacted prompt, original tokens, compacted tokens, {step: items dropped}).
+    """
+    original_tokens = count_prompt_tokens(prompt)
+    if original_tokens <= target_tokens:
+        return prompt, original_tokens, original_tokens, {}
+
+    text = " ".join(prompt.split())
+    for old, new in PROMPT_REWRITES:
+        text = text.replace(old, new)
+    clauses = [clause for clause in _PROMPT_CLAUSE_SPLIT_RE.split(text) if clause.strip()]
+    deduped = _dedupe_clauses(clauses)
+    dropped = {"duplicate_clauses": len(clauses) - len(deduped), "modifiers": 0, "clauses": 0, "trimmed_words": 0}
+    clauses = [clause.split() for clause in deduped]
+
+    def render() -> str:
+        return ", ".join(" ".join(words) for words in clauses if words)
+
+    def over_budget() -> bool:
+        return count_prompt_tokens(render()) > target_tokens
+
+    # Low-value modifiers, from the last clause backwards
+    for words in reversed(clauses):
+        for index in reversed(range(len(words))):
+            if not over_budget():
+                break
+            if len(words) > 1 and words[index].lower().strip(".,!") in PROMPT_LOW_VALUE_MODIFIERS:
+                del words[index]
+                dropped["modifiers"] += 1
+
+    # Whole clauses, lowest rank first
+    def rank(index: int) -> float:
+        terms = set(_PROMPT_WORD_RE.findall(" ".join(clauses[index]).lower()))
+        return 1.0 / (1 + index) + (0.5 if terms & PROMPT_PRIORITY_TERMS else 0.0)
+
+    removed = []
+    for index in sorted(range(1, len(clauses)), key=rank):
+        if not over_budget():
+            break
+        removed.append((index, clauses[index]))
+        clauses[index] = []
+    # The last drop may have freed more than needed - put back the best-ranked clauses that still fit
+    for index, words in reversed(removed[:-1]):
+        clauses[index] = words
+        if over_budget():
+            clauses[index] = []
+    dropped["clauses"] = sum(1 for index, _ in removed if not clauses[index])
+
+    # Still too long (one huge clause): trim whole words from the end
+    while over_budget() and sum(map(len, clauses)) > 1:
+        last = max(i for i, words in enumerate(clauses) if words)
+        clauses[last].pop()
+        dropped["trimmed_words"] += 1
+
+    compacted = render()
+    return compacted, original_tokens, count_prompt_tokens(compacted), {step: n for step, n in dropped.items() if n}
+
+
 class PromptRefinementRequest(BaseModel):
     prompt: str
     target_tokens: int = 65
@@ -1723,79 +4207,442 @@ class PromptRefinementResponse(BaseModel):
     refined_tokens: int
     improvement: str
 
+class PromptRefinementBatchRequest(BaseModel):
+    prompts: List[str]  # e.g. the five matrix prompts of one session
+    target_tokens: int = 65
+
+class PromptRefinementBatchResponse(BaseModel):
+    results: List[PromptRefinementResponse]
+
+
+def _refine_prompt_response(prompt: str, target_tokens: int) -> PromptRefinementResponse:
+    try:
+        _prompt_tokenizer()
+    except RuntimeError as e:
+        # Without the real tokenizer any count would be a guess - a prompt "within budget" could still be over it
+        raise HTTPException(status_code=503, detail=str(e))
+    try:
+        refined, original_tokens, refined_tokens, dropped = compact_prompt(prompt, target_tokens)
+    except Exception as e:
+        print(f"Prompt refinement error: {str(e)}")
+        # Fallback: return original
+        tokens = count_prompt_tokens(prompt)
+        return PromptRefinementResponse(
+            refined_prompt=prompt,
+            original_tokens=tokens,
+            refined_tokens=tokens,
+            improvement="Error, returned original"
+        )
+    if not dropped:
+        improvement = "Already optimal"
+    else:
+        details = ", ".join(f"{n} {step.replace('_', ' ')}" for step, n in dropped.items())
+        improvement = f"Reduced by {original_tokens - refined_tokens} tokens ({details})"
+    return PromptRefinementResponse(
+        refined_prompt=refined,
+        original_tokens=original_tokens,
+        refined_tokens=refined_tokens,
+        improvement=improvement
+    )
+
+
 @web_app.post("/refine-prompt", response_model=PromptRefinementResponse)
 async def refine_prompt(request: PromptRefinementRequest):
     """
-    Refine FLUX prompt using lightweight LLM
+    Compact a FLUX prompt to `target_tokens` text-encoder tokens (see compact_prompt)
     
     Purpose:
     - Condense verbose template prompts
     - Remove redundancy
-    - Keep token count under 65 (CLIP optimal)
+    - Keep token count under the target (65 by default)
     - Maintain semantic meaning
     """
-    try:
-        print(f"Refining prompt (length: {len(request.prompt)} chars)")
-        
-        original_tokens = len(request.prompt.split())
-        print(f"Original tokens: {original_tokens}")
-        
-        # If already short enough, return as-is
-        if original_tokens <= request.target_tokens:
-            return PromptRefinementResponse(
-                refined_prompt=request.prompt,
-                original_tokens=original_tokens,
-                refined_tokens=original_tokens,
-                improvement="Already optimal"
-            )
-        
-        # Simple rule-based refinement (no LLM needed for basic cases)
-        refined = request.prompt
-        
-        # Remove redundant words
-        redundant_phrases = [
-            ("featuring a ", "with "),
-            ("that has ", "with "),
-            ("which includes ", "including "),
-            (", and also ", ", "),
-            ("very ", ""),
-            ("really ", ""),
-            ("quite ", "")
-        ]
-        
-        for old, new in redundant_phrases:
-            refined = refined.replace(old, new)
-        
-        # Remove double spaces
-        refined = ' '.join(refined.split())
-        
-        refined_tokens = len(refined.split())
-        print(f"Refined tokens: {refined_tokens}")
-        
-        # If still too long, use more aggressive truncation
-        if refined_tokens > request.target_tokens:
-            words = refined.split()
-            refined = ' '.join(words[:request.target_tokens])
-            refined_tokens = request.target_tokens
-        
-        return PromptRefinementResponse(
-            refined_prompt=refined,
-            original_tokens=original_tokens,
-            refined_tokens=refined_tokens,
-            improvement=f"Reduced by {original_tokens - refined_tokens} tokens"
-        )
-        
-    except Exception as e:
-        print(f"Prompt refinement error: {str(e)}")
-        # Fallback: return original
-        return PromptRefinementResponse(
-            refined_prompt=request.prompt,
-            original_tokens=len(request.prompt.split()),
-            refined_tokens=len(request.prompt.split()),
-            improvement="Error, returned original"
-        )
+    print(f"Refining prompt (length: {len(request.prompt)} chars)")
+    response = await _run_in_pool(_refine_prompt_response, request.prompt, request.target_tokens)
+    print(f"Prompt tokens: {response.original_tokens} -> {response.refined_tokens} ({response.improvement})")
+    return response
+
+@web_app.post("/refine-prompts", response_model=PromptRefinementBatchResponse)
+async def refine_prompts(request: PromptRefinementBatchRequest):
+    """Batch /refine-prompt (e.g. a session's five matrix prompts) in one request and one pool hop"""
+    if len(request.prompts) > PROMPT_REFINE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {PROMPT_REFINE_BATCH_MAX} prompts per batch")
+
+    def _refine_all() -> List[PromptRefinementResponse]:
+        return [_refine_prompt_response(prompt, request.target_tokens) for prompt in request.prompts]
+
+    results = await _run_in_pool(_refine_all)
+    print(f"[REFINE_BATCH] {len(results)} prompts, tokens {sum(r.original_tokens for r in results)} -> "
+          f"{sum(r.refined_tokens for r in results)}")
+    return PromptRefinementBatchResponse(results=results)
+
+@web_app.options("/refine-prompts")
+async def refine_prompts_options():
+    """Handle preflight request for batch prompt refinement"""
+    return {"message": "OK"}
 
 @web_app.options("/refine-prompt")
 async def refine_prompt_options():
     """Handle preflight request for prompt refinement"""
     return {"message": "OK"}
+
+# =========================================
+# LOAD TEST (run locally: modal run main.py::load_test --url https://... --image-path room.jpg)
+# =========================================
+
+@app.local_entrypoint()
+def load_test(url: str, image_path: str, route: str = "/generate-previews", concurrency: int = 4, health_probes: int = 20):
+    """Fire concurrent generation requests and probe /health meanwhile to check the event loop stays responsive"""
+    import statistics
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor as _Pool
+
+    with open(image_path, "rb") as f:
+        image_b64 = base64.b64encode(f.read()).decode()
+    body = json.dumps({
+        "prompt": "Load test: modern living room, light wood, plants",
+        "base_image": image_b64,
+        "num_images": 1,
+        "num_inference_steps": 20,
+        "seed": 42,
+    }).encode()
+
+    def _post(i: int) -> float:
+        req = urllib.request.Request(url.rstrip("/") + route, data=body, headers={"Content-Type": "application/json"})
+        start = time.time()
+        with urllib.request.urlopen(req, timeout=900) as resp:
+            resp.read()
+        elapsed = time.time() - start
+        print(f"[LOAD] request {i} finished in {elapsed:.2f}s")
+        return elapsed
+
+    def _probe_health() -> List[float]:
+        latencies = []
+        for _ in range(health_probes):
+            start = time.time()
+            with urllib.request.urlopen(url.rstrip("/") + "/health", timeout=60) as resp:
+                resp.read()
+            latencies.append(time.time() - start)
+            time.sleep(1.0)
+        return latencies
+
+    wall_start = time.time()
+    with _Pool(max_workers=concurrency + 1) as pool:
+        health_future = pool.submit(_probe_health)
+        request_latencies = list(pool.map(_post, range(concurrency)))
+        health_latencies = health_future.result()
+    wall = time.time() - wall_start
+
+    print(f"[LOAD] {concurrency} x {route}: wall={wall:.2f}s sum={sum(request_latencies):.2f}s "
+          f"max={max(request_latencies):.2f}s (Flux2Model itself still runs one generation at a time)")
+    print(f"[LOAD] /health during load: p50={statistics.median(health_latencies) * 1000:.0f}ms "
+          f"max={max(health_latencies) * 1000:.0f}ms (stays low when the event loop is not blocked)")
+
+@app.local_entrypoint()
+def ttfb_probe(url: str, samples: int = 10, interval: float = 30.0):
+    """Measure time-to-first-byte for CORS preflight and /health, and count distinct web containers (cold starts)"""
+    import urllib.request
+
+    def _ttfb(method: str, path: str) -> tuple:
+        headers = {}
+        if method == "OPTIONS":
+            headers = {
+                "Origin": "http://localhost:3000",
+                "Access-Control-Request-Method": "POST",
+                "Access-Control-Request-Headers": "content-type",
+            }
+        req = urllib.request.Request(url.rstrip("/") + path, method=method, headers=headers)
+        start = time.time()
+        with urllib.request.urlopen(req, timeout=300) as resp:
+            first = resp.read(1)
+            ttfb = time.time() - start
+            # Keep the byte that timed the response - it is the opening "{" of the JSON body
+            payload = first + resp.read() if path == "/health" else b""
+        return ttfb, payload
+
+    containers = {}
+    for i in range(samples):
+        preflight_ttfb, _ = _ttfb("OPTIONS", "/generate-previews")
+        health_ttfb, payload = _ttfb("GET", "/health")
+        web_container = json.loads(payload or b"{}").get("web_container", {})
+        container_id = web_container.get("id", "unknown")
+        containers.setdefault(container_id, web_container.get("uptime_s"))
+        print(f"[TTFB] sample {i}: preflight={preflight_ttfb * 1000:.0f}ms health={health_ttfb * 1000:.0f}ms "
+              f"container={container_id} uptime={web_container.get('uptime_s')}s")
+        if i < samples - 1:
+            time.sleep(interval)
+
+    print(f"[TTFB] distinct web containers seen (cold starts): {len(containers)}")
+
+# =========================================
+# IMPORT-TIME PROFILE (modal run main.py::import_profile)
+# =========================================
+
+def _import_time_profile(top: int = 15) -> dict:
+    """Run `python -X importtime -c "import main"` in this container and summarize the slowest imports"""
+    import subprocess
+    import sys
+
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    top_level = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        # Nested imports are indented further - only top-level entries add up to the total
+        if len(name) - len(name.lstrip()) == 3:
+            top_level.append((name.strip(), int(cumulative_us) / 1000))
+    top_level.sort(key=lambda item: item[1], reverse=True)
+    return {
+        "total_ms": round(sum(ms for _, ms in top_level), 1),
+        "slowest": [(name, round(ms, 1)) for name, ms in top_level[:top]],
+        "returncode": proc.returncode,
+    }
+
+@app.function(image=web_image)
+def profile_imports_web_image() -> dict:
+    return _import_time_profile()
+
+@app.function(image=image)
+def profile_imports_gpu_image() -> dict:
+    return _import_time_profile()
+
+@app.local_entrypoint()
+def import_profile():
+    """Compare `import main` time in the slim web image vs the GPU image the web tier used before"""
+    for label, fn in (("web_image", profile_imports_web_image), ("gpu image", profile_imports_gpu_image)):
+        profile = fn.remote()
+        print(f"[IMPORTTIME] {label}: import main = {profile['total_ms']:.0f}ms (rc={profile['returncode']})")
+        for name, ms in profile["slowest"]:
+            print(f"    {ms:10.1f}ms  {name}")
+
+# =========================================
+# FAKE GROQ SERVER (local testing of timeouts, retries and the circuit breaker)
+#   modal run main.py::fake_groq --latency 0.5 --failure-rate 0.3
+#   GROQ_API_URL=http://127.0.0.1:8787/openai/v1/chat/completions GROQ_API_KEY=test uvicorn main:web_app
+# =========================================
+
+@app.local_entrypoint()
+def fake_groq(port: int = 8787, latency: float = 0.2, failure_rate: float = 0.0, failure_status: int = 503):
+    """Serve Groq-compatible chat completions locally with configurable latency and error rate"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request_body = json.loads(self.rfile.read(length) or b"{}")
+            time.sleep(latency)
+            if random.random() < failure_rate:
+                self.send_response(failure_status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps({"error": {"message": "fake failure"}}).encode())
+                return
+            prompt = request_body.get("messages", [{}])[-1].get("content", "")
+            body = json.dumps({
+                "id": "fake-groq",
+                "model": request_body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": f"Fake komentarz ({len(prompt)} znaków promptu)."}}],
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+    print(f"[FAKE_GROQ] Listening on http://127.0.0.1:{port}/openai/v1/chat/completions "
+          f"(latency={latency}s, failure_rate={failure_rate}, failure_status={failure_status})")
+    server.serve_forever()
+
+# =========================================
+# GEMMA BURST BENCHMARK (modal run main.py::bench_inspiration_burst --image-path insp.jpg)
+# =========================================
+
+@app.local_entrypoint()
+def bench_inspiration_burst(image_path: str, n: int = 10, rounds: int = 2, max_batch_size: int = 0):
+    """Send `n` concurrent analyze_inspiration calls (like the frontend's 10 inspirations) and report latency/throughput.
+    The first round includes the cold start. GEMMA_MAX_BATCH_SIZE is read inside the container, so pass
+    `--max-batch-size 1` (rather than setting it locally) to compare against the default and see the batching gain."""
+    import statistics
+    from concurrent.futures import ThreadPoolExecutor as _Pool
+
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+
+    model = gemma3_vision_model
+    if max_batch_size > 0:
+        model = Gemma3VisionModel.with_options(env={"GEMMA_MAX_BATCH_SIZE": str(max_batch_size)})()
+
+    def _one(_: int) -> float:
+        start = time.time()
+        model.analyze_inspiration.remote(image_bytes)
+        return time.time() - start
+
+    for round_index in range(rounds):
+        wall_start = time.time()
+        with _Pool(max_workers=n) as pool:
+            latencies = list(pool.map(_one, range(n)))
+        wall = time.time() - wall_start
+        print(f"[BENCH] round {round_index}: {n} inspirations in {wall:.2f}s -> {n / wall:.2f} img/s, "
+              f"per-image p50={statistics.median(latencies):.2f}s max={max(latencies):.2f}s")
+
+@app.local_entrypoint()
+def bench_gemma_prefill(image_path: str, kind: str = "inspiration", repeats: int = 5):
+    """Compare Gemma prefill time with and without the cached prompt prefix"""
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+    result = gemma3_vision_model.benchmark_prefill.remote(image_bytes, kind, repeats)
+    print(f"[BENCH] {result['kind']} prompt={result['prompt_tokens']} tokens: "
+          f"full prefill={result['full_prefill_s'] * 1000:.1f}ms, "
+          f"cached prefix={result['cached_prefix_prefill_s'] * 1000:.1f}ms")
+
+@app.local_entrypoint()
+def bench_gemma_backends(image_path: str, kind: str = "room", repeats: int = 3):
+    """Latency of the same analysis on the GPU (T4) and CPU (int8) Gemma classes.
+    The first call of each backend includes its cold start; the rest are warm."""
+    import statistics
+
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+    method_name = "analyze_room_and_comment" if kind == "room" else "analyze_inspiration"
+
+    for backend, model in (("gpu", gemma3_vision_model), ("cpu", gemma3_vision_model_cpu)):
+        latencies = []
+        for _ in range(repeats):
+            start = time.time()
+            result = getattr(model, method_name).remote(image_bytes)
+            latencies.append(time.time() - start)
+        warm = latencies[1:] or latencies
+        print(f"[BENCH] {backend} {kind}: first={latencies[0]:.2f}s warm p50={statistics.median(warm):.2f}s "
+              f"result={result.get('detected_room_type') or result.get('styles')}")
+
+@app.local_entrypoint()
+def bench_speculative(main_model: str = "HuggingFaceTB/SmolLM2-360M-Instruct", draft_model: str = "HuggingFaceTB/SmolLM2-135M-Instruct",
+                      max_new_tokens: int = 64, image_path: str = ""):
+    """Speculative decoding benchmark.
+
+    Without image_path: runs locally on CPU with two small models sharing a tokenizer (any Linux box).
+    With image_path: runs Gemma3VisionModel.benchmark_speculative_decoding on Modal (needs GEMMA_DRAFT_MODEL).
+    """
+    if image_path:
+        with open(image_path, "rb") as f:
+            print(f"[BENCH] {gemma3_vision_model.benchmark_speculative_decoding.remote(f.read())}")
+        return
+
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(main_model)
+    model = AutoModelForCausalLM.from_pretrained(main_model, torch_dtype=torch.float32).eval()
+    draft = AutoModelForCausalLM.from_pretrained(draft_model, torch_dtype=torch.float32).eval()
+    questions = [
+        "Describe a cozy Scandinavian living room in two sentences.",
+        "List four materials typical for an industrial loft.",
+        "What makes a bathroom feel calm? Answer briefly.",
+    ]
+    prompts = [
+        tokenizer.apply_chat_template([{"role": "user", "content": question}], add_generation_prompt=True, return_tensors="pt", return_dict=True)["input_ids"]
+        for question in questions
+    ]
+    result = benchmark_speculative(model, draft, prompts, max_new_tokens=max_new_tokens, pad_token_id=tokenizer.eos_token_id)
+    print(f"[BENCH] {main_model} + draft {draft_model}: {result}")
+
+
+@app.local_entrypoint()
+def bench_prompt_compaction(prompts: int = 2000, target_tokens: int = 65):
+    """Throughput of compact_prompt on synthetic matrix-style prompts: cold (empty memo), memoized, and in
+    batches of five. Runs locally - only needs `tokenizers`, `huggingface_hub` and an HF login with access to
+    MODEL_NAME (for its tokenizer)."""
+    rng = random.Random(0)
+    fillers = ["very beautiful", "really stunning", "soft warm lighting", "warm lighting", "large windows", "high ceiling",
+               "cozy atmosphere", "neutral palette", "highly detailed", "plants", "art on the walls", "natural light"]
+    corpus = []
+    for _ in range(prompts):
+        clauses = [f"Photorealistic interior of a {rng.choice(INSPIRATION_STYLES)} {rng.choice(['living room', 'bedroom', 'kitchen'])}"]
+        clauses += [f"{rng.choice(['', 'elegant ', 'quite '])}{rng.choice(INSPIRATION_MATERIALS)} {rng.choice(['floor', 'table', 'sofa', 'walls'])}"
+                    for _ in range(rng.randint(3, 8))]
+        clauses += rng.sample(fillers, rng.randint(3, 8))
+        corpus.append(", ".join(clauses))
+
+    count_prompt_tokens("warm up")  # tokenizer download/load is not part of the measurement
+    compact_prompt.cache_clear()
+    count_prompt_tokens.cache_clear()
+    start = time.perf_counter()
+    results = [compact_prompt(prompt, target_tokens) for prompt in corpus]
+    cold_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for prompt in corpus:
+        compact_prompt(prompt, target_tokens)
+    memo_s = time.perf_counter() - start
+
+    compact_prompt.cache_clear()
+    start = time.perf_counter()
+    for i in range(0, len(corpus), 5):
+        [_refine_prompt_response(prompt, target_tokens) for prompt in corpus[i:i + 5]]
+    batch_s = time.perf_counter() - start
+
+    original = [r[1] for r in results]
+    compacted = [r[2] for r in results]
+    print(f"[BENCH] {prompts} prompts, target={target_tokens}: cold {prompts / cold_s:.0f} prompts/s, "
+          f"memoized {prompts / memo_s:.0f} prompts/s, batches of 5 {prompts / 5 / batch_s:.0f} batches/s")
+    print(f"[BENCH] tokens mean {sum(original) / prompts:.1f} -> {sum(compacted) / prompts:.1f}, "
+          f"max {max(compacted)} (over budget: {sum(c > target_tokens for c in compacted)})")
+
+
+def _loose_prompt_key(prompt: str) -> str:
+    """Offline-only key for prompt_collapse_report: canonicalize_prompt plus the lossy rules it deliberately
+    leaves out - attributes sorted, clauses contained in another or in the subject dropped (see _dedupe_clauses)"""
+    canonical = canonicalize_prompt(prompt)[0]
+    if canonical.startswith("{"):
+        return canonical
+    sentences = []
+    for sentence in canonical.split(". "):
+        items = sentence.split(", ")
+        head_words = set(_PROMPT_WORD_RE.findall(items[0]))
+        rest = [item for item in _dedupe_clauses(items[1:]) if not set(_PROMPT_WORD_RE.findall(item)) <= head_words]
+        sentence = ", ".join([items[0]] + sorted(set(rest)))
+        if sentence not in sentences:
+            sentences.append(sentence)
+    return ". ".join(sentences)
+
+
+@app.local_entrypoint()
+def prompt_collapse_report(corpus_path: str, top: int = 10):
+    """How many distinct prompts collapse under canonicalize_prompt, and how many more would under the lossy
+    rules (attribute order, contained clauses) that are not used for caching. The corpus is a text file with one
+    prompt per line, or JSONL with a "prompt" field (e.g. prompts exported from the generation logs)."""
+    prompts = []
+    with open(corpus_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                try:
+                    line = json.loads(line).get("prompt") or ""
+                except ValueError:
+                    pass
+            if line:
+                prompts.append(line)
+
+    groups: dict = {}
+    for prompt in set(prompts):
+        groups.setdefault(canonicalize_prompt(prompt)[1], []).append(prompt)
+    fingerprints = [canonicalize_prompt(prompt)[1] for prompt in prompts]
+    distinct_raw = len(set(prompts))
+    print(f"[PROMPT] {len(prompts)} prompts: {distinct_raw} distinct raw -> {len(groups)} distinct canonical "
+          f"({distinct_raw - len(groups)} collapsed, {1 - len(groups) / max(1, distinct_raw):.1%})")
+    print(f"[PROMPT] cache hit ceiling over the corpus: raw {1 - distinct_raw / max(1, len(prompts)):.1%}, "
+          f"canonical {1 - len(set(fingerprints)) / max(1, len(prompts)):.1%}")
+    loose_keys = {_loose_prompt_key(prompt) for prompt in set(prompts)}
+    print(f"[PROMPT] sorting attributes and dropping contained clauses (not used for caching - lossy) would leave "
+          f"{len(loose_keys)} distinct ({len(groups) - len(loose_keys)} more collapsed)")
+    for fingerprint, variants in sorted(groups.items(), key=lambda item: -len(item[1]))[:top]:
+        if len(variants) < 2:
+            break
+        print(f"[PROMPT] {fingerprint}: {len(variants)} variants, e.g. {variants[0][:80]!r} / {variants[1][:80]!r}")
@@ -0,0 +1,11 @@
+from main import FluxScheduler
+
+
+def test_wait_p95_uses_nearest_rank():
+    scheduler = FluxScheduler(slots=1, max_wait_seconds=90)
+    scheduler._stats["final"]["waits"].extend([0.1, 0.2, 0.3])
+    scheduler._stats["preview"]["waits"].extend(i / 1000 for i in range(1, 101))
+    classes = scheduler.summary()["classes"]
+    assert classes["final"]["wait_ms_p95"] == 300
+    assert classes["preview"]["wait_ms_p95"] == 95
+    assert classes["batch"]["wait_ms_p95"] is None
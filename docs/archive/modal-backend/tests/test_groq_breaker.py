@@ -0,0 +1,31 @@
+import asyncio
+
+import main
+
+
+class _HangingClient:
+    async def post(self, *args, **kwargs):
+        await asyncio.sleep(3600)
+
+
+def test_cancelled_half_open_probe_releases_the_breaker(monkeypatch):
+    breaker = main.CircuitBreaker("GROQ", failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+    assert breaker.state == "half_open"
+    monkeypatch.setattr(main, "groq_breaker", breaker)
+    monkeypatch.setattr(main, "_get_groq_client", lambda: _HangingClient())
+    monkeypatch.setenv("GROQ_API_KEY", "test")
+
+    async def run():
+        probe = asyncio.ensure_future(main._call_groq_for_comment("kitchen", "a kitchen"))
+        await asyncio.sleep(0.01)
+        assert not breaker.allow()  # the probe is in flight
+        probe.cancel()
+        try:
+            await probe
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+    assert breaker.state == "half_open"
+    assert breaker.allow()  # the next call gets to probe
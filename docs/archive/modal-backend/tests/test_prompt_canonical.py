@@ -0,0 +1,25 @@
+from main import _loose_prompt_key, canonicalize_prompt
+
+
+def key(prompt):
+    return canonicalize_prompt(prompt)[1]
+
+
+def test_lossless_variants_share_a_key():
+    assert key("Modern Kitchen,  oak;steel.") == key("modern kitchen, oak, steel")
+    assert key("Kitchen, oak, oak") == key("Kitchen, oak")
+    assert key("Bright room. Bright room.") == key("Bright room.")
+    assert key('{"style": "modern", "room": "kitchen"}') == key('{"room":"kitchen","style":"modern"}')
+
+
+def test_contained_clauses_keep_distinct_keys():
+    assert key("Kitchen, warm lighting, soft warm lighting") != key("Kitchen, soft warm lighting")
+    assert key("Modern living room, wood floor, wood") != key("Modern living room, wood floor")
+
+
+def test_attribute_order_keeps_distinct_keys():
+    assert key("Kitchen, oak, steel") != key("Kitchen, steel, oak")
+
+
+def test_loose_report_key_still_collapses_them():
+    assert _loose_prompt_key("Kitchen, warm lighting, soft warm lighting") == _loose_prompt_key("Kitchen, soft warm lighting")
@@ -0,0 +1,52 @@
+import pytest
+from fastapi.testclient import TestClient
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+
+import main
+
+
+@pytest.fixture
+def tokenizer_loader(monkeypatch):
+    """Swap the hub download for a given loader, with fresh tokenizer state and memo caches"""
+    def install(loader):
+        monkeypatch.setattr(main, "_load_prompt_tokenizer", loader)
+        monkeypatch.setattr(main, "_prompt_tokenizer_state", {})
+        main.count_prompt_tokens.cache_clear()
+        main.compact_prompt.cache_clear()
+
+    yield install
+    main.count_prompt_tokens.cache_clear()
+    main.compact_prompt.cache_clear()
+
+
+def _tokenizer():
+    vocab = {"[UNK]": 0, "modern": 1, "kitchen": 2, ",": 3, "oak": 4, "floor": 5, "-": 6}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = Whitespace()
+    return tokenizer
+
+
+def test_token_count_matches_the_tokenizer(tokenizer_loader):
+    tokenizer = _tokenizer()
+    tokenizer_loader(lambda: tokenizer)
+    prompt = "Modern kitchen, oak floor, built-in shelves"
+    expected = len(tokenizer.encode(prompt, add_special_tokens=False).ids)
+    assert expected != len(prompt.split())
+    assert main.count_prompt_tokens(prompt) == expected
+
+
+def test_failed_load_is_cached_and_refinement_fails_loudly(tokenizer_loader):
+    calls = []
+
+    def broken():
+        calls.append(1)
+        raise OSError("hub unreachable")
+
+    tokenizer_loader(broken)
+    client = TestClient(main.web_app)
+    for _ in range(2):
+        response = client.post("/refine-prompt", json={"prompt": "Modern kitchen, oak floor"})
+        assert response.status_code == 503
+    assert calls == [1]
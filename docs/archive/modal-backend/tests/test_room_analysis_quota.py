@@ -0,0 +1,18 @@
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_analyze_room_quota_returns_429_with_retry_after(monkeypatch):
+    monkeypatch.setattr(main, "QUOTA_BACKEND", "memory")
+    monkeypatch.setattr(main, "_quota_backend", None)
+    monkeypatch.setattr(main, "room_analysis_quota", main.QuotaLimiter("room_analysis", 1, 60, "quota"))
+    client = TestClient(main.web_app)
+    body = {"image": "!!", "metadata": {"session_id": "quota-test"}}
+
+    # The first request is within quota and fails on the image itself
+    assert client.post("/analyze-room", json=body).status_code == 400
+
+    response = client.post("/analyze-room", json=body)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
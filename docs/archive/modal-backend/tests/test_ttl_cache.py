@@ -0,0 +1,43 @@
+import asyncio
+
+from main import AsyncTTLCache
+
+
+def test_cancelled_first_caller_does_not_cancel_coalesced_waiters():
+    cache = AsyncTTLCache(max_entries=8, ttl_seconds=60)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "image"
+
+    async def run():
+        first = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(cache.get_or_compute("key", compute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == "image"
+        assert first.cancelled()
+
+    asyncio.run(run())
+    assert calls == [1]
+    assert cache.get("key") == "image"
+    assert cache.coalesced == 1
+
+
+def test_failure_reaches_every_caller_and_is_not_cached():
+    cache = AsyncTTLCache(max_entries=8, ttl_seconds=60)
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("gpu down")
+
+    async def run():
+        results = await asyncio.gather(cache.get_or_compute("key", compute), cache.get_or_compute("key", compute),
+                                       return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert not cache.has("key")
+
+    asyncio.run(run())
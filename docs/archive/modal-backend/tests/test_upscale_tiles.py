@@ -0,0 +1,38 @@
+import numpy as np
+
+from main import blend_tiles, plan_tiles
+
+
+def test_single_tile_when_image_fits():
+    assert plan_tiles(1024, 768, 1024, 128) == [(0, 0, 1024, 768)]
+
+
+def test_tiles_cover_image_with_overlap():
+    width, height, tile_size, overlap = 2048, 1536, 1024, 128
+    tiles = plan_tiles(width, height, tile_size, overlap)
+    assert len(tiles) == 6
+    covered = np.zeros((height, width), dtype=bool)
+    for left, top, right, bottom in tiles:
+        assert right - left <= tile_size and bottom - top <= tile_size
+        covered[top:bottom, left:right] = True
+    assert covered.all()
+    lefts = sorted({box[0] for box in tiles})
+    rights = sorted({box[2] for box in tiles})
+    assert all(rights[i] - lefts[i + 1] >= overlap for i in range(len(lefts) - 1))
+
+
+def test_blend_of_unchanged_tiles_reproduces_input():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(700, 1100, 3)).astype(np.float32)
+    tiles = [(box, image[box[1]:box[3], box[0]:box[2]]) for box in plan_tiles(1100, 700, 512, 64)]
+    np.testing.assert_allclose(blend_tiles(1100, 700, tiles, 64), image, atol=1e-3)
+
+
+def test_blend_feathers_across_the_overlap():
+    tiles = plan_tiles(200, 100, 120, 40)
+    (left_box, right_box) = tiles
+    blended = blend_tiles(200, 100, [(left_box, np.zeros((100, 120, 1))), (right_box, np.full((100, 120, 1), 100.0))], 40)
+    row = blended[50, :, 0]
+    assert row[0] == 0 and row[-1] == 100
+    overlap = row[right_box[0]:left_box[2]]
+    assert np.all(np.diff(overlap) > 0)